@@ -9,6 +9,7 @@ from nicegui import app, ui
 from src.controllers.category_ctrl import init_predefined_categories
 from src.controllers.manager_ctrl import Manager
 from src.core.config import Config, read_config
+from src.core.executors import shutdown_executors
 from src.database import close_db, init_db
 from src.pages import (
     categories_page,
@@ -35,11 +36,12 @@ async def initialize():
     global GLOBAL_MANAGER
     assert GLOBAL_CONF
     assert GLOBAL_MANAGER
-    await GLOBAL_MANAGER.start_background_tasks()
-
     await init_db(GLOBAL_CONF.db_path)
     await init_predefined_categories()
 
+    # the manager resumes the queued jobs from the database
+    await GLOBAL_MANAGER.start_background_tasks()
+
 
 def main():
     global GLOBAL_CONF
@@ -60,6 +62,7 @@ def main():
 
     app.on_startup(initialize)
     app.on_shutdown(close_db)
+    app.on_shutdown(shutdown_executors)
 
     os.makedirs(GLOBAL_CONF.result_path, exist_ok=True)
     os.makedirs(GLOBAL_CONF.controlnet_references_path, exist_ok=True)
@@ -89,4 +92,6 @@ def main():
     ui.run(title="Bowl of scenes", reload=False, show=False)
 
 
-main()
+# the worker processes import this module, they must not start the app
+if __name__ == "__main__":
+    main()
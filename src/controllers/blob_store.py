@@ -0,0 +1,165 @@
+import hashlib
+import json
+from collections import OrderedDict
+from collections.abc import Iterable
+from dataclasses import asdict, is_dataclass
+from itertools import batched
+from typing import Any
+
+from tortoise.backends.base.client import BaseDBAsyncClient
+from tortoise.expressions import Subquery
+
+from src.db.records import BlobRecord, JobRecord
+from src.db.records.job_rec import JOB_BLOB_FIELDS
+
+# how many parsed blobs are kept in memory, least recently used are dropped
+BLOB_CACHE_SIZE = 10_000
+# how many hashes are looked up with one query
+BLOB_QUERY_SIZE = 500
+
+# the parsed blobs by hash, least recently used first. The values are shared
+# by every job that references them, so they must not be changed in place.
+_blobs: OrderedDict[str, Any] = OrderedDict()
+
+
+def encode_blob(value: Any) -> str:
+    def encode_dataclass(obj: Any) -> Any:
+        if is_dataclass(obj) and not isinstance(obj, type):
+            return asdict(obj)
+        raise TypeError(f"{type(obj).__name__} is not JSON serializable")
+
+    return json.dumps(value, separators=(",", ":"), default=encode_dataclass)
+
+
+def blob_hash(data: str) -> str:
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+def cache_blob(ref: str, value: Any):
+    _blobs[ref] = value
+    _blobs.move_to_end(ref)
+    while len(_blobs) > BLOB_CACHE_SIZE:
+        _blobs.popitem(last=False)
+
+
+async def store_blobs(
+    values: list[Any], conn: BaseDBAsyncClient | None = None
+) -> list[str | None]:
+    """
+    Stores the values that are not stored yet and returns their hashes, with
+    None for the values that are None. It must run in the transaction that
+    saves the jobs referencing the values, so that delete_unused_blobs can
+    not delete a blob before its jobs exist.
+
+    A value is encoded and hashed once however many times it is repeated,
+    e.g. the command code of every job of a chunk.
+    """
+    refs: list[str | None] = []
+    refs_by_value: dict[int, str] = {}
+    encoded: dict[str, str] = {}
+    for value in values:
+        if value is None:
+            refs.append(None)
+            continue
+
+        ref = refs_by_value.get(id(value))
+        if ref is None:
+            data = encode_blob(value)
+            ref = blob_hash(data)
+            refs_by_value[id(value)] = ref
+            encoded[ref] = data
+        refs.append(ref)
+
+    for chunk in batched(encoded, BLOB_QUERY_SIZE):
+        stored = set(
+            await BlobRecord.filter(hash__in=chunk)
+            .using_db(conn)
+            .values_list("hash", flat=True)
+        )
+        await BlobRecord.bulk_create(
+            [
+                BlobRecord(hash=ref, data=encoded[ref])
+                for ref in chunk
+                if ref not in stored
+            ],
+            using_db=conn,
+        )
+        for ref in chunk:
+            if ref not in _blobs:
+                cache_blob(ref, json.loads(encoded[ref]))
+
+    return refs
+
+
+async def store_job_blobs(
+    job_inputs: list[dict[str, Any]], conn: BaseDBAsyncClient | None = None
+):
+    """
+    Replaces the blob values in the fields of new jobs with the references
+    to their stored blobs, in the transaction that inserts the jobs.
+    """
+    with_value = [
+        (job_input, name)
+        for name in JOB_BLOB_FIELDS
+        for job_input in job_inputs
+        if name in job_input
+    ]
+    refs = await store_blobs(
+        [job_input.pop(name) for job_input, name in with_value], conn
+    )
+    for (job_input, name), ref in zip(with_value, refs):
+        job_input[name + "_ref"] = ref
+
+
+async def load_blobs(refs: Iterable[str | None]) -> dict[str, Any]:
+    blobs: dict[str, Any] = {}
+    missing: set[str] = set()
+    for ref in refs:
+        if ref is None or ref in blobs:
+            continue
+        if ref in _blobs:
+            _blobs.move_to_end(ref)
+            blobs[ref] = _blobs[ref]
+        else:
+            missing.add(ref)
+
+    for chunk in batched(missing, BLOB_QUERY_SIZE):
+        for blob in await BlobRecord.filter(hash__in=chunk):
+            value = json.loads(blob.data)
+            cache_blob(blob.hash, value)
+            blobs[blob.hash] = value
+
+    return blobs
+
+
+async def hydrate_jobs(jobs: list[JobRecord]) -> list[JobRecord]:
+    """
+    Sets the blob values of the jobs from the blobs their fields reference.
+    A value whose blob is missing is left None.
+    """
+    refs = [
+        getattr(job, name + "_ref") for job in jobs for name in JOB_BLOB_FIELDS
+    ]
+    blobs = await load_blobs(refs)
+    for job in jobs:
+        for name in JOB_BLOB_FIELDS:
+            ref = getattr(job, name + "_ref")
+            if ref is not None and ref not in blobs:
+                print("Blob", ref, "of the", name, "of job", job.id, "is missing")
+            setattr(job, name, blobs.get(ref))
+
+    return jobs
+
+
+async def delete_unused_blobs():
+    """Deletes the blobs that no job references anymore."""
+    query = BlobRecord.all()
+    for name in JOB_BLOB_FIELDS:
+        query = query.exclude(
+            hash__in=Subquery(
+                JobRecord.filter(**{name + "_ref__isnull": False}).values(
+                    name + "_ref"
+                )
+            )
+        )
+    await query.delete()
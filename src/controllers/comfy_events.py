@@ -0,0 +1,120 @@
+import asyncio
+from collections import OrderedDict
+
+from yet_another_comfy_client import (
+    EventType,
+    StatusData,
+    YetAnotherComfyClient,
+)
+
+# how many finished prompt ids are remembered for late waiters
+FINISHED_PROMPTS_MEMORY = 1000
+# the events after which ComfyUI renders nothing more for the prompt, the
+# waiter finds out from the history whether it has images
+PROMPT_ENDED_EVENTS = (
+    EventType.EXECUTION_SUCCESS,
+    EventType.EXECUTION_ERROR,
+    EventType.EXECUTION_INTERRUPTED,
+)
+
+
+class ComfyEventListener:
+    """
+    Keeps one event stream open per ComfyUI server and routes the events
+    to the jobs that wait for them by prompt id.
+    """
+
+    def __init__(self, code_name: str, client: YetAnotherComfyClient):
+        self.code_name = code_name
+        self.client = client
+        self.progress: dict[str, tuple[int, int]] = {}
+        self._waiters: dict[str, asyncio.Future[None]] = {}
+        self._finished: OrderedDict[str, None] = OrderedDict()
+        self._task: asyncio.Task | None = None
+        self._queue_remaining = 0
+        self._history_checks: set[asyncio.Task] = set()
+
+    def start(self):
+        self._task = asyncio.create_task(self.listen())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+        for task in self._history_checks:
+            task.cancel()
+
+        for fut in self._waiters.values():
+            fut.cancel()
+        self._waiters.clear()
+
+    async def wait_for(self, prompt_id: str):
+        # the prompt could finish before anybody waits for it
+        if prompt_id in self._finished:
+            return
+
+        fut = self._waiters.get(prompt_id)
+        if fut is None:
+            fut = asyncio.get_running_loop().create_future()
+            self._waiters[prompt_id] = fut
+
+        await fut
+
+    async def listen(self):
+        while True:
+            try:
+                async for event in self.client.get_events():
+                    self.handle_event(event)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print("Events from Comfyui", self.code_name, "failed:", e)
+
+            print("Event from Comfyui ", self.code_name, " closed")
+            await asyncio.sleep(1)
+
+    def handle_event(self, event):
+        if event.type in PROMPT_ENDED_EVENTS:
+            prompt_id = getattr(event.data, "prompt_id", None)
+            if prompt_id is not None:
+                self.prompt_finished(prompt_id)
+
+        elif event.type == EventType.PROGRESS:
+            prompt_id = getattr(event.data, "prompt_id", None)
+            if prompt_id is not None:
+                self.progress[prompt_id] = (event.data.value, event.data.max)
+
+        elif event.type == EventType.STATUS:
+            # nothing is left in the queue, so every prompt we wait for ended
+            # even if its event was missed, or was lost in a restart
+            assert isinstance(event.data, StatusData)
+            self._queue_remaining = event.data.status.exec_info.queue_remaining
+            if self._queue_remaining == 0 and len(self._waiters) > 0:
+                task = asyncio.create_task(self.check_history(list(self._waiters)))
+                self._history_checks.add(task)
+                task.add_done_callback(self._history_checks.discard)
+
+    async def check_history(self, prompt_ids: list[str]):
+        """
+        Ends the waits of the prompts in the history, and of the rest too
+        if the queue is still empty. A status sent just before a prompt was
+        queued is followed by one that counts it, so that prompt is kept.
+        """
+        for prompt_id in prompt_ids:
+            output = None
+            try:
+                output = await self.client.get_images_by_prompt_id(prompt_id)
+            except Exception as e:
+                print("History of", prompt_id, "from", self.code_name, "failed:", e)
+
+            if output is not None or self._queue_remaining == 0:
+                self.prompt_finished(prompt_id)
+
+    def prompt_finished(self, prompt_id: str):
+        self.progress.pop(prompt_id, None)
+        self._finished[prompt_id] = None
+        while len(self._finished) > FINISHED_PROMPTS_MEMORY:
+            self._finished.popitem(last=False)
+
+        fut = self._waiters.pop(prompt_id, None)
+        if fut is not None and not fut.done():
+            fut.set_result(None)
@@ -1,9 +1,14 @@
+import asyncio
+import math
 import os
-from dataclasses import dataclass
-from itertools import product
+from collections.abc import Callable, Iterator
+from dataclasses import asdict, dataclass
+from itertools import batched, chain, product
 from typing import Any
 
+from tortoise.backends.base.client import BaseDBAsyncClient
 from tortoise.expressions import F
+from tortoise.transactions import in_transaction
 
 from src.controllers.command_ctrl.command_parser import (
     GroupSelection,
@@ -12,12 +17,24 @@ from src.controllers.command_ctrl.command_parser import (
 from src.controllers.command_ctrl.command_validator import (
     validate_code_names,
 )
+from src.controllers.command_ctrl.selection_resolver import SelectionResolver
+from src.controllers.blob_store import delete_unused_blobs, store_job_blobs
+from src.controllers.common import remove_files
 from src.controllers.manager_ctrl import Manager
+from src.controllers.prompt_assembly import (
+    ItemContribution,
+    assemble_prompt,
+    item_contribution,
+)
+from src.controllers.prompt_builder import (
+    compile_fixer_prompts,
+    compile_generator_prompts,
+)
 from src.core.config import Config
+from src.core.executors import CPU_WORKERS, run_cpu, run_io
 from src.db.records import (
     CommandRecord,
     GeneratorRecord,
-    GroupRecord,
     ItemRecord,
     JobRecord,
     ServerRecord,
@@ -26,6 +43,9 @@ from src.db.records.fixer_rec import FixerRecord
 from src.db.records.item_rec import CoordinatedRegionKeyword, MaskRegionImages
 from src.db.records.job_rec import CoordinatedRegion, RegionPrompt
 
+# how many generator jobs are written to the database at once
+JOBS_CHUNK_SIZE = 500
+
 
 @dataclass
 class CommandInput:
@@ -42,104 +62,34 @@ class CommandOutput:
     command_json: dict[str, Any]
 
 
-async def get_items_per_group_without_regioned_prompts(
-    group_selections: list[GroupSelection],
-) -> list[list[ItemRecord]]:
-    items_per_group: list[list[ItemRecord]] = []
-    for group_sel in group_selections:
-        # Handle merged groups
-        if group_sel.is_merged:
-            merged_items: list[ItemRecord] = []
-            assert group_sel.merged_groups is not None
-            for merged_group in group_sel.merged_groups:
-                group_code = merged_group["group_code_name"]
-
-                # Check group exists
-                group = await GroupRecord.filter(code_name=group_code).first()
-                if not group:
-                    raise ValueError(f"Group '{group_code}' not found")
-
-                items = []
-                if (
-                    merged_group["exclude"] is None
-                    and merged_group["include_only"] is None
-                ):
-                    items = await ItemRecord.filter(group_id=group.id).all()
-
-                elif merged_group["exclude"] is not None:
-                    items = (
-                        await ItemRecord.filter(group_id=group.id)
-                        .exclude(code_name__in=merged_group["exclude"])
-                        .all()
-                    )
-
-                elif merged_group["include_only"] is not None:
-                    items = await ItemRecord.filter(
-                        group_id=group.id, code_name__in=merged_group["include_only"]
-                    ).all()
-
-                merged_items.extend(items)
-
-            items_per_group.append(merged_items)
-        else:
-            # Handle single group
-            group_code = group_sel.group_code_name
-
-            # Check group exists
-            group = await GroupRecord.filter(code_name=group_code).first()
-            if not group:
-                raise ValueError(f"Group '{group_code}' not found")
-
-            items = []
-            if group_sel.exclude is None and group_sel.include_only is None:
-                items = await ItemRecord.filter(group_id=group.id).all()
-
-            elif group_sel.exclude is not None:
-                items = (
-                    await ItemRecord.filter(group_id=group.id)
-                    .exclude(code_name__in=group_sel.exclude)
-                    .all()
-                )
-
-            elif group_sel.include_only is not None:
-                items = await ItemRecord.filter(
-                    group_id=group.id, code_name__in=group_sel.include_only
-                ).all()
-
-            items_per_group.append(items)
-
-    return items_per_group
-
-
 @dataclass
 class RegionPromptCombOutput:
     region_items: list[ItemRecord]
     loras: list[dict[str, Any]]  # contains the items with color coded mask file
-    regioned_prompts: list[dict[str, RegionPrompt]]
+    region_prompts_per_key: dict[str, list[RegionPrompt]]
+
+    def count(self) -> int:
+        return math.prod(len(rps) for rps in self.region_prompts_per_key.values())
 
+    def regioned_prompts(self) -> Iterator[dict[str, RegionPrompt]]:
+        keys = list(self.region_prompts_per_key.keys())
+        values_lists = list(self.region_prompts_per_key.values())
+        for combo in product(*values_lists):
+            yield dict(zip(keys, combo))
 
-async def get_region_prompt_comb(
+
+def get_region_prompt_comb(
+    resolver: SelectionResolver,
     group_selections: list[GroupSelection],
 ) -> RegionPromptCombOutput | None:
-    the_group = None
-    the_gs = None
-    for gs in group_selections:
-        if not gs.is_regioned:
-            continue
-
-        the_gs = gs
-        group = await GroupRecord.get_or_none(code_name=gs.group_code_name)
-        if group is None:
-            continue
-        the_group = group
-        break
-
-    if the_gs is None or the_group is None:
+    region = resolver.region_selection(group_selections)
+    if region is None:
         return None
 
+    the_gs, the_group = region
     assert the_gs.region_group_selections is not None
 
-    region_items = await ItemRecord.filter(group_id=the_group.id).all()
+    region_items = resolver.items_of_group(the_group.id)
     region_prompts_per_key: dict[str, list[RegionPrompt]] = {}
     loras = {}
     for ri in region_items:
@@ -148,44 +98,38 @@ async def get_region_prompt_comb(
             for keyword, mask_file in mri.mask_files.items():
                 group_sels = the_gs.region_group_selections[keyword]
 
-                items_per_group = await get_items_per_group_without_regioned_prompts(
-                    group_sels
-                )
-                combined_items = [list(combo) for combo in product(*items_per_group)]
+                items_per_group = resolver.items_per_group(group_sels)
                 region_prompts_per_key[keyword] = []
-                for items in combined_items:
-                    prompt_positive = ""
-                    for item in items:
-                        if item.lora is not None:
-                            loras[item.lora["name"]] = item.lora
-
-                        if len(item.positive_prompt) > 0:
-                            prompt_positive += item.positive_prompt + " "
+                contributions_per_group = [
+                    [item_contribution(item) for item in items]
+                    for items in items_per_group
+                ]
+                for contributions in product(*contributions_per_group):
+                    assembled = assemble_prompt(contributions)
+                    for lora in assembled.lora_list:
+                        loras[lora["name"]] = lora
 
                     rp = RegionPrompt(
                         keyword=keyword,
                         mask_file=os.path.abspath(mask_file),
                         coordinates=None,
-                        prompt=prompt_positive,
+                        prompt=assembled.prompt_positive,
                     )
                     region_prompts_per_key[keyword].append(rp)
         elif ri.coordinated_regions is not None:
             crns = [CoordinatedRegionKeyword(**v) for v in ri.coordinated_regions]
             for crn in crns:
                 group_sels = the_gs.region_group_selections[crn.keyword]
-                items_per_group = await get_items_per_group_without_regioned_prompts(
-                    group_sels
-                )
-                combined_items = [list(combo) for combo in product(*items_per_group)]
+                items_per_group = resolver.items_per_group(group_sels)
                 region_prompts_per_key[crn.keyword] = []
-                for items in combined_items:
-                    prompt_positive = ""
-                    for item in items:
-                        if item.lora is not None:
-                            loras[item.lora["name"]] = item.lora
-
-                        if len(item.positive_prompt) > 0:
-                            prompt_positive += item.positive_prompt + " "
+                contributions_per_group = [
+                    [item_contribution(item) for item in items]
+                    for items in items_per_group
+                ]
+                for contributions in product(*contributions_per_group):
+                    assembled = assemble_prompt(contributions)
+                    for lora in assembled.lora_list:
+                        loras[lora["name"]] = lora
 
                     rp = RegionPrompt(
                         keyword=crn.keyword,
@@ -193,25 +137,214 @@ async def get_region_prompt_comb(
                         coordinates=CoordinatedRegion(
                             width=crn.width, height=crn.height, x=crn.x, y=crn.y
                         ),
-                        prompt=prompt_positive,
+                        prompt=assembled.prompt_positive,
                     )
                     region_prompts_per_key[crn.keyword].append(rp)
 
     if len(region_prompts_per_key) == 0:
         return None
 
-    keys = list(region_prompts_per_key.keys())
-    values_lists = list(region_prompts_per_key.values())
-    regioned_prompts = [dict(zip(keys, combo)) for combo in product(*values_lists)]
-
     return RegionPromptCombOutput(
         region_items=region_items,
-        regioned_prompts=regioned_prompts,
+        region_prompts_per_key=region_prompts_per_key,
         loras=list(loras.values()),
     )
 
 
-async def create_jobs(conf: Config, command: CommandRecord) -> list[JobRecord]:
+def get_item_contributions(
+    resolver: SelectionResolver,
+    items_per_group: list[list[ItemRecord]],
+) -> list[list[ItemContribution]]:
+    """
+    Computes what each item adds to a job once, together with its part
+    of the result filename, so that combinations are built without queries.
+    """
+    group_code_names = resolver.group_code_names()
+    return [
+        [item_contribution(item, group_code_names.get(item.group_id)) for item in items]
+        for items in items_per_group
+    ]
+
+
+def generate_job_inputs(
+    conf: Config,
+    command: CommandRecord,
+    server: ServerRecord,
+    generator: GeneratorRecord,
+    server_pool: list[str] | None,
+    contributions_per_group: list[list[ItemContribution]],
+    ccp_comb: RegionPromptCombOutput | None,
+) -> Iterator[dict[str, Any]]:
+    """
+    Yields the fields of each generator job one combination at a time,
+    so that no combination is kept in memory after it is written.
+    """
+    # every combination of items shares the same region prompts, so each
+    # of them is stored once
+    regioned_prompts = [] if ccp_comb is None else list(ccp_comb.regioned_prompts())
+    for contributions in product(*contributions_per_group):
+        assembled = assemble_prompt(contributions)
+        lora_list = assembled.lora_list
+        if ccp_comb is not None and len(ccp_comb.loras) > 0:
+            lora_list.extend(ccp_comb.loras)
+
+        result_filename_img = (
+            f"{server.code_name}_{generator.code_name}_{command.id}"
+            + assembled.filename
+        )
+        job_input = dict(
+            project_id=command.project_id,
+            command_id=command.id,
+            group_item_id_list=assembled.group_item_id_list,
+            code_str=command.command_code,
+            server_code_name=server.code_name,
+            server_host=server.host,
+            server_pool=server_pool,
+            generator_code_name=generator.code_name,
+            prompt_positive=assembled.prompt_positive,
+            prompt_negative=assembled.prompt_negative,
+            reference_controlnet_img=assembled.reference_controlnet_img,
+            ipadapter_list=assembled.ipadapter_list,
+            lora_list=lora_list,
+        )
+
+        if ccp_comb is not None:
+            for i, ccp in enumerate(regioned_prompts):
+                result_img = os.path.join(
+                    conf.result_path,
+                    result_filename_img + f"_ccp_{i}" + ".png",
+                )
+                yield job_input | dict(region_prompts=ccp, result_img=result_img)
+        else:
+            result_img = os.path.join(conf.result_path, result_filename_img + ".png")
+            yield job_input | dict(result_img=result_img)
+
+
+async def bulk_create_jobs(
+    conn: BaseDBAsyncClient, job_inputs: list[dict[str, Any]]
+) -> list[JobRecord]:
+    """
+    Inserts the jobs with one bulk insert and sets their ids, which
+    bulk_create leaves empty. It must run inside a transaction so the
+    new rows get consecutive ids in the order they were inserted.
+    """
+    jobs = [JobRecord(**job_input) for job_input in job_inputs]
+    last_id = (
+        await JobRecord.all()
+        .using_db(conn)
+        .order_by("-id")
+        .first()
+        .values_list("id", flat=True)
+    )
+    await JobRecord.bulk_create(jobs, using_db=conn)
+    ids = (
+        await JobRecord.filter(id__gt=last_id or 0)
+        .using_db(conn)
+        .order_by("id")
+        .values_list("id", flat=True)
+    )
+    if len(ids) != len(jobs):
+        raise ValueError("Could not read back the ids of the created jobs")
+
+    for job, job_id in zip(jobs, ids):
+        job.id = job_id
+
+    return jobs
+
+
+def fixer_result_img(
+    conf: Config, fixer: FixerRecord, original_result_img: str
+) -> str:
+    result_filename_img = os.path.basename(original_result_img)
+    return os.path.join(conf.result_path, fixer.code_name + "_" + result_filename_img)
+
+
+def fixer_job_input(
+    conf: Config,
+    command: CommandRecord,
+    server: ServerRecord,
+    server_pool: list[str] | None,
+    fixer: FixerRecord,
+    pj: JobRecord,
+) -> dict[str, Any]:
+    result_img = fixer_result_img(conf, fixer, pj.result_img)
+    return dict(
+        project_id=command.project_id,
+        command_id=command.id,
+        group_item_id_list_ref=pj.group_item_id_list_ref,
+        code_str_ref=pj.code_str_ref,
+        server_code_name=server.code_name,
+        server_host=server.host,
+        server_pool=server_pool,
+        fixer_code_name=fixer.code_name,
+        fix_job_id=pj.id,
+        generator_code_name=None,
+        prompt_positive="",
+        prompt_negative="",
+        reference_controlnet_img=None,
+        lora_list_ref=None,
+        result_img=result_img,
+    )
+
+
+async def precompile_prompts(
+    conf: Config,
+    generator: GeneratorRecord,
+    fixers: list[FixerRecord],
+    chunk: list[dict[str, Any]],
+) -> list[list[bytes]]:
+    """
+    Builds the prompts of a chunk of generator jobs and of their fixer jobs
+    on the worker processes. The prompts of the generator jobs are added to
+    their inputs, the prompts of the jobs of each fixer are returned in the
+    order of the chunk.
+    """
+    # the region prompts as they are read back from the database
+    job_inputs = [
+        job_input
+        | dict(
+            region_prompts={
+                key: asdict(region_prompt)
+                for key, region_prompt in job_input["region_prompts"].items()
+            }
+        )
+        if job_input.get("region_prompts") is not None
+        else job_input
+        for job_input in chunk
+    ]
+    slice_size = math.ceil(len(job_inputs) / CPU_WORKERS)
+    generator_prompts = await asyncio.gather(
+        *(
+            run_cpu(compile_generator_prompts, generator, list(job_inputs_slice))
+            for job_inputs_slice in batched(job_inputs, slice_size)
+        )
+    )
+    for job_input, prompt in zip(chunk, chain.from_iterable(generator_prompts)):
+        job_input.update(compiled_prompt=prompt, compiled_version=generator.version)
+
+    # each fixer fixes the images of the jobs of the previous one
+    original_result_imgs = [job_input["result_img"] for job_input in chunk]
+    fixer_calls = []
+    for fixer in fixers:
+        fixer_calls.append(run_cpu(compile_fixer_prompts, fixer, original_result_imgs))
+        original_result_imgs = [
+            fixer_result_img(conf, fixer, result_img)
+            for result_img in original_result_imgs
+        ]
+
+    return list(await asyncio.gather(*fixer_calls))
+
+
+async def create_jobs(
+    conf: Config,
+    command: CommandRecord,
+    on_progress: Callable[[int, int], None] | None = None,
+) -> int:
+    """
+    Creates the jobs of the command in chunks of JOBS_CHUNK_SIZE and
+    returns how many were created. on_progress is called after each chunk
+    with the number of created jobs and the total.
+    """
     parser = PromptLanguageParser()
     cmd = parser.parse(command.command_code)
     server = await ServerRecord.filter(code_name=cmd.server_code_name).first()
@@ -231,129 +364,61 @@ async def create_jobs(conf: Config, command: CommandRecord) -> list[JobRecord]:
 
             fixers.append(fix_rec)
 
-    items_per_group = await get_items_per_group_without_regioned_prompts(
-        cmd.group_selections
+    resolver = await SelectionResolver.load(cmd.group_selections)
+    items_per_group = resolver.items_per_group(cmd.group_selections)
+
+    ccp_comb = get_region_prompt_comb(resolver, cmd.group_selections)
+
+    total = math.prod(len(items) for items in items_per_group)
+    if ccp_comb is not None:
+        total *= ccp_comb.count()
+    total *= 1 + len(fixers)
+
+    print(f"Will run {total}")
+    created = 0
+
+    async def write_chunk(chunk: list[dict[str, Any]]):
+        nonlocal created
+        fixer_prompts: list[list[bytes]] = []
+        if conf.precompile_prompts:
+            fixer_prompts = await precompile_prompts(conf, generator, fixers, chunk)
+
+        async with in_transaction() as conn:
+            await store_job_blobs(chunk, conn)
+            process_jobs = await bulk_create_jobs(conn, chunk)
+            created += len(process_jobs)
+            for i, fixer in enumerate(fixers):
+                fixer_inputs = [
+                    fixer_job_input(conf, command, server, cmd.server_pool, fixer, pj)
+                    for pj in process_jobs
+                ]
+                if fixer_prompts:
+                    for fixer_input, prompt in zip(fixer_inputs, fixer_prompts[i]):
+                        fixer_input.update(
+                            compiled_prompt=prompt, compiled_version=fixer.version
+                        )
+
+                process_jobs = await bulk_create_jobs(conn, fixer_inputs)
+                created += len(process_jobs)
+
+        print(f"Created {created}/{total} jobs of command {command.id}")
+        if on_progress is not None:
+            on_progress(created, total)
+
+    contributions_per_group = get_item_contributions(resolver, items_per_group)
+    job_inputs = generate_job_inputs(
+        conf,
+        command,
+        server,
+        generator,
+        cmd.server_pool,
+        contributions_per_group,
+        ccp_comb,
     )
-    combined_items = [list(combo) for combo in product(*items_per_group)]
-
-    ccp_comb = await get_region_prompt_comb(cmd.group_selections)
-
-    print(f"Will run {len(combined_items)}")
-    res: list[JobRecord] = []
-    for items in combined_items:
-        prompt_positive = ""
-        prompt_negative = ""
-        reference_controlnet_img = None
-        lora_list = []
-        ipadapter_list = []
-        group_item_id_list = []
-
-        result_filename_img = f"{server.code_name}_{generator.code_name}_{command.id}"
-        for item in items:
-            group = await GroupRecord.get_or_none(id=item.group_id)
-            if group is not None:
-                result_filename_img += "_" + group.code_name
-
-            result_filename_img += "_" + item.code_name
-            group_item_id_list.append(
-                {
-                    "group_id": item.group_id,
-                    "item_id": item.id,
-                }
-            )
-            if len(item.positive_prompt) > 0:
-                prompt_positive += item.positive_prompt + " "
-            if len(item.negative_prompt) > 0:
-                prompt_negative += item.negative_prompt + " "
-            if item.controlnet_reference_image is not None:
-                reference_controlnet_img = os.path.abspath(
-                    item.controlnet_reference_image
-                )
+    for chunk in batched(job_inputs, JOBS_CHUNK_SIZE):
+        await write_chunk(list(chunk))
 
-            if item.ipadapter is not None:
-                ipadapter_list.append(item.ipadapter)
-
-            if item.lora is not None:
-                lora_list.append(item.lora)
-
-        if ccp_comb is not None:
-            if len(ccp_comb.loras) > 0:
-                lora_list.extend(ccp_comb.loras)
-
-            for i, ccp in enumerate(ccp_comb.regioned_prompts):
-                result_img = os.path.join(
-                    conf.result_path,
-                    result_filename_img + f"_ccp_{i}" + ".png",
-                )
-                job = await JobRecord.create(
-                    project_id=command.project_id,
-                    command_id=command.id,
-                    group_item_id_list=group_item_id_list,
-                    code_str=command.command_code,
-                    server_code_name=server.code_name,
-                    server_host=server.host,
-                    generator_code_name=generator.code_name,
-                    prompt_positive=prompt_positive,
-                    prompt_negative=prompt_negative,
-                    region_prompts=ccp,
-                    reference_controlnet_img=reference_controlnet_img,
-                    ipadapter_list=ipadapter_list,
-                    lora_list=lora_list,
-                    result_img=result_img,
-                )
-                res.append(job)
-        else:
-            result_img = os.path.join(conf.result_path, result_filename_img + ".png")
-            job = await JobRecord.create(
-                project_id=command.project_id,
-                command_id=command.id,
-                group_item_id_list=group_item_id_list,
-                code_str=command.command_code,
-                server_code_name=server.code_name,
-                server_host=server.host,
-                generator_code_name=generator.code_name,
-                prompt_positive=prompt_positive,
-                prompt_negative=prompt_negative,
-                reference_controlnet_img=reference_controlnet_img,
-                ipadapter_list=ipadapter_list,
-                lora_list=lora_list,
-                result_img=result_img,
-            )
-            res.append(job)
-
-    if len(fixers) > 0:
-        process_jobs = res.copy()
-        for fixer in fixers:
-            new_process_jobs = []
-            for pj in process_jobs:
-                result_filename_img = os.path.basename(pj.result_img)
-                result_img = os.path.join(
-                    conf.result_path, fixer.code_name + "_" + result_filename_img
-                )
-
-                job = await JobRecord.create(
-                    project_id=command.project_id,
-                    command_id=command.id,
-                    group_item_id_list=pj.group_item_id_list,
-                    code_str=command.command_code,
-                    server_code_name=server.code_name,
-                    server_host=server.host,
-                    fixer_code_name=fixer.code_name,
-                    fix_job_id=pj.id,
-                    generator_code_name=None,
-                    prompt_positive="",
-                    prompt_negative="",
-                    reference_controlnet_img=None,
-                    reference_ipadapter_img=None,
-                    lora_list=None,
-                    result_img=result_img,
-                )
-                res.append(job)
-                new_process_jobs.append(job)
-
-            process_jobs = new_process_jobs.copy()
-
-    return res
+    return created
 
 
 async def run_command(manager: Manager, command_id: int):
@@ -364,14 +429,18 @@ async def run_command(manager: Manager, command_id: int):
     await manager.add_command(cmd.id)
 
 
-async def recreate_command(conf: Config, command_id: int):
+async def recreate_command(
+    conf: Config,
+    command_id: int,
+    on_progress: Callable[[int, int], None] | None = None,
+):
     cmd = await CommandRecord.get_or_none(id=command_id)
     if cmd is None:
         raise ValueError("command doesn't exist")
 
     await delete_jobs_from_command(command_id)
 
-    await create_jobs(conf, cmd)
+    await create_jobs(conf, cmd, on_progress)
 
 
 async def get_command(command_id: int) -> CommandOutput:
@@ -389,7 +458,10 @@ async def get_command(command_id: int) -> CommandOutput:
 
 
 async def add_command(
-    conf: Config, input: CommandInput, insert_at: int | None = None
+    conf: Config,
+    input: CommandInput,
+    insert_at: int | None = None,
+    on_progress: Callable[[int, int], None] | None = None,
 ) -> list[str] | None:
     """
     Add a new command. If insert_at is specified, insert at that position,
@@ -426,10 +498,15 @@ async def add_command(
         command_json=command.to_dict(),
     )
 
-    await create_jobs(conf, cmd_rec)
+    await create_jobs(conf, cmd_rec, on_progress)
 
 
-async def edit_command(conf: Config, id: int, input: CommandInput) -> list[str] | None:
+async def edit_command(
+    conf: Config,
+    id: int,
+    input: CommandInput,
+    on_progress: Callable[[int, int], None] | None = None,
+) -> list[str] | None:
     cmd = await CommandRecord.get_or_none(id=id)
     if cmd is None:
         raise ValueError("command doesn't exist")
@@ -446,17 +523,16 @@ async def edit_command(conf: Config, id: int, input: CommandInput) -> list[str]
         cmd.command_json = command.to_dict()
         await cmd.save()
         await delete_jobs_from_command(cmd.id)
-        await create_jobs(conf, cmd)
+        await create_jobs(conf, cmd, on_progress)
 
 
 async def delete_jobs_from_command(command_id: int):
-    jobs = await JobRecord.filter(command_id=command_id).all()
-    for job in jobs:
-        if job.result_img is not None:
-            if os.path.exists(job.result_img):
-                os.remove(job.result_img)
-
-        await job.delete()
+    result_imgs = await JobRecord.filter(
+        command_id=command_id, result_img__isnull=False
+    ).values_list("result_img", flat=True)
+    await run_io(remove_files, result_imgs)
+    await JobRecord.filter(command_id=command_id).delete()
+    await delete_unused_blobs()
 
 
 async def delete_command(command_id: int):
@@ -0,0 +1,187 @@
+import math
+from dataclasses import dataclass
+
+from tortoise.functions import Avg
+
+from src.controllers.command_ctrl.command_parser import (
+    GroupSelection,
+    PromptLanguageParser,
+)
+from src.controllers.command_ctrl.command_validator import validate_code_names
+from src.controllers.command_ctrl.selection_resolver import SelectionResolver
+from src.db.records import JobRecord
+from src.db.records.item_rec import CoordinatedRegionKeyword, MaskRegionImages
+from src.db.records.job_rec import JobStatus
+
+
+@dataclass
+class ServerEstimate:
+    server_code_name: str
+    seconds_per_generator_job: float | None
+    seconds_per_fixer_job: dict[str, float | None]
+    # None when the server has not finished any job yet
+    estimated_seconds: float | None
+
+
+@dataclass
+class CommandEstimate:
+    generator_jobs: int
+    fixer_jobs: int
+    total_jobs: int
+    region_combinations: int
+    servers: list[ServerEstimate]
+    # time for the whole pool, None when no server of the pool has history
+    estimated_seconds: float | None
+
+
+def count_region_combinations(
+    resolver: SelectionResolver,
+    group_selections: list[GroupSelection],
+) -> int:
+    """
+    Counts the region prompt combinations that create_jobs would build
+    for the command, from the item counts of each region keyword.
+    """
+    region = resolver.region_selection(group_selections)
+    if region is None:
+        return 1
+
+    gs, group = region
+    assert gs.region_group_selections is not None
+
+    keywords = set()
+    for ri in resolver.items_of_group(group.id):
+        if ri.mask_region_images is not None:
+            keywords.update(MaskRegionImages(**ri.mask_region_images).mask_files.keys())
+        elif ri.coordinated_regions is not None:
+            keywords.update(
+                CoordinatedRegionKeyword(**v).keyword for v in ri.coordinated_regions
+            )
+
+    return math.prod(
+        math.prod(
+            len(items)
+            for items in resolver.items_per_group(gs.region_group_selections[keyword])
+        )
+        for keyword in keywords
+    )
+
+
+async def historic_render_seconds(
+    server_code_names: list[str],
+) -> dict[tuple[str, str], float]:
+    """
+    Returns the average render time of the finished jobs, keyed by server
+    and by the generator or fixer code name of the jobs.
+    """
+    rows = (
+        await JobRecord.filter(
+            status=JobStatus.FINISHED,
+            server_code_name__in=server_code_names,
+            render_seconds__not_isnull=True,
+        )
+        .annotate(avg_seconds=Avg("render_seconds"))
+        .group_by("server_code_name", "generator_code_name", "fixer_code_name")
+        .values(
+            "server_code_name",
+            "generator_code_name",
+            "fixer_code_name",
+            "avg_seconds",
+        )
+    )
+
+    durations = {}
+    for row in rows:
+        workflow = row["generator_code_name"] or row["fixer_code_name"]
+        durations[(row["server_code_name"], workflow)] = row["avg_seconds"]
+
+    return durations
+
+
+def estimate_server(
+    server_code_name: str,
+    generator_code_name: str,
+    fixers: list[str],
+    generator_jobs: int,
+    durations: dict[tuple[str, str], float],
+) -> ServerEstimate:
+    server_durations = [v for k, v in durations.items() if k[0] == server_code_name]
+    # a workflow that never ran on the server is estimated with the average
+    # of everything else that ran on it
+    fallback = None
+    if len(server_durations) > 0:
+        fallback = sum(server_durations) / len(server_durations)
+
+    gen_seconds = durations.get((server_code_name, generator_code_name), fallback)
+    fixer_seconds = {
+        fixer: durations.get((server_code_name, fixer), fallback) for fixer in fixers
+    }
+
+    estimated_seconds = None
+    if fallback is not None:
+        assert gen_seconds is not None
+        estimated_seconds = generator_jobs * gen_seconds
+        for seconds in fixer_seconds.values():
+            assert seconds is not None
+            estimated_seconds += generator_jobs * seconds
+
+    return ServerEstimate(
+        server_code_name=server_code_name,
+        seconds_per_generator_job=gen_seconds,
+        seconds_per_fixer_job=fixer_seconds,
+        estimated_seconds=estimated_seconds,
+    )
+
+
+async def estimate_command(code: str) -> CommandEstimate:
+    """
+    Counts the jobs that the command would create and estimates how long
+    its servers would take to render them, without creating any job.
+    """
+    parser = PromptLanguageParser()
+    cmd = parser.parse(code)
+    valid_res = await validate_code_names(cmd)
+    if not valid_res.is_valid:
+        raise ValueError(str(valid_res.errors))
+
+    resolver = await SelectionResolver.load(cmd.group_selections)
+    region_combinations = count_region_combinations(resolver, cmd.group_selections)
+    generator_jobs = region_combinations * math.prod(
+        len(items) for items in resolver.items_per_group(cmd.group_selections)
+    )
+    fixers = cmd.fixers or []
+    fixer_jobs = generator_jobs * len(fixers)
+
+    server_code_names = cmd.server_pool or [cmd.server_code_name]
+    durations = await historic_render_seconds(server_code_names)
+    servers = [
+        estimate_server(
+            server_cn,
+            cmd.generator_code_name,
+            fixers,
+            generator_jobs,
+            durations,
+        )
+        for server_cn in server_code_names
+    ]
+
+    # the servers of a pool share the jobs, so their speeds add up
+    speeds = [
+        1 / s.estimated_seconds
+        for s in servers
+        if s.estimated_seconds is not None and s.estimated_seconds > 0
+    ]
+    estimated_seconds = None
+    if len(speeds) > 0:
+        estimated_seconds = 1 / sum(speeds)
+    elif any(s.estimated_seconds == 0 for s in servers):
+        estimated_seconds = 0.0
+
+    return CommandEstimate(
+        generator_jobs=generator_jobs,
+        fixer_jobs=fixer_jobs,
+        total_jobs=generator_jobs + fixer_jobs,
+        region_combinations=region_combinations,
+        servers=servers,
+        estimated_seconds=estimated_seconds,
+    )
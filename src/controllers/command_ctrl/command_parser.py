@@ -1,6 +1,7 @@
 """
 Parser for the prompt mini-language
 Supports syntax: server_code -$ workflow_code: group1 x group2 > fixer1 > fixer2
+A pool of servers can be given with: server_1 and server_2 -$ workflow_code: ...
 """
 
 import json
@@ -48,6 +49,7 @@ class ParsedCommand:
     generator_code_name: str
     group_selections: list[GroupSelection]
     fixers: Optional[list[str]] = None
+    server_pool: Optional[list[str]] = None
 
     def to_dict(self):
         result = {
@@ -55,6 +57,8 @@ class ParsedCommand:
             "generator_code_name": self.generator_code_name,
             "group_selections": [gs.to_dict() for gs in self.group_selections],
         }
+        if self.server_pool:
+            result["server_pool"] = self.server_pool
         if self.fixers:
             result["fixers"] = self.fixers
         return result
@@ -69,7 +73,9 @@ class PromptLanguageParser:
 
     def __init__(self):
         # Regex patterns
-        self.server_workflow_pattern = r"(\w+)\s*-\$\s*(\w+)\s*:\s*(.+)"
+        self.server_workflow_pattern = (
+            r"(\w+(?:\s+and\s+\w+)*)\s*-\$\s*(\w+)\s*:\s*(.+)"
+        )
 
     def parse(self, command: str) -> ParsedCommand:
         """
@@ -89,7 +95,10 @@ class PromptLanguageParser:
         if not match:
             raise ValueError(f"Invalid command syntax: {command}")
 
-        server_code = match.group(1)
+        # Servers joined with 'and' form a pool, any of them can run the jobs
+        server_codes = [s.strip() for s in re.split(r"\s+and\s+", match.group(1))]
+        server_code = server_codes[0]
+        server_pool = server_codes if len(server_codes) > 1 else None
         workflow_code = match.group(2)
         rest = match.group(3)
 
@@ -110,6 +119,7 @@ class PromptLanguageParser:
             generator_code_name=workflow_code,
             group_selections=group_selections,
             fixers=fixers,
+            server_pool=server_pool,
         )
 
     def _parse_groups(self, groups_part: str) -> list[GroupSelection]:
@@ -1,7 +1,9 @@
+from collections.abc import Iterable
 from dataclasses import dataclass
 
 from src.controllers.command_ctrl.command_parser import GroupSelection, ParsedCommand
-from src.db.records import GeneratorRecord, GroupRecord, ItemRecord, ServerRecord
+from src.controllers.command_ctrl.selection_resolver import SelectionResolver
+from src.db.records import GeneratorRecord, ServerRecord
 from src.db.records.fixer_rec import FixerRecord
 from src.db.records.item_rec import CoordinatedRegionKeyword, MaskRegionImages
 
@@ -15,10 +17,19 @@ class ValidationResult:
 async def validate_code_names(cmd: ParsedCommand) -> ValidationResult:
     errors = []
 
-    # Validate server
-    server_exists = await ServerRecord.filter(code_name=cmd.server_code_name).exists()
-    if not server_exists:
-        errors.append(f"Server '{cmd.server_code_name}' not found")
+    # Validate servers
+    server_code_names = [cmd.server_code_name]
+    if cmd.server_pool:
+        server_code_names.extend(cmd.server_pool[1:])
+
+    found_servers = set(
+        await ServerRecord.filter(code_name__in=server_code_names).values_list(
+            "code_name", flat=True
+        )
+    )
+    for server_cn in server_code_names:
+        if server_cn not in found_servers:
+            errors.append(f"Server '{server_cn}' not found")
 
     # Validate workflow
     generator_exists = await GeneratorRecord.filter(
@@ -28,22 +39,28 @@ async def validate_code_names(cmd: ParsedCommand) -> ValidationResult:
         errors.append(f"Workflow '{cmd.generator_code_name}' not found")
 
     if cmd.fixers:
+        found_fixers = set(
+            await FixerRecord.filter(code_name__in=cmd.fixers).values_list(
+                "code_name", flat=True
+            )
+        )
         for fixer_cn in cmd.fixers:
-            fixer_exists = await FixerRecord.filter(code_name=fixer_cn).exists()
-            if not fixer_exists:
+            if fixer_cn not in found_fixers:
                 errors.append(f"Fixer '{fixer_cn}' not found")
 
     # Validate groups and items
-    gr_errors = await validate_group_selections(cmd.group_selections)
+    resolver = await SelectionResolver.load(cmd.group_selections)
+    gr_errors = validate_group_selections(resolver, cmd.group_selections)
 
-    cc_errors = await validate_region_group_selections(cmd.group_selections)
+    cc_errors = validate_region_group_selections(resolver, cmd.group_selections)
 
     errors.extend(gr_errors)
     errors.extend(cc_errors)
     return ValidationResult(is_valid=len(errors) == 0, errors=errors)
 
 
-async def validate_region_group_selections(
+def validate_region_group_selections(
+    resolver: SelectionResolver,
     group_selections: list[GroupSelection],
 ) -> list[str]:
     errors = []
@@ -59,12 +76,12 @@ async def validate_region_group_selections(
             )
             continue
 
-        group = await GroupRecord.get_or_none(code_name=gs.group_code_name)
+        group = resolver.group(gs.group_code_name)
         if group is None:
             errors.append(f"Group '{gs.group_code_name}' not found")
             continue
 
-        region_items = await ItemRecord.filter(group_id=group.id).all()
+        region_items = resolver.items_of_group(group.id)
         keywords_from_group = set()
         for mi in region_items:
             ccis_dict = mi.mask_region_images
@@ -99,13 +116,39 @@ async def validate_region_group_selections(
                     f"Missing color coded keywords from group '{gs.group_code_name}': {missing_in_items}'"
                 )
 
+        for region_sels in gs.region_group_selections.values():
+            errors.extend(validate_group_selections(resolver, region_sels))
+
     if region_count > 1:
         errors.append("You can use only one color coded group in the command")
 
     return errors
 
 
-async def validate_group_selections(
+def validate_selected_items(
+    resolver: SelectionResolver,
+    group_code: str,
+    include_only: Iterable[str] | None,
+    exclude: Iterable[str] | None,
+) -> list[str]:
+    # Check group exists
+    group = resolver.group(group_code)
+    if not group:
+        return [f"Group '{group_code}' not found"]
+
+    item_code_names = {item.code_name for item in resolver.items_of_group(group.id)}
+    errors = []
+
+    # Check included and excluded items
+    for item_code in [*(include_only or []), *(exclude or [])]:
+        if item_code not in item_code_names:
+            errors.append(f"Item '{item_code}' not found in group '{group_code}'")
+
+    return errors
+
+
+def validate_group_selections(
+    resolver: SelectionResolver,
     group_selections: list[GroupSelection],
 ) -> list[str]:
     errors = []
@@ -117,65 +160,23 @@ async def validate_group_selections(
         if group_sel.is_merged:
             assert group_sel.merged_groups is not None
             for merged_group in group_sel.merged_groups:
-                group_code = merged_group["group_code_name"]
-
-                # Check group exists
-                group = await GroupRecord.filter(code_name=group_code).first()
-                if not group:
-                    errors.append(f"Group '{group_code}' not found")
-                    continue
-
-                # Check included items
-                if merged_group["include_only"]:
-                    for item_code in merged_group["include_only"]:
-                        item_exists = await ItemRecord.filter(
-                            group_id=group.id, code_name=item_code
-                        ).exists()
-                        if not item_exists:
-                            errors.append(
-                                f"Item '{item_code}' not found in group '{group_code}'"
-                            )
-
-                # Check excluded items
-                if merged_group["exclude"]:
-                    for item_code in merged_group["exclude"]:
-                        item_exists = await ItemRecord.filter(
-                            group_id=group.id, code_name=item_code
-                        ).exists()
-                        if not item_exists:
-                            errors.append(
-                                f"Item '{item_code}' not found in group '{group_code}'"
-                            )
+                errors.extend(
+                    validate_selected_items(
+                        resolver,
+                        merged_group["group_code_name"],
+                        merged_group["include_only"],
+                        merged_group["exclude"],
+                    )
+                )
         else:
             # Handle single group
-            group_code = group_sel.group_code_name
-
-            # Check group exists
-            group = await GroupRecord.filter(code_name=group_code).first()
-            if not group:
-                errors.append(f"Group '{group_code}' not found")
-                continue
-
-            # Check included items
-            if group_sel.include_only:
-                for item_code in group_sel.include_only:
-                    item_exists = await ItemRecord.filter(
-                        group_id=group.id, code_name=item_code
-                    ).exists()
-                    if not item_exists:
-                        errors.append(
-                            f"Item '{item_code}' not found in group '{group_code}'"
-                        )
-
-            # Check excluded items
-            if group_sel.exclude:
-                for item_code in group_sel.exclude:
-                    item_exists = await ItemRecord.filter(
-                        group_id=group.id, code_name=item_code
-                    ).exists()
-                    if not item_exists:
-                        errors.append(
-                            f"Item '{item_code}' not found in group '{group_code}'"
-                        )
+            errors.extend(
+                validate_selected_items(
+                    resolver,
+                    group_sel.group_code_name,
+                    group_sel.include_only,
+                    group_sel.exclude,
+                )
+            )
 
     return errors
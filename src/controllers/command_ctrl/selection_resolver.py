@@ -0,0 +1,129 @@
+from collections.abc import Iterable
+from dataclasses import dataclass
+
+from src.controllers.command_ctrl.command_parser import GroupSelection
+from src.db.records import GroupRecord, ItemRecord
+
+
+def collect_group_code_names(group_selections: list[GroupSelection]) -> set[str]:
+    """Returns the code names of every group referenced by the selections."""
+    code_names = set()
+    for gs in group_selections:
+        if gs.is_merged:
+            assert gs.merged_groups is not None
+            for merged_group in gs.merged_groups:
+                code_names.add(merged_group["group_code_name"])
+        else:
+            code_names.add(gs.group_code_name)
+
+        if gs.is_regioned and gs.region_group_selections is not None:
+            for region_sels in gs.region_group_selections.values():
+                code_names.update(collect_group_code_names(region_sels))
+
+    return code_names
+
+
+@dataclass
+class SelectionResolver:
+    """
+    Holds the groups and items that a command refers to, loaded with one
+    query for the groups and one for their items, and serves the group
+    selections from memory.
+    """
+
+    groups: dict[str, GroupRecord]
+    items_by_group_id: dict[int, list[ItemRecord]]
+
+    @classmethod
+    async def load(cls, group_selections: list[GroupSelection]) -> "SelectionResolver":
+        code_names = collect_group_code_names(group_selections)
+        groups = await GroupRecord.filter(code_name__in=code_names)
+        items = await ItemRecord.filter(
+            group_id__in=[group.id for group in groups]
+        ).order_by("id")
+
+        items_by_group_id: dict[int, list[ItemRecord]] = {
+            group.id: [] for group in groups
+        }
+        for item in items:
+            items_by_group_id[item.group_id].append(item)
+
+        return cls(
+            groups={group.code_name: group for group in groups},
+            items_by_group_id=items_by_group_id,
+        )
+
+    def group(self, code_name: str) -> GroupRecord | None:
+        return self.groups.get(code_name)
+
+    def group_code_names(self) -> dict[int, str]:
+        return {group.id: group.code_name for group in self.groups.values()}
+
+    def items_of_group(self, group_id: int) -> list[ItemRecord]:
+        return self.items_by_group_id.get(group_id, [])
+
+    def select_items(
+        self,
+        group_code_name: str,
+        include_only: Iterable[str] | None,
+        exclude: Iterable[str] | None,
+    ) -> list[ItemRecord]:
+        group = self.group(group_code_name)
+        if group is None:
+            raise ValueError(f"Group '{group_code_name}' not found")
+
+        items = self.items_of_group(group.id)
+        if exclude is not None:
+            excluded = set(exclude)
+            return [item for item in items if item.code_name not in excluded]
+
+        if include_only is not None:
+            included = set(include_only)
+            return [item for item in items if item.code_name in included]
+
+        return list(items)
+
+    def region_selection(
+        self, group_selections: list[GroupSelection]
+    ) -> tuple[GroupSelection, GroupRecord] | None:
+        """Returns the regioned group selection of the command and its group."""
+        for gs in group_selections:
+            if not gs.is_regioned:
+                continue
+
+            group = self.group(gs.group_code_name)
+            if group is None:
+                continue
+
+            return gs, group
+
+        return None
+
+    def items_per_group(
+        self, group_selections: list[GroupSelection]
+    ) -> list[list[ItemRecord]]:
+        items_per_group: list[list[ItemRecord]] = []
+        for group_sel in group_selections:
+            if group_sel.is_merged:
+                merged_items: list[ItemRecord] = []
+                assert group_sel.merged_groups is not None
+                for merged_group in group_sel.merged_groups:
+                    merged_items.extend(
+                        self.select_items(
+                            merged_group["group_code_name"],
+                            merged_group["include_only"],
+                            merged_group["exclude"],
+                        )
+                    )
+
+                items_per_group.append(merged_items)
+            else:
+                items_per_group.append(
+                    self.select_items(
+                        group_sel.group_code_name,
+                        group_sel.include_only,
+                        group_sel.exclude,
+                    )
+                )
+
+        return items_per_group
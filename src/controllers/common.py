@@ -1,11 +1,22 @@
 import os
 import shutil
 
+from src.core.executors import run_io
 from src.db.records import ItemRecord
 from src.db.records.item_rec import IPAdapter, MaskRegionImages
 
 
+def remove_files(paths: list[str]):
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+
 async def delete_item_files(item: ItemRecord):
+    await run_io(remove_item_files, item)
+
+
+def remove_item_files(item: ItemRecord):
     if item.ipadapter is not None:
         ipadapter = IPAdapter(**item.ipadapter)
         if os.path.exists(ipadapter.image_file):
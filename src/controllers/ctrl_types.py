@@ -1,11 +1,14 @@
+import asyncio
 import enum
 import os
-from dataclasses import dataclass
+from collections import deque
+from dataclasses import dataclass, field
 from typing import Any
 
 from nicegui.elements.upload_files import FileUpload
 from yet_another_comfy_client import YetAnotherComfyClient
 
+from src.controllers.comfy_events import ComfyEventListener
 from src.db.records import FixerRecord, GroupRecord
 from src.db.records.item_rec import MaskRegionImages
 from src.db.records.job_rec import JobRecord, JobStatus, RegionPrompt
@@ -151,6 +154,11 @@ class ServerData:
     host: str
     code_name: str
     client: YetAnotherComfyClient
+    listener: ComfyEventListener | None = None
+    job_ids: deque[int] = field(default_factory=deque)
+    worker: asyncio.Task | None = None
+    in_flight_tasks: dict[int, asyncio.Task] = field(default_factory=dict)
+    last_finished_at: float = 0.0
 
 
 @dataclass
@@ -1,5 +1,6 @@
 from src.controllers.ctrl_types import FixerInput, FixerOutput
 from src.controllers.serializers import serialize_fixer
+from src.controllers.workflow_templates import invalidate_fixer_template
 from src.db.records import FixerRecord
 
 
@@ -37,7 +38,9 @@ async def edit_fixer(id: int, input: FixerInput):
     fixer.load_image_title = input.load_image_title
     fixer.save_image_title = input.save_image_title
     fixer.workflow_json = input.workflow_json
+    fixer.version += 1
     await fixer.save()
+    invalidate_fixer_template(fixer.id)
 
 
 async def delete_fixer(id: int):
@@ -46,3 +49,4 @@ async def delete_fixer(id: int):
         raise ValueError("fixer doesn't exist")
 
     await fixer.delete()
+    invalidate_fixer_template(id)
@@ -1,4 +1,5 @@
 from src.controllers.ctrl_types import GeneratorInput, GeneratorOutput
+from src.controllers.workflow_templates import invalidate_generator_template
 from src.db.records import GeneratorRecord
 
 
@@ -32,8 +33,10 @@ async def edit_generator(id: int, input: GeneratorInput):
 
     gen.save_image_title = input.save_image_title
     gen.workflow_json = input.workflow_json
+    gen.version += 1
 
     await gen.save()
+    invalidate_generator_template(gen.id)
 
 
 async def list_generators() -> list[GeneratorOutput]:
@@ -60,3 +63,4 @@ async def delete_generator(id: int):
         raise ValueError("workflow doesn't exist")
 
     await gen.delete()
+    invalidate_generator_template(id)
@@ -8,6 +8,7 @@ from src.controllers.common import delete_item_files
 from src.controllers.ctrl_types import ItemInput, ItemOutput
 from src.controllers.serializers import serialize_item
 from src.core.config import Config
+from src.core.executors import run_segmentation
 from src.core.utils.auto_masking import auto_create_masks
 from src.db.records import ItemRecord
 from src.db.records.item_rec import IPAdapter, MaskRegionImages
@@ -62,7 +63,9 @@ async def add_item(conf: Config, input: ItemInput):
         cc_ref_path = os.path.join(conf.colored_region_path, image_filename)
         await input.mask_region_reference_image.save(cc_ref_path)
         mask_folder_path = os.path.join(conf.colored_region_path, photos_id)
-        output = auto_create_masks(cc_ref_path, mask_folder_path)
+        output = await run_segmentation(
+            auto_create_masks, cc_ref_path, mask_folder_path
+        )
         mask_files = {}
         for key, outpath in output.items():
             mask_files[key] = outpath
@@ -170,7 +173,9 @@ async def edit_item(conf: Config, id: int, ui_input: ItemInput):
         cc_ref_path = os.path.join(conf.colored_region_path, image_filename)
         await ui_input.mask_region_reference_image.save(cc_ref_path)
         mask_folder_path = os.path.join(conf.colored_region_path, photos_id)
-        output = auto_create_masks(cc_ref_path, mask_folder_path)
+        output = await run_segmentation(
+            auto_create_masks, cc_ref_path, mask_folder_path
+        )
         mask_files = {}
         for key, outpath in output.items():
             mask_files[key] = outpath
@@ -1,8 +1,11 @@
+from tortoise.transactions import in_transaction
+
+from src.controllers.blob_store import hydrate_jobs, store_blobs
 from src.controllers.ctrl_types import JobOutput
 from src.controllers.manager_ctrl import Manager
+from src.controllers.prompt_assembly import assemble_prompt, item_contribution
 from src.controllers.serializers import serialize_job
 from src.db.records import ItemRecord, JobRecord
-from src.db.records.item_rec import IPAdapter
 from src.db.records.job_rec import JobStatus
 
 
@@ -20,45 +23,39 @@ async def reload_job(manager: Manager, job_id: int):
     if job is None:
         raise ValueError("job doesn't exist")
 
-    prompt_positive = ""
-    prompt_negative = ""
-    reference_controlnet_img = None
-    ipadapters: list[IPAdapter] = []
-    lora_list = []
-
-    for v in job.group_item_id_list:
-        item = await ItemRecord.get_or_none(id=v["item_id"])
-        if item is None:
-            continue
-
-        if len(item.positive_prompt) > 0:
-            prompt_positive += item.positive_prompt + " "
-        if len(item.negative_prompt) > 0:
-            prompt_negative += item.negative_prompt + " "
-        if item.controlnet_reference_image is not None:
-            reference_controlnet_img = item.controlnet_reference_image
-
-        if item.ipadapter is not None:
-            ipadapters.append(item.ipadapter)
-
-        if item.lora is not None:
-            lora_list.append(item.lora)
-
-    job.prompt_positive = prompt_positive
-    job.prompt_negative = prompt_negative
+    await hydrate_jobs([job])
+    if job.group_item_id_list is None:
+        raise ValueError("job's items are missing")
+
+    item_ids = [v["item_id"] for v in job.group_item_id_list]
+    items = await ItemRecord.filter(id__in=item_ids)
+    items_by_id = {item.id: item for item in items}
+    assembled = assemble_prompt(
+        item_contribution(items_by_id[item_id])
+        for item_id in item_ids
+        if item_id in items_by_id
+    )
+
+    job.prompt_positive = assembled.prompt_positive
+    job.prompt_negative = assembled.prompt_negative
     job.status = JobStatus.WAITING
-    if reference_controlnet_img is not None:
-        job.reference_controlnet_img = reference_controlnet_img
-
-    job.ipadapter_list = ipadapters
-    job.lora_list = lora_list
-    await job.save()
+    # the old prompt must not be recovered from the server's history
+    job.comfyui_prompt_id = None
+    job.compiled_prompt = None
+    if assembled.reference_controlnet_img is not None:
+        job.reference_controlnet_img = assembled.reference_controlnet_img
+
+    async with in_transaction() as conn:
+        job.ipadapter_list_ref, job.lora_list_ref = await store_blobs(
+            [assembled.ipadapter_list, assembled.lora_list], conn
+        )
+        await job.save(using_db=conn)
 
     await manager.add_job(job.id)
 
 
 async def list_jobs(command_id: int) -> list[JobOutput]:
-    jobs = await JobRecord.filter(command_id=command_id).all()
+    jobs = await hydrate_jobs(await JobRecord.filter(command_id=command_id).all())
     ls = []
     for job in jobs:
         ls.append(serialize_job(job))
@@ -1,66 +1,73 @@
 import asyncio
-import io
-import os
-
-from PIL import Image
-from yet_another_comfy_client import (
-    EventType,
-    StatusData,
-    YetAnotherComfyClient,
-    edit_prompt,
-)
-
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Any
+
+from tortoise import timezone
+from tortoise.expressions import Q
+from tortoise.queryset import QuerySet
+from yet_another_comfy_client import YetAnotherComfyClient
+
+from src.controllers.blob_store import hydrate_jobs
+from src.controllers.comfy_events import ComfyEventListener
 from src.controllers.ctrl_types import ServerData
 from src.controllers.server_ctrl import StatusEnum
+from src.controllers.prompt_builder import (
+    decompress_prompt,
+    fixer_prompt,
+    generator_prompt,
+)
 from src.core.config import Config
-from src.core.utils import LoRAInjector
-from src.core.utils.ipadapter_injector import add_multiple_ipadapters_to_workflow
-from src.core.utils.mask_injector import inject_masks
+from src.core.utils.image_io import save_image_bytes
 from src.db.records import (
     FixerRecord,
     GeneratorRecord,
     JobRecord,
     ServerRecord,
 )
-from src.db.records.job_rec import CoordinatedRegion, JobStatus, RegionPrompt
-
-
-async def listen_for_events_from_comfyui(sd: ServerData):
-    async for event in sd.client.get_events():
-        print(
-            "Event from Comfyui ",
-            sd.code_name,
-            ": ",
-            event.type,
-            "data",
-            event.data,
-        )
-        if event.type == EventType.EXECUTION_SUCCESS:
-            break
+from src.db.records.job_rec import JobStatus
 
-        elif event.type == EventType.STATUS:
-            assert isinstance(event.data, StatusData)
-            if event.data.status.exec_info.queue_remaining == 0:
-                break
 
-    print("Event from Comfyui ", sd.code_name, " closed")
+# how long a server owns a job it claimed without renewing the lease
+JOB_LEASE_SECONDS = 60
+# how many queued jobs the dispatcher reads from the database at once
+DISPATCH_BATCH_SIZE = 500
+# how many jobs can wait in memory for each server and each pool
+MAX_DISPATCHED_JOBS = 1000
+# the columns the dispatcher needs to route a queued job
+DISPATCH_FIELDS = ("id", "server_code_name", "server_pool", "fix_job_id")
+# how often the dispatcher looks for queued jobs without being notified
+DISPATCH_POLL_SECONDS = 5
 
 
 class Manager:
     _servers: dict[str, ServerData]
-    _jobid_queue: asyncio.Queue[int]
-    _cmdid_queue: asyncio.Queue[int]
+    _pooled_job_ids: dict[tuple[str, ...], deque[int]]
+    _pending_job_ids: set[int]
+    _parked_job_ids: dict[int, set[int]]
 
     def __init__(self, conf: Config):
         self._conf = conf
         self._servers = {}
-        self._jobid_queue = asyncio.Queue()
-        self._cmdid_queue = asyncio.Queue()
+        # jobs that can run on any server of a pool, keyed by the sorted pool
+        self._pooled_job_ids = {}
+        # jobs that were dispatched to a server and have not finished yet
+        self._pending_job_ids = set()
+        # fixer jobs waiting for the job they fix, keyed by that job's id
+        self._parked_job_ids = {}
+        self._work_available = asyncio.Event()
+        # the queue lives in the database as the QUEUED jobs, the dispatcher
+        # reads them in id order after the cursor of their server or pool
+        self._dispatch_cursors: dict[str | tuple[str, ...], int] = {}
+        self._queued_pools: list[list[str]] = []
+        self._rescan_from: int | None = 1
+        self._queue_changed = asyncio.Event()
 
     async def start_background_tasks(self):
         asyncio.create_task(self.update_servers_thread())
-        asyncio.create_task(self.execute_jobs())
-        asyncio.create_task(self.execute_commands())
+        asyncio.create_task(self.dispatch_jobs())
+        asyncio.create_task(self.renew_leases())
 
     async def update_servers_thread(self):
         while True:
@@ -83,194 +90,485 @@ class Manager:
                             client=client,
                         )
                         print("comfyui with code name", sd.code_name, "is online")
-                        self._servers[server.code_name] = sd
+                        self.add_server(sd)
                     else:
                         await client.close()
 
-                        # def event_worker():
-                        #     asyncio.run(listen_for_events_from_comfyui(sd))
-
-                        # thread = Thread(target=event_worker, daemon=True)
-                        # thread.start()
-
                 elif status == StatusEnum.OFFLINE:
                     await client.close()
                     if server.code_name in self._servers.keys():
                         print("removing server", server.code_name)
-                        await self._servers[server.code_name].client.close()
-                        del self._servers[server.code_name]
+                        await self.remove_server(server.code_name)
 
             await asyncio.sleep(1)
 
+    def add_server(self, sd: ServerData):
+        sd.listener = ComfyEventListener(sd.code_name, sd.client)
+        sd.listener.start()
+        sd.worker = asyncio.create_task(self.server_worker(sd))
+        self._servers[sd.code_name] = sd
+        # queued jobs that were skipped while the server was offline
+        self.rescan_queue()
+
+    async def remove_server(self, code_name: str):
+        sd = self._servers.pop(code_name)
+        tasks = list(sd.in_flight_tasks.values())
+        in_flight_job_ids = list(sd.in_flight_tasks.keys())
+        if sd.worker is not None:
+            tasks.append(sd.worker)
+
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        if sd.listener is not None:
+            await sd.listener.close()
+
+        # the jobs that were not claimed are still queued in the database,
+        # they only have to leave the memory of the dispatcher
+        for job_id in sd.job_ids:
+            self._pending_job_ids.discard(job_id)
+        sd.job_ids.clear()
+
+        for pool, job_ids in self._pooled_job_ids.items():
+            if any(cn in self._servers.keys() for cn in pool):
+                continue
+
+            for job_id in job_ids:
+                self._pending_job_ids.discard(job_id)
+            job_ids.clear()
+
+        # the prompts of the server are lost with it
+        await requeue_jobs(in_flight_job_ids)
+        self.rescan_queue()
+
+        await sd.client.close()
+
     async def add_job(self, job_id: int):
-        await self._jobid_queue.put(job_id)
+        await JobRecord.filter(id=job_id, status=JobStatus.WAITING).update(
+            status=JobStatus.QUEUED
+        )
+        self.rescan_queue(job_id)
 
     async def add_command(self, cmd_id: int):
-        await self._cmdid_queue.put(cmd_id)
+        await JobRecord.filter(command_id=cmd_id, status=JobStatus.WAITING).update(
+            status=JobStatus.QUEUED
+        )
+        self.rescan_queue()
+
+    def rescan_queue(self, from_job_id: int = 1):
+        """Makes the dispatcher read again the queued jobs from from_job_id."""
+        if self._rescan_from is None or from_job_id < self._rescan_from:
+            self._rescan_from = from_job_id
+        self._queue_changed.set()
 
-    async def execute_commands(self):
-        print("ready for commands")
+    async def dispatch_jobs(self):
+        requeued = await requeue_orphaned_jobs()
+        print("requeued", requeued, "jobs left in processing")
+        print("ready for jobs from queue")
         while True:
-            cmd_id = await self._cmdid_queue.get()
-            print("received command", cmd_id)
-            jobs = await JobRecord.filter(command_id=cmd_id).values("id")
-            for v in jobs:
-                job = await JobRecord.get_or_none(id=v["id"])
-                if job is None:
+            if self._rescan_from is not None:
+                for dest, cursor in self._dispatch_cursors.items():
+                    self._dispatch_cursors[dest] = min(cursor, self._rescan_from - 1)
+                self._rescan_from = None
+                self._queued_pools = await queued_pools()
+            self._queue_changed.clear()
+
+            # every server and pool reads its own jobs, so a long queue for
+            # one of them does not hold back the jobs of the others
+            read = 0
+            for sd in list(self._servers.values()):
+                read += await self.read_queue(
+                    sd.code_name,
+                    JobRecord.filter(
+                        status=JobStatus.QUEUED,
+                        server_code_name=sd.code_name,
+                        server_pool__isnull=True,
+                    ),
+                    len(sd.job_ids),
+                )
+
+            for pool in self._queued_pools:
+                if not any(cn in self._servers.keys() for cn in pool):
                     continue
 
-                if job.server_code_name in self._servers.keys():
-                    client = self._servers[job.server_code_name].client
-                    if job.generator_code_name is not None:
-                        await generate_image(client, job)
-                    elif job.fixer_code_name is not None:
-                        await fix_image(client, job)
+                job_ids = self._pooled_job_ids.get(tuple(sorted(pool)), ())
+                read += await self.read_queue(
+                    tuple(pool),
+                    JobRecord.filter(status=JobStatus.QUEUED, server_pool=pool),
+                    len(job_ids),
+                )
 
-    async def execute_jobs(self):
-        print("ready for jobs from queue")
+            if read == 0:
+                try:
+                    await asyncio.wait_for(
+                        self._queue_changed.wait(), DISPATCH_POLL_SECONDS
+                    )
+                except TimeoutError:
+                    pass
+
+    async def read_queue(
+        self, dest: str | tuple[str, ...], query: QuerySet[JobRecord], waiting: int
+    ) -> int:
+        """
+        Dispatches the next queued jobs of a server or pool after its cursor,
+        as many as fit next to the jobs that are waiting for it.
+        """
+        limit = min(DISPATCH_BATCH_SIZE, MAX_DISPATCHED_JOBS - waiting)
+        if limit <= 0:
+            return 0
+
+        # ordered by id so fixer jobs come after the jobs they fix
+        jobs = (
+            await query.filter(id__gt=self._dispatch_cursors.get(dest, 0))
+            .only(*DISPATCH_FIELDS)
+            .order_by("id")
+            .limit(limit)
+        )
+        for job in jobs:
+            self._dispatch_cursors[dest] = job.id
+            self.dispatch_job(job)
+
+        return len(jobs)
+
+    def dispatch_job(self, job: JobRecord):
+        if job.id in self._pending_job_ids:
+            return
+
+        if job.fix_job_id is not None and job.fix_job_id in self._pending_job_ids:
+            self._parked_job_ids.setdefault(job.fix_job_id, set()).add(job.id)
+            return
+
+        print("Received job", job.id)
+        if job.server_pool is not None and len(job.server_pool) > 0:
+            pool = tuple(sorted(job.server_pool))
+            if not any(cn in self._servers.keys() for cn in pool):
+                print("No server is online from pool", pool, "for job", job.id)
+                return
+
+            self._pooled_job_ids.setdefault(pool, deque()).append(job.id)
+        else:
+            if job.server_code_name not in self._servers.keys():
+                print("Server", job.server_code_name, "is not online for job", job.id)
+                return
+
+            self._servers[job.server_code_name].job_ids.append(job.id)
+
+        self._pending_job_ids.add(job.id)
+        self._work_available.set()
+
+    async def renew_leases(self):
+        while True:
+            await asyncio.sleep(JOB_LEASE_SECONDS / 3)
+            job_ids = [
+                job_id
+                for sd in self._servers.values()
+                for job_id in sd.in_flight_tasks.keys()
+            ]
+            try:
+                if len(job_ids) > 0:
+                    await JobRecord.filter(
+                        id__in=job_ids, status=JobStatus.PROCESSING
+                    ).update(lease_expires_at=lease_deadline())
+
+                if await requeue_orphaned_jobs() > 0:
+                    self.rescan_queue()
+            except Exception as e:
+                print("Failed to renew the leases of the jobs:", e)
+
+    async def next_job_id(self, sd: ServerData) -> int:
+        while True:
+            if len(sd.job_ids) > 0:
+                return sd.job_ids.popleft()
+
+            for pool, job_ids in self._pooled_job_ids.items():
+                if sd.code_name in pool and len(job_ids) > 0:
+                    return job_ids.popleft()
+
+            self._work_available.clear()
+            await self._work_available.wait()
+
+    async def server_worker(self, sd: ServerData):
+        print("worker started for", sd.code_name)
+        try:
+            recovered = await reconcile_jobs(
+                sd, self._conf.recompress_result_images
+            )
+            print("recovered", recovered, "jobs from the history of", sd.code_name)
+        except Exception as e:
+            print("Failed to recover jobs from", sd.code_name, ":", e)
+        # the queued jobs were hidden from the dispatcher while their history
+        # was read, so it could have read past them or failed to claim them
+        self.rescan_queue()
+
+        # keeps the next prompts queued on ComfyUI while the current one renders
+        slots = asyncio.Semaphore(self._conf.prompts_in_flight_per_server)
         while True:
-            job_id = await self._jobid_queue.get()
-            print("Received job", job_id)
-            job = await JobRecord.get_or_none(id=job_id)
+            await slots.acquire()
+            job_id = await self.next_job_id(sd)
+            job = None
+            try:
+                job = await claim_job(sd, job_id)
+                # a job queued before a crash may be rendered already
+                if (
+                    job is not None
+                    and job.comfyui_prompt_id is not None
+                    and await recover_job_images(
+                        sd.client, job, self._conf.recompress_result_images
+                    )
+                ):
+                    print("Recovered job", job.id, "from", sd.code_name)
+                    job = None
+                elif job is not None and not await self.queue_job(sd, job):
+                    await release_job(job.id)
+                    job = None
+            except asyncio.CancelledError:
+                self.job_done(job_id)
+                raise
+            except Exception as e:
+                print("Job", job_id, "failed on", sd.code_name, ":", e)
+                await release_job(job_id)
+                job = None
+
             if job is None:
+                slots.release()
+                self.job_done(job_id)
                 continue
 
-            if job.server_code_name in self._servers.keys():
-                client = self._servers[job.server_code_name].client
-                if job.generator_code_name is not None:
-                    await generate_image(client, job)
-                elif job.fixer_code_name is not None:
-                    await fix_image(client, job)
+            task = asyncio.create_task(
+                self.finish_job(sd, job, slots, time.monotonic())
+            )
+            sd.in_flight_tasks[job.id] = task
+            task.add_done_callback(
+                lambda _, job_id=job.id: sd.in_flight_tasks.pop(job_id, None)
+            )
+
+    async def queue_job(self, sd: ServerData, job: JobRecord) -> bool:
+        prompt = None
+        if job.generator_code_name is not None:
+            prompt = await build_generator_prompt(job)
+        elif job.fixer_code_name is not None:
+            prompt = await build_fixer_prompt(job)
+
+        if prompt is None:
+            return False
+
+        await queue_prompt(sd.client, job, prompt)
+        return True
+
+    async def finish_job(
+        self,
+        sd: ServerData,
+        job: JobRecord,
+        slots: asyncio.Semaphore,
+        queued_at: float,
+    ):
+        try:
+            assert job.comfyui_prompt_id is not None
+            assert sd.listener is not None
+            await sd.listener.wait_for(job.comfyui_prompt_id)
+
+            # ComfyUI renders one prompt at a time, so a prompt that waited
+            # behind another one started rendering when that one finished
+            finished_at = time.monotonic()
+            job.render_seconds = finished_at - max(queued_at, sd.last_finished_at)
+            sd.last_finished_at = finished_at
+            await save_job_images(
+                sd.client, job, self._conf.recompress_result_images
+            )
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print("Job", job.id, "failed on", sd.code_name, ":", e)
+            await release_job(job.id)
+        finally:
+            slots.release()
+            self.job_done(job.id)
+
+    def job_done(self, job_id: int):
+        self._pending_job_ids.discard(job_id)
+        self._queue_changed.set()
+        parked_ids = self._parked_job_ids.pop(job_id, set())
+        if len(parked_ids) > 0:
+            self.rescan_queue(min(parked_ids))
+
+
+async def queued_pools() -> list[list[str]]:
+    return (
+        await JobRecord.filter(status=JobStatus.QUEUED, server_pool__isnull=False)
+        .distinct()
+        .values_list("server_pool", flat=True)
+    )
 
 
-async def fix_image(client: YetAnotherComfyClient, job: JobRecord):
-    fixer = await FixerRecord.get_or_none(code_name=job.fixer_code_name)
-    if fixer is None:
-        return
+def lease_deadline() -> datetime:
+    return timezone.now() + timedelta(seconds=JOB_LEASE_SECONDS)
 
-    original_job = await JobRecord.get_or_none(id=job.fix_job_id)
-    if original_job is None:
-        return
 
-    img_path = os.path.abspath(original_job.result_img)
-    prompt = edit_prompt(
-        fixer.workflow_json,
-        fixer.load_image_title,
-        "image",
-        img_path,
+async def claim_job(sd: ServerData, job_id: int) -> JobRecord | None:
+    """
+    Takes a queued job for the server. Only one claim of a job can succeed,
+    so a job is never rendered twice.
+    """
+    claimed = await JobRecord.filter(id=job_id, status=JobStatus.QUEUED).update(
+        status=JobStatus.PROCESSING,
+        server_code_name=sd.code_name,
+        server_host=sd.host,
+        lease_expires_at=lease_deadline(),
     )
-    res = await client.queue_prompt(prompt)
-    job.comfyui_prompt_id = res["prompt_id"]
-    job.status = JobStatus.PROCESSING
-    await job.save()
-    print("Processing job", job)
-    async for event in client.get_events():
-        if event.type == EventType.EXECUTION_SUCCESS:
-            break
-
-        elif event.type == EventType.STATUS:
-            assert isinstance(event.data, StatusData)
-            if event.data.status.exec_info.queue_remaining == 0:
-                break
-    output = await client.get_images_by_prompt_id(job.comfyui_prompt_id)
-    if output is not None:
-        for node_id, node_images in output.output_images.items():
-            for oid, image_data in enumerate(node_images):
-                image = Image.open(io.BytesIO(image_data))
-                image.save(job.result_img)
+    if claimed == 0:
+        return None
 
-    job.status = JobStatus.FINISHED
-    await job.save()
-    print("Finished job", job.id)
+    return await JobRecord.get_or_none(id=job_id)
 
 
-async def generate_image(client: YetAnotherComfyClient, job: JobRecord):
-    gen = await GeneratorRecord.get_or_none(code_name=job.generator_code_name)
-    if gen is None:
+async def release_job(job_id: int):
+    # a failed job waits until somebody runs it again
+    await JobRecord.filter(id=job_id, status=JobStatus.PROCESSING).update(
+        status=JobStatus.WAITING, lease_expires_at=None
+    )
+
+
+async def requeue_jobs(job_ids: list[int]):
+    if len(job_ids) == 0:
         return
 
-    prompt = edit_prompt(
-        gen.workflow_json,
-        gen.positive_prompt_title,
-        "text",
-        job.prompt_positive,
+    await JobRecord.filter(id__in=job_ids, status=JobStatus.PROCESSING).update(
+        status=JobStatus.QUEUED, lease_expires_at=None
     )
-    prompt = edit_prompt(
-        gen.workflow_json,
-        gen.negative_prompt_title,
-        "text",
-        job.prompt_negative,
+
+
+def lease_expired() -> Q:
+    return Q(lease_expires_at__isnull=True) | Q(lease_expires_at__lt=timezone.now())
+
+
+async def requeue_orphaned_jobs() -> int:
+    """Queues again the processing jobs whose server stopped renewing them."""
+    return (
+        await JobRecord.filter(status=JobStatus.PROCESSING)
+        .filter(lease_expired())
+        .update(status=JobStatus.QUEUED, lease_expires_at=None)
     )
 
-    if (
-        job.reference_controlnet_img is not None
-        and gen.load_image_controlnet_title is not None
-        and len(gen.load_image_controlnet_title) > 0
-    ):
-        prompt = edit_prompt(
-            prompt,
-            gen.load_image_controlnet_title,
-            "image",
-            job.reference_controlnet_img,
+
+async def reconcile_jobs(sd: ServerData, recompress: bool = False) -> int:
+    """
+    Saves the images of the unfinished jobs that the server rendered while
+    nobody was waiting for them, e.g. before a crash, so they are not
+    rendered again. Returns how many jobs were recovered.
+    """
+    jobs = (
+        await JobRecord.filter(
+            server_code_name=sd.code_name,
+            comfyui_prompt_id__isnull=False,
+            status__not=JobStatus.FINISHED,
         )
+        .filter(Q(status__not=JobStatus.PROCESSING) | lease_expired())
+        .order_by("id")
+    )
 
-    if job.ipadapter_list is not None and len(job.ipadapter_list) > 0:
-        ipas_input = []
-        clip_vision_model = ""
-        for ipadapter in job.ipadapter_list:
-            clip_vision_model = ipadapter["clip_vision_model"]
-            ipas_input.append(
-                {
-                    "model": ipadapter["model_name"],
-                    "path": ipadapter["image_file"],
-                    "weight": ipadapter["weight"],
-                    "weight_type": ipadapter["weight_type"],
-                    "start_at": ipadapter["start_at"],
-                    "end_at": ipadapter["end_at"],
-                }
-            )
-        prompt = add_multiple_ipadapters_to_workflow(
-            prompt, ipas_input, clip_vision_model=clip_vision_model
+    recovered = 0
+    for job in jobs:
+        # claimed while its history is read, so no other server renders it
+        claimable = JobRecord.filter(id=job.id, status=job.status)
+        if job.status == JobStatus.PROCESSING:
+            claimable = claimable.filter(lease_expired())
+        claimed = await claimable.update(
+            status=JobStatus.PROCESSING, lease_expires_at=lease_deadline()
         )
+        if claimed == 0:
+            continue
+
+        try:
+            if await recover_job_images(sd.client, job, recompress):
+                recovered += 1
+                continue
+        except Exception as e:
+            print("Failed to recover job", job.id, "from", sd.code_name, ":", e)
 
-    if job.lora_list is not None and len(job.lora_list) > 0:
-        inj = LoRAInjector(prompt)
-        inj.add_multiple_loras(job.lora_list)
-        prompt = inj.get_workflow()
-
-    if job.region_prompts is not None:
-        ccps = []
-        for v in job.region_prompts.values():
-            ccp = RegionPrompt(**v)
-            if v["coordinates"] is not None:
-                ccp.coordinates = CoordinatedRegion(**v["coordinates"])
-            ccps.append(ccp)
-
-        prompt = inject_masks(
-            prompt,
-            ccps,
+        await JobRecord.filter(id=job.id, status=JobStatus.PROCESSING).update(
+            status=job.status, lease_expires_at=job.lease_expires_at
         )
 
+    return recovered
+
+
+async def build_fixer_prompt(job: JobRecord) -> dict[str, Any] | None:
+    fixer = await FixerRecord.get_or_none(code_name=job.fixer_code_name)
+    if fixer is None:
+        return None
+
+    if job.compiled_prompt is not None and job.compiled_version == fixer.version:
+        return decompress_prompt(job.compiled_prompt)
+
+    original_job = await JobRecord.get_or_none(id=job.fix_job_id)
+    if original_job is None:
+        return None
+
+    return fixer_prompt(fixer, original_job.result_img)
+
+
+async def build_generator_prompt(job: JobRecord) -> dict[str, Any] | None:
+    gen = await GeneratorRecord.get_or_none(code_name=job.generator_code_name)
+    if gen is None:
+        return None
+
+    if job.compiled_prompt is not None and job.compiled_version == gen.version:
+        return decompress_prompt(job.compiled_prompt)
+
+    await hydrate_jobs([job])
+    return generator_prompt(gen, job)
+
+
+async def queue_prompt(
+    client: YetAnotherComfyClient, job: JobRecord, prompt: dict[str, Any]
+):
     res = await client.queue_prompt(prompt)
     job.comfyui_prompt_id = res["prompt_id"]
     job.status = JobStatus.PROCESSING
     await job.save()
     print("Processing job", job, "with prompt", prompt)
-    async for event in client.get_events():
-        if event.type == EventType.EXECUTION_SUCCESS:
-            break
-
-        elif event.type == EventType.STATUS:
-            assert isinstance(event.data, StatusData)
-            if event.data.status.exec_info.queue_remaining == 0:
-                break
+
+
+async def save_job_images(
+    client: YetAnotherComfyClient, job: JobRecord, recompress: bool = False
+):
+    assert job.comfyui_prompt_id is not None
+    output = await client.get_images_by_prompt_id(job.comfyui_prompt_id)
+    await store_job_output(job, output, recompress)
+
+
+async def recover_job_images(
+    client: YetAnotherComfyClient, job: JobRecord, recompress: bool = False
+) -> bool:
+    """Finishes the job from the server's history if its prompt was rendered."""
+    assert job.comfyui_prompt_id is not None
     output = await client.get_images_by_prompt_id(job.comfyui_prompt_id)
+    if output is None or not any(
+        len(node_images) > 0 for node_images in output.output_images.values()
+    ):
+        return False
+
+    await store_job_output(job, output, recompress)
+    return True
+
+
+async def store_job_output(job: JobRecord, output, recompress: bool = False):
+    # every image was written to the same file, so only the last one stays
+    last_image = None
     if output is not None:
-        for node_id, node_images in output.output_images.items():
-            for oid, image_data in enumerate(node_images):
-                image = Image.open(io.BytesIO(image_data))
-                image.save(job.result_img)
+        for node_images in output.output_images.values():
+            if len(node_images) > 0:
+                last_image = node_images[-1]
+
+    if last_image is None:
+        # the prompt failed or is not rendered yet, the job is not finished
+        print("Job", job.id, "has no images in prompt", job.comfyui_prompt_id)
+        await release_job(job.id)
+        return
 
+    await save_image_bytes(job.result_img, last_image, recompress)
     job.status = JobStatus.FINISHED
+    job.lease_expires_at = None
     await job.save()
     print("Finished job", job.id)
@@ -1,6 +1,7 @@
-import os
-
+from src.controllers.blob_store import delete_unused_blobs
+from src.controllers.common import remove_files
 from src.controllers.ctrl_types import ProjectInput, ProjectOutput
+from src.core.executors import run_io
 from src.db.records import JobRecord, ProjectRecord
 from src.db.records.command_rec import CommandRecord
 
@@ -25,13 +26,12 @@ async def delete_project(id: int):
     if project is None:
         raise ValueError("Project does not exist")
 
-    jobs = await JobRecord.filter(project_id=id).all()
-    for job in jobs:
-        if job.result_img is not None:
-            if os.path.exists(job.result_img):
-                os.remove(job.result_img)
-
-        await job.delete()
+    result_imgs = await JobRecord.filter(
+        project_id=id, result_img__isnull=False
+    ).values_list("result_img", flat=True)
+    await run_io(remove_files, result_imgs)
+    await JobRecord.filter(project_id=id).delete()
+    await delete_unused_blobs()
 
     cmds = await CommandRecord.filter(project_id=id).all()
     for cmd in cmds:
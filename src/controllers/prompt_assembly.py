@@ -0,0 +1,83 @@
+import os
+from collections.abc import Iterable
+from dataclasses import dataclass
+from typing import Any
+
+from src.db.records import ItemRecord
+
+
+@dataclass(frozen=True)
+class ItemContribution:
+    """What an item adds to the prompt of a job, computed once per item."""
+
+    group_id: int
+    item_id: int
+    positive: str
+    negative: str
+    controlnet_img: str | None
+    ipadapter: dict[str, Any] | None
+    lora: dict[str, Any] | None
+    filename_part: str
+
+
+@dataclass
+class AssembledPrompt:
+    prompt_positive: str
+    prompt_negative: str
+    reference_controlnet_img: str | None
+    ipadapter_list: list[dict[str, Any]]
+    lora_list: list[dict[str, Any]]
+    group_item_id_list: list[dict[str, int]]
+    filename: str
+
+
+def item_contribution(
+    item: ItemRecord, group_code_name: str | None = None
+) -> ItemContribution:
+    positive = ""
+    if len(item.positive_prompt) > 0:
+        positive = item.positive_prompt + " "
+
+    negative = ""
+    if len(item.negative_prompt) > 0:
+        negative = item.negative_prompt + " "
+
+    controlnet_img = None
+    if item.controlnet_reference_image is not None:
+        controlnet_img = os.path.abspath(item.controlnet_reference_image)
+
+    filename_part = ""
+    if group_code_name is not None:
+        filename_part += "_" + group_code_name
+    filename_part += "_" + item.code_name
+
+    return ItemContribution(
+        group_id=item.group_id,
+        item_id=item.id,
+        positive=positive,
+        negative=negative,
+        controlnet_img=controlnet_img,
+        ipadapter=item.ipadapter,
+        lora=item.lora,
+        filename_part=filename_part,
+    )
+
+
+def assemble_prompt(contributions: Iterable[ItemContribution]) -> AssembledPrompt:
+    contributions = tuple(contributions)
+    reference_controlnet_img = None
+    for c in contributions:
+        if c.controlnet_img is not None:
+            reference_controlnet_img = c.controlnet_img
+
+    return AssembledPrompt(
+        prompt_positive="".join(c.positive for c in contributions),
+        prompt_negative="".join(c.negative for c in contributions),
+        reference_controlnet_img=reference_controlnet_img,
+        ipadapter_list=[c.ipadapter for c in contributions if c.ipadapter is not None],
+        lora_list=[c.lora for c in contributions if c.lora is not None],
+        group_item_id_list=[
+            {"group_id": c.group_id, "item_id": c.item_id} for c in contributions
+        ],
+        filename="".join(c.filename_part for c in contributions),
+    )
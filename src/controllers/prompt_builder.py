@@ -0,0 +1,145 @@
+import hashlib
+import json
+import os
+import zlib
+from typing import Any
+
+from src.controllers.workflow_templates import (
+    cache_injection,
+    cached_injection,
+    fixer_template,
+    generator_template,
+)
+from src.core.utils import LoRAInjector
+from src.core.utils.compiled_workflow import CompiledWorkflow
+from src.core.utils.ipadapter_injector import add_multiple_ipadapters_to_workflow
+from src.core.utils.mask_injector import add_region_prompts
+from src.core.utils.workflow_graph import WorkflowGraph
+from src.db.records import FixerRecord, GeneratorRecord, JobRecord
+from src.db.records.job_rec import (
+    JOB_BLOB_FIELDS,
+    CoordinatedRegion,
+    RegionPrompt,
+)
+
+
+def fixer_prompt(fixer: FixerRecord, original_result_img: str) -> dict[str, Any]:
+    img_path = os.path.abspath(original_result_img)
+    return fixer_template(fixer).instantiate({"image": img_path})
+
+
+def generator_prompt(gen: GeneratorRecord, job: JobRecord) -> dict[str, Any]:
+    values = {"positive": job.prompt_positive, "negative": job.prompt_negative}
+    if job.reference_controlnet_img is not None:
+        values["controlnet_image"] = job.reference_controlnet_img
+    template = generator_template(gen)
+    if not job.ipadapter_list and not job.lora_list and not job.region_prompts:
+        return template.instantiate(values)
+
+    # jobs of a command mostly share their injected nodes and differ only in
+    # the texts, so the injected workflow is built once and its slots patched
+    key = (gen.id, gen.version, injection_fingerprint(job))
+    injected = cached_injection(key)
+    if injected is None:
+        injected = inject_job_nodes(template, job)
+        cache_injection(key, injected)
+
+    if job.region_prompts is not None:
+        for i, region_prompt in enumerate(job.region_prompts.values()):
+            values[f"region_{i}"] = region_prompt["prompt"]
+
+    return injected.instantiate(values)
+
+
+def injection_fingerprint(job: JobRecord) -> str:
+    """Hashes the nodes that the injectors add for a job, except region texts."""
+    regions = [
+        {key: value for key, value in region_prompt.items() if key != "prompt"}
+        for region_prompt in (job.region_prompts or {}).values()
+    ]
+    data = json.dumps([job.ipadapter_list, job.lora_list, regions], sort_keys=True)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+def inject_job_nodes(template: CompiledWorkflow, job: JobRecord) -> CompiledWorkflow:
+    """
+    Returns the generator workflow with the IPAdapters, LoRAs and regions of
+    the job injected. It keeps the slots of the template and has a slot
+    region_<index> for the text of each region prompt.
+    """
+    # indexed once and shared by the injectors
+    graph = WorkflowGraph(template.instantiate({}))
+
+    if job.ipadapter_list is not None and len(job.ipadapter_list) > 0:
+        ipas_input = []
+        clip_vision_model = ""
+        for ipadapter in job.ipadapter_list:
+            clip_vision_model = ipadapter["clip_vision_model"]
+            ipas_input.append(
+                {
+                    "model": ipadapter["model_name"],
+                    "path": ipadapter["image_file"],
+                    "weight": ipadapter["weight"],
+                    "weight_type": ipadapter["weight_type"],
+                    "start_at": ipadapter["start_at"],
+                    "end_at": ipadapter["end_at"],
+                }
+            )
+        add_multiple_ipadapters_to_workflow(
+            graph, ipas_input, clip_vision_model=clip_vision_model
+        )
+
+    if job.lora_list is not None and len(job.lora_list) > 0:
+        LoRAInjector(graph).add_multiple_loras(job.lora_list)
+
+    region_encode_ids = []
+    if job.region_prompts is not None:
+        ccps = []
+        for v in job.region_prompts.values():
+            ccp = RegionPrompt(**v)
+            if v["coordinates"] is not None:
+                ccp.coordinates = CoordinatedRegion(**v["coordinates"])
+            ccps.append(ccp)
+
+        region_encode_ids = add_region_prompts(graph, ccps)
+
+    injected = CompiledWorkflow(graph.workflow)
+    for name, targets in template.slots().items():
+        for node_id, input_key in targets:
+            injected.add_node_slot(name, node_id, input_key)
+    for i, node_id in enumerate(region_encode_ids):
+        injected.add_node_slot(f"region_{i}", node_id, "text")
+
+    return injected
+
+
+def compress_prompt(prompt: dict[str, Any]) -> bytes:
+    return zlib.compress(json.dumps(prompt, separators=(",", ":")).encode())
+
+
+def decompress_prompt(data: bytes) -> dict[str, Any]:
+    return json.loads(zlib.decompress(data))
+
+
+def compile_generator_prompts(
+    gen: GeneratorRecord, job_inputs: list[dict[str, Any]]
+) -> list[bytes]:
+    """Builds the compressed prompts of new generator jobs, runs on run_cpu."""
+    prompts = []
+    for job_input in job_inputs:
+        job = JobRecord(**job_input)
+        for name in JOB_BLOB_FIELDS:
+            setattr(job, name, job_input.get(name))
+        prompts.append(compress_prompt(generator_prompt(gen, job)))
+
+    return prompts
+
+
+def compile_fixer_prompts(
+    fixer: FixerRecord, original_result_imgs: list[str]
+) -> list[bytes]:
+    """Builds the compressed prompts of new fixer jobs, runs on run_cpu."""
+    return [
+        compress_prompt(fixer_prompt(fixer, result_img))
+        for result_img in original_result_imgs
+    ]
@@ -2,10 +2,20 @@ import json
 import os
 import re
 
+from tortoise.transactions import in_transaction
+
+from src.controllers.blob_store import (
+    delete_unused_blobs,
+    hydrate_jobs,
+    store_job_blobs,
+)
+from src.controllers.common import remove_files
 from src.controllers.ctrl_types import JobOutput, ReplInput
 from src.controllers.manager_ctrl import Manager
+from src.controllers.prompt_assembly import assemble_prompt, item_contribution
 from src.controllers.serializers import serialize_job
 from src.core.config import Config
+from src.core.executors import run_io
 from src.db.records import GeneratorRecord, GroupRecord, JobRecord, ServerRecord
 from src.db.records.item_rec import ItemRecord
 
@@ -65,6 +75,7 @@ async def get_previous_job_from_repl() -> JobOutput | None:
     if job_rec is None:
         return None
 
+    await hydrate_jobs([job_rec])
     return serialize_job(job_rec)
 
 
@@ -85,13 +96,8 @@ async def run_repl(conf: Config, manager: Manager, input: ReplInput):
     list_group_item_code_names = serialize_group_item_code_names_to_dict(
         input.group_item_code_names
     )
-    prompt_positive = ""
-    prompt_negative = ""
-    reference_controlnet_img = None
     reference_ipadapter_img = None
-    lora_list = []
-
-    group_item_id_list = []
+    contributions = []
     for v in list_group_item_code_names:
         group = await GroupRecord.get_or_none(code_name=v["group_code_name"])
         if group is None:
@@ -105,24 +111,14 @@ async def run_repl(conf: Config, manager: Manager, input: ReplInput):
                 f"Item '{v['item_code_name']}' from group '{v['group_code_name']}' not found"
             )
 
-        group_item_id_list.append(
-            {
-                "group_id": item.group_id,
-                "item_id": item.id,
-            }
-        )
-        if len(item.positive_prompt) > 0:
-            prompt_positive += item.positive_prompt + " "
-        if len(item.negative_prompt) > 0:
-            prompt_negative += item.negative_prompt + " "
-        if item.controlnet_reference_image is not None:
-            reference_controlnet_img = item.controlnet_reference_image
-
-        # if item.ipadapter_reference_image is not None:
-        #     reference_ipadapter_img = item.ipadapter_reference_image
+        contributions.append(item_contribution(item))
 
-        if item.lora is not None:
-            lora_list.append(item.lora)
+    assembled = assemble_prompt(contributions)
+    prompt_positive = assembled.prompt_positive
+    prompt_negative = assembled.prompt_negative
+    reference_controlnet_img = assembled.reference_controlnet_img
+    lora_list = assembled.lora_list
+    group_item_id_list = assembled.group_item_id_list
 
     prompt_positive += input.prompt_positive
     prompt_negative += input.prompt_negative
@@ -145,7 +141,7 @@ async def run_repl(conf: Config, manager: Manager, input: ReplInput):
 
     await clear_repl_job()
 
-    job = await JobRecord.create(
+    job_input = dict(
         project_id=-1,
         command_id=-1,
         group_item_id_list=group_item_id_list,
@@ -160,8 +156,9 @@ async def run_repl(conf: Config, manager: Manager, input: ReplInput):
         lora_list=lora_list,
         result_img=result_img,
     )
-
-    await job.save()
+    async with in_transaction() as conn:
+        await store_job_blobs([job_input], conn)
+        job = await JobRecord.create(**job_input, using_db=conn)
     await manager.add_job(job.id)
 
 
@@ -169,6 +166,6 @@ async def clear_repl_job():
     job = await JobRecord.get_or_none(project_id=-1, command_id=-1)
     if job is not None:
         if job.result_img is not None:
-            if os.path.exists(job.result_img):
-                os.remove(job.result_img)
+            await run_io(remove_files, [job.result_img])
         await job.delete()
+        await delete_unused_blobs()
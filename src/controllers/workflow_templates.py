@@ -0,0 +1,78 @@
+from collections import OrderedDict
+
+from src.core.utils.compiled_workflow import CompiledWorkflow
+from src.db.records import FixerRecord, GeneratorRecord
+
+# compiled workflows with the version of the record they were compiled from,
+# keyed by the kind and the id of the record
+_templates: dict[tuple[str, int], tuple[int, CompiledWorkflow]] = {}
+
+# generator workflows with the LoRAs, IPAdapters and regions of a job already
+# injected, least recently used first, keyed by the generator id, its version
+# and the fingerprint of the injected nodes
+_injected: OrderedDict[tuple[int, int, str], CompiledWorkflow] = OrderedDict()
+_injected_node_count = 0
+# the least recently used injected workflows are dropped above this many nodes
+MAX_INJECTED_NODES = 200_000
+
+
+def generator_template(gen: GeneratorRecord) -> CompiledWorkflow:
+    cached = _templates.get(("generator", gen.id))
+    if cached is not None and cached[0] == gen.version:
+        return cached[1]
+
+    template = CompiledWorkflow(gen.workflow_json)
+    if gen.positive_prompt_title is not None:
+        template.add_slot("positive", gen.positive_prompt_title, "text")
+    if gen.negative_prompt_title is not None:
+        template.add_slot("negative", gen.negative_prompt_title, "text")
+    if (
+        gen.load_image_controlnet_title is not None
+        and len(gen.load_image_controlnet_title) > 0
+    ):
+        template.add_slot("controlnet_image", gen.load_image_controlnet_title, "image")
+
+    _templates[("generator", gen.id)] = (gen.version, template)
+    return template
+
+
+def fixer_template(fixer: FixerRecord) -> CompiledWorkflow:
+    cached = _templates.get(("fixer", fixer.id))
+    if cached is not None and cached[0] == fixer.version:
+        return cached[1]
+
+    template = CompiledWorkflow(fixer.workflow_json)
+    template.add_slot("image", fixer.load_image_title, "image")
+
+    _templates[("fixer", fixer.id)] = (fixer.version, template)
+    return template
+
+
+def invalidate_generator_template(gen_id: int):
+    global _injected_node_count
+    _templates.pop(("generator", gen_id), None)
+    for key in [key for key in _injected if key[0] == gen_id]:
+        _injected_node_count -= _injected.pop(key).node_count
+
+
+def cached_injection(key: tuple[int, int, str]) -> CompiledWorkflow | None:
+    injected = _injected.get(key)
+    if injected is not None:
+        _injected.move_to_end(key)
+    return injected
+
+
+def cache_injection(key: tuple[int, int, str], injected: CompiledWorkflow):
+    global _injected_node_count
+    if key in _injected:
+        _injected_node_count -= _injected.pop(key).node_count
+
+    _injected[key] = injected
+    _injected_node_count += injected.node_count
+    while _injected_node_count > MAX_INJECTED_NODES and len(_injected) > 1:
+        _, evicted = _injected.popitem(last=False)
+        _injected_node_count -= evicted.node_count
+
+
+def invalidate_fixer_template(fixer_id: int):
+    _templates.pop(("fixer", fixer_id), None)
@@ -14,6 +14,13 @@ class Config(DataClassYAMLMixin):
     ipadapter_references_path: str
     colored_region_path: str
     thumbnails_path: str
+    # how many prompts each ComfyUI server has queued at the same time
+    prompts_in_flight_per_server: int = 2
+    # result images are saved as ComfyUI sent them unless this is set
+    recompress_result_images: bool = False
+    # build and compress the prompt of each job when the jobs are created,
+    # so that dispatching a job only loads its prompt
+    precompile_prompts: bool = False
 
 
 def read_config(filepath: str) -> Config:
@@ -0,0 +1,85 @@
+import asyncio
+import functools
+import multiprocessing
+import os
+from collections.abc import Callable
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any
+
+IO_WORKERS = 8
+CPU_WORKERS = max(1, (os.cpu_count() or 2) - 1)
+# how many calls can be pending on each pool before the callers wait
+IO_BACKLOG = 64
+CPU_BACKLOG = 2 * CPU_WORKERS
+SEGMENTATION_BACKLOG = 4
+
+
+class BoundedExecutor:
+    """
+    Runs blocking calls on a pool that is created on first use. Once
+    max_pending calls are submitted, the next callers wait for a free slot
+    instead of piling up work in the pool.
+    """
+
+    def __init__(self, make_pool: Callable[[], Executor], max_pending: int):
+        self._make_pool = make_pool
+        self._max_pending = max_pending
+        self._pool: Executor | None = None
+        self._slots: asyncio.Semaphore | None = None
+
+    async def run(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self._max_pending)
+
+        async with self._slots:
+            if self._pool is None:
+                self._pool = self._make_pool()
+
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                self._pool, functools.partial(fn, *args, **kwargs)
+            )
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+
+io_executor = BoundedExecutor(
+    lambda: ThreadPoolExecutor(IO_WORKERS, thread_name_prefix="io"),
+    IO_BACKLOG,
+)
+# spawned because forking a process with NiceGUI's threads is not safe
+cpu_executor = BoundedExecutor(
+    lambda: ProcessPoolExecutor(
+        CPU_WORKERS, mp_context=multiprocessing.get_context("spawn")
+    ),
+    CPU_BACKLOG,
+)
+# a single process, so the segmentation model is loaded once and stays warm
+segmentation_executor = BoundedExecutor(
+    lambda: ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")),
+    SEGMENTATION_BACKLOG,
+)
+
+
+async def run_io(fn: Callable[..., Any], *args, **kwargs) -> Any:
+    """Runs blocking filesystem work on the I/O threads."""
+    return await io_executor.run(fn, *args, **kwargs)
+
+
+async def run_cpu(fn: Callable[..., Any], *args, **kwargs) -> Any:
+    """Runs CPU heavy image work on the worker processes, fn must be picklable."""
+    return await cpu_executor.run(fn, *args, **kwargs)
+
+
+async def run_segmentation(fn: Callable[..., Any], *args, **kwargs) -> Any:
+    """Runs mask creation on the process that keeps the segmentation model."""
+    return await segmentation_executor.run(fn, *args, **kwargs)
+
+
+def shutdown_executors():
+    io_executor.shutdown()
+    cpu_executor.shutdown()
+    segmentation_executor.shutdown()
@@ -1,134 +1,309 @@
 import os
+from typing import Any
 
 import cv2
 import numpy as np
-from ultralytics import YOLO  # pyright: ignore[reportPrivateImportUsage]
 
+SEGMENTATION_MODEL = "yolov8m-seg.pt"
+# images with more colors than this are photos that need person segmentation
+MAX_MASK_COLORS = 10
+# white, packed like pack_colors does
+BACKGROUND_COLOR = 0xFFFFFF
+# how far, as RGB distance, a pixel can be from a named color to belong to it
+DEFAULT_COLOR_TOLERANCE = 48
+# share of the pixels that must be close to a named color for the image
+# to be treated as a painted mask
+MIN_PALETTE_COVERAGE = 0.95
+# named colors covering less than this share of the pixels are stray
+# antialiasing pixels, not regions
+MIN_REGION_FRACTION = 0.001
+# rows of pixels that are labeled at once, which bounds the memory of the
+# color indexes to a few of these rows
+LABEL_ROWS = 64
 
-def auto_create_masks(input_image_path: str, output_dir: str) -> dict[str, str]:
+COLOR_NAMES = {
+    (255, 0, 0): "red",
+    (0, 255, 0): "green",
+    (0, 0, 255): "blue",
+    (255, 255, 0): "yellow",
+    (255, 0, 255): "magenta",
+    (0, 255, 255): "cyan",
+    (128, 0, 0): "maroon",
+    (0, 128, 0): "dark_green",
+    (0, 0, 128): "navy",
+    (128, 128, 0): "olive",
+    (255, 165, 0): "orange",
+    (128, 0, 128): "purple",
+    (255, 192, 203): "pink",
+    (165, 42, 42): "brown",
+    (128, 128, 128): "gray",
+    # Add more if needed
+}
+# the named colors and white, packed like pack_colors does
+PALETTE = np.array(
+    [(c[0] << 16) | (c[1] << 8) | c[2] for c in COLOR_NAMES.keys()]
+    + [BACKGROUND_COLOR]
+)
+
+_segmentation_model: Any = None
+
+
+def get_segmentation_model() -> Any:
+    """
+    Loads the segmentation model once per process. ultralytics is imported
+    here so that color masks work without it.
+    """
+    global _segmentation_model
+    if _segmentation_model is None:
+        from ultralytics import YOLO  # pyright: ignore[reportPrivateImportUsage]
+
+        _segmentation_model = YOLO(SEGMENTATION_MODEL)
+
+    return _segmentation_model
+
+
+def auto_create_masks(
+    input_image_path: str,
+    output_dir: str,
+    tolerance: int = DEFAULT_COLOR_TOLERANCE,
+) -> dict[str, str]:
     """
     Analyzes the input image and decides whether to use color detection or person segmentation.
     Saves appropriate mask files to the specified output directory.
     Returns a dictionary where keys are region names (including 'background') and values are paths to the generated mask files.
+    Colors within tolerance of a named color count as that color, so antialiased or compressed masks still use color detection.
+    """
+    return auto_create_masks_batch([(input_image_path, output_dir)], tolerance)[0]
+
+
+def auto_create_masks_batch(
+    inputs: list[tuple[str, str]],
+    tolerance: int = DEFAULT_COLOR_TOLERANCE,
+) -> list[dict[str, str]]:
+    """
+    Same as auto_create_masks for a list of (input image path, output dir),
+    the images that need person segmentation go through the model in one
+    batched call.
     """
-    img = cv2.imread(input_image_path)
-    if img is None:
-        raise ValueError(f"Could not load image from {input_image_path}")
+    imgs = []
+    for input_image_path, output_dir in inputs:
+        img = cv2.imread(input_image_path)
+        if img is None:
+            raise ValueError(f"Could not load image from {input_image_path}")
 
-    # Ensure output directory exists
-    os.makedirs(output_dir, exist_ok=True)
+        # Ensure output directory exists
+        os.makedirs(output_dir, exist_ok=True)
+        imgs.append(img)
 
-    # Get unique colors excluding background (assuming white [255,255,255])
-    pixels = img.reshape(-1, 3)
-    unique_colors = np.unique(pixels, axis=0)
-    bg_color = np.array([255, 255, 255])
-    non_bg_colors = unique_colors[~np.all(unique_colors == bg_color, axis=1)]
-    num_unique_non_bg = len(non_bg_colors)
+    mask_paths: list[dict[str, str]] = [{} for _ in inputs]
+    person_ids = []
+    for i, img in enumerate(imgs):
+        packed = pack_colors(img)
+        # sorts a copy of the pixels instead of counting into a table of
+        # every possible color
+        colors, counts = np.unique(packed.ravel(), return_counts=True)
+        non_bg_colors = colors[colors != BACKGROUND_COLOR]
+        if len(non_bg_colors) <= MAX_MASK_COLORS:
+            mask_paths[i] = create_color_masks(packed, colors, inputs[i][1])
+            continue
 
+        quantized = quantize_to_palette(colors, counts, tolerance)
+        if quantized is not None:
+            mask_colors, color_labels = quantized
+            labels = label_pixels(packed, colors, color_labels)
+            mask_paths[i] = write_color_masks(labels, mask_colors, inputs[i][1])
+        else:
+            person_ids.append(i)
+
+    if len(person_ids) > 0:
+        model = get_segmentation_model()
+        results = model([imgs[i] for i in person_ids])
+        for i, result in zip(person_ids, results):
+            mask_paths[i] = create_person_masks(imgs[i], result, inputs[i][1])
+
+    return mask_paths
+
+
+def pack_colors(img: np.ndarray) -> np.ndarray:
+    """Packs the three channels of every pixel in one uint32."""
+    return (
+        (img[..., 0].astype(np.uint32) << 16)
+        | (img[..., 1].astype(np.uint32) << 8)
+        | img[..., 2].astype(np.uint32)
+    )
+
+
+def unpack_color(packed: int) -> tuple[int, int, int]:
+    return (packed >> 16) & 0xFF, (packed >> 8) & 0xFF, packed & 0xFF
+
+
+def unpack_colors(packed: np.ndarray) -> np.ndarray:
+    return np.stack(
+        [(packed >> 16) & 0xFF, (packed >> 8) & 0xFF, packed & 0xFF], axis=1
+    ).astype(np.int32)
+
+
+def quantize_to_palette(
+    colors: np.ndarray, counts: np.ndarray, tolerance: int
+) -> tuple[list[int], np.ndarray] | None:
+    """
+    Matches the distinct colors of the image, with the pixel count of each,
+    to the named colors and white.
+    Returns the named colors that form regions and the label of every
+    distinct color for write_color_masks, or None when too few pixels are
+    close to a named color for the image to be a painted mask.
+    """
+    channels = unpack_colors(colors)
+    palette_channels = unpack_colors(PALETTE)
+    distances = np.zeros((len(colors), len(PALETTE)), dtype=np.int32)
+    for c in range(3):
+        diff = channels[:, c, None] - palette_channels[None, :, c]
+        distances += diff * diff
+
+    nearest = distances.argmin(axis=1)
+    within = distances[np.arange(len(colors)), nearest] <= tolerance * tolerance
+    total = counts.sum()
+    if counts[within].sum() < MIN_PALETTE_COVERAGE * total:
+        return None
+
+    palette_counts = np.bincount(
+        nearest[within], weights=counts[within], minlength=len(PALETTE)
+    )
+    bg_index = len(PALETTE) - 1
+    used = np.flatnonzero(palette_counts >= MIN_REGION_FRACTION * total)
+    used = used[used != bg_index]
+    if len(used) > MAX_MASK_COLORS:
+        return None
+
+    # every color goes to the closest region, so the masks have no holes
+    candidates = np.append(used, bg_index)
+    closest = distances[:, candidates].argmin(axis=1)
+    # labels are 1..len(used) for the regions and len(used) + 1 for white
+    color_labels = (closest + 1).astype(np.uint8)
+    return PALETTE[used].tolist(), color_labels
+
+
+def label_pixels(
+    packed: np.ndarray, colors: np.ndarray, color_labels: np.ndarray
+) -> np.ndarray:
+    """
+    Returns the label of every pixel, where color_labels[i] is the label of
+    colors[i] and colors are the sorted distinct colors of the image.
+    """
+    labels = np.empty(packed.shape, dtype=np.uint8)
+    for start in range(0, len(packed), LABEL_ROWS):
+        rows = packed[start : start + LABEL_ROWS]
+        labels[start : start + LABEL_ROWS] = color_labels[np.searchsorted(colors, rows)]
+    return labels
+
+
+def create_color_masks(
+    packed: np.ndarray, colors: np.ndarray, output_dir: str
+) -> dict[str, str]:
+    """
+    Writes a mask per exact color of the image and one for the background,
+    colors being the sorted distinct colors of the image.
+    """
+    # label 0 is left for the pixels that are not in any mask
+    is_bg = colors == BACKGROUND_COLOR
+    non_bg_count = len(colors) - int(is_bg.sum())
+    color_labels = np.zeros(len(colors), dtype=np.uint8)
+    color_labels[~is_bg] = np.arange(1, non_bg_count + 1)
+    color_labels[is_bg] = non_bg_count + 1
+    labels = label_pixels(packed, colors, color_labels)
+    return write_color_masks(labels, colors[~is_bg].tolist(), output_dir)
+
+
+def write_color_masks(
+    labels: np.ndarray, mask_colors: list[int], output_dir: str
+) -> dict[str, str]:
+    """
+    Writes the masks from an image of labels, where the pixels of
+    mask_colors[i] have the label i + 1 and the background pixels the label
+    len(mask_colors) + 1.
+    """
+    mask_paths = {}
+    for label, color in enumerate(mask_colors, start=1):
+        # Name the mask
+        color_tuple = unpack_color(color)
+        color_name = COLOR_NAMES.get(
+            color_tuple,
+            f"color_{color_tuple[0]}_{color_tuple[1]}_{color_tuple[2]}",
+        )
+        mask = (labels == label).astype(np.uint8) * 255
+        mask_filename = f"mask_{color_name}.png"
+        mask_path = os.path.join(output_dir, mask_filename)
+        cv2.imwrite(mask_path, mask)
+        mask_paths[color_name] = mask_path
+
+    # Create and add background mask
+    bg_mask = (labels == len(mask_colors) + 1).astype(np.uint8) * 255
+    bg_filename = "mask_background.png"
+    bg_path = os.path.join(output_dir, bg_filename)
+    cv2.imwrite(bg_path, bg_mask)
+    mask_paths["background"] = bg_path
+
+    return mask_paths
+
+
+def create_person_masks(
+    img: np.ndarray, result: Any, output_dir: str
+) -> dict[str, str]:
     mask_paths = {}
+    person_masks = []
+    if result.masks is not None:
+        for i, mask_tensor in enumerate(result.masks.data):
+            if result.boxes.cls[i] == 0:  # Class 0 is 'person' in COCO
+                mask_np = (mask_tensor.cpu().numpy() * 255).astype(np.uint8)
+                # Ensure mask is same size as image
+                if mask_np.shape != img.shape[:2]:
+                    mask_np = cv2.resize(mask_np, (img.shape[1], img.shape[0]))
+                person_masks.append(mask_np)
+
+    # Create color-coded image
+    color_coded = np.ones_like(img) * 255  # White background
+    colors = [
+        (0, 0, 255),  # blue
+        (0, 255, 0),  # green
+        (255, 0, 0),  # red
+        (0, 255, 255),  # yellow
+        (255, 0, 255),  # magenta
+        (255, 255, 0),  # cyan
+        (128, 0, 0),
+        (0, 128, 0),
+        (0, 0, 128),
+        (128, 128, 0),
+        (255, 165, 0),
+        (128, 0, 128),
+        (255, 192, 203),
+        (165, 42, 42),
+        (128, 128, 128),
+        # Add more if needed
+    ]
+
+    for i, mask in enumerate(person_masks):
+        color = colors[i % len(colors)]
+        color_coded[mask > 127] = color  # Threshold to apply color
+
+    color_coded_path = os.path.join(output_dir, "color_coded.png")
+    cv2.imwrite(color_coded_path, color_coded)
+
+    # Save individual binary masks
+    for i, mask in enumerate(person_masks):
+        key = f"person_{i + 1}"
+        mask_filename = f"mask_{key}.png"
+        mask_path = os.path.join(output_dir, mask_filename)
+        cv2.imwrite(mask_path, mask)
+        mask_paths[key] = mask_path
 
-    if num_unique_non_bg <= 10:
-        # Color detection method
-        color_to_name = {
-            (255, 0, 0): "red",
-            (0, 255, 0): "green",
-            (0, 0, 255): "blue",
-            (255, 255, 0): "yellow",
-            (255, 0, 255): "magenta",
-            (0, 255, 255): "cyan",
-            (128, 0, 0): "maroon",
-            (0, 128, 0): "dark_green",
-            (0, 0, 128): "navy",
-            (128, 128, 0): "olive",
-            (255, 165, 0): "orange",
-            (128, 0, 128): "purple",
-            (255, 192, 203): "pink",
-            (165, 42, 42): "brown",
-            (128, 128, 128): "gray",
-            # Add more if needed
-        }
-
-        for color in non_bg_colors:
-            # Create binary mask
-            mask = np.all(img == color, axis=-1).astype(np.uint8) * 255
-            # Name the mask
-            color_tuple = tuple(color.tolist())
-            color_name = color_to_name.get(
-                color_tuple, f"color_{color[0]}_{color[1]}_{color[2]}"
-            )
-            mask_filename = f"mask_{color_name}.png"
-            mask_path = os.path.join(output_dir, mask_filename)
-            cv2.imwrite(mask_path, mask)
-            mask_paths[color_name] = mask_path
-
-        # Create and add background mask
-        bg_mask = np.all(img == bg_color, axis=-1).astype(np.uint8) * 255
-        bg_filename = "mask_background.png"
-        bg_path = os.path.join(output_dir, bg_filename)
-        cv2.imwrite(bg_path, bg_mask)
-        mask_paths["background"] = bg_path
-
-    else:
-        # Person segmentation method
-        model = YOLO(
-            "yolov8m-seg.pt"
-        )  # Use a segmentation model; can change to larger like 'yolov8m-seg.pt'
-        results = model(img)
-
-        person_masks = []
-        if results[0].masks is not None:
-            for i, mask_tensor in enumerate(results[0].masks.data):
-                if results[0].boxes.cls[i] == 0:  # Class 0 is 'person' in COCO
-                    mask_np = (mask_tensor.cpu().numpy() * 255).astype(np.uint8)
-                    # Ensure mask is same size as image
-                    if mask_np.shape != img.shape[:2]:
-                        mask_np = cv2.resize(mask_np, (img.shape[1], img.shape[0]))
-                    person_masks.append(mask_np)
-
-        # Create color-coded image
-        color_coded = np.ones_like(img) * 255  # White background
-        colors = [
-            (0, 0, 255),  # blue
-            (0, 255, 0),  # green
-            (255, 0, 0),  # red
-            (0, 255, 255),  # yellow
-            (255, 0, 255),  # magenta
-            (255, 255, 0),  # cyan
-            (128, 0, 0),
-            (0, 128, 0),
-            (0, 0, 128),
-            (128, 128, 0),
-            (255, 165, 0),
-            (128, 0, 128),
-            (255, 192, 203),
-            (165, 42, 42),
-            (128, 128, 128),
-            # Add more if needed
-        ]
-
-        for i, mask in enumerate(person_masks):
-            color = colors[i % len(colors)]
-            color_coded[mask > 127] = color  # Threshold to apply color
-
-        color_coded_path = os.path.join(output_dir, "color_coded.png")
-        cv2.imwrite(color_coded_path, color_coded)
-
-        # Save individual binary masks
-        for i, mask in enumerate(person_masks):
-            key = f"person_{i + 1}"
-            mask_filename = f"mask_{key}.png"
-            mask_path = os.path.join(output_dir, mask_filename)
-            cv2.imwrite(mask_path, mask)
-            mask_paths[key] = mask_path
-
-        # Create and add background mask (inverse of all person regions)
-        height, width = img.shape[:2]
-        bg_mask = np.ones((height, width), dtype=np.uint8) * 255
-        for mask in person_masks:
-            bg_mask[mask > 127] = 0
-        bg_filename = "mask_background.png"
-        bg_path = os.path.join(output_dir, bg_filename)
-        cv2.imwrite(bg_path, bg_mask)
-        mask_paths["background"] = bg_path
+    # Create and add background mask (inverse of all person regions)
+    height, width = img.shape[:2]
+    bg_mask = np.ones((height, width), dtype=np.uint8) * 255
+    for mask in person_masks:
+        bg_mask[mask > 127] = 0
+    bg_filename = "mask_background.png"
+    bg_path = os.path.join(output_dir, bg_filename)
+    cv2.imwrite(bg_path, bg_mask)
+    mask_paths["background"] = bg_path
 
     return mask_paths
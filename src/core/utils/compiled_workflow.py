@@ -0,0 +1,56 @@
+import copy
+from typing import Any
+
+from src.core.utils.cow_workflow import CowWorkflow
+from src.core.utils.workflow_graph import WorkflowGraph
+
+
+class CompiledWorkflow:
+    """
+    A ComfyUI workflow prepared once to build many prompts. Node ids are
+    indexed by title and class type, and the inputs that change per prompt
+    are registered as slots that are written directly on each copy.
+    """
+
+    def __init__(self, workflow: dict[str, Any]):
+        self._workflow = copy.deepcopy(workflow)
+        self._graph = WorkflowGraph(self._workflow)
+        self._slots: dict[str, list[tuple[str, str]]] = {}
+
+    def node_ids_with_title(self, title: str) -> list[str]:
+        return self._graph.node_ids_with_title(title)
+
+    def node_ids_with_class(self, class_type: str) -> list[str]:
+        return self._graph.node_ids_with_class(class_type)
+
+    def add_slot(self, name: str, title: str, input_key: str):
+        """Registers the input of the nodes with the title as a slot."""
+        self._slots[name] = [
+            (node_id, input_key) for node_id in self.node_ids_with_title(title)
+        ]
+
+    def add_node_slot(self, name: str, node_id: str, input_key: str):
+        """Adds the input of a single node to a slot."""
+        self._slots.setdefault(name, []).append((node_id, input_key))
+
+    def slots(self) -> dict[str, list[tuple[str, str]]]:
+        return {name: list(targets) for name, targets in self._slots.items()}
+
+    @property
+    def node_count(self) -> int:
+        return len(self._workflow)
+
+    def has_slot(self, name: str) -> bool:
+        return len(self._slots.get(name, [])) > 0
+
+    def instantiate(self, values: dict[str, Any]) -> CowWorkflow:
+        """
+        Returns a prompt with the values written in their slots. The prompt
+        shares every node with the template except the ones of the slots.
+        """
+        prompt = CowWorkflow(self._workflow)
+        for name, value in values.items():
+            for node_id, input_key in self._slots.get(name, []):
+                prompt.edit(node_id)["inputs"][input_key] = value
+
+        return prompt
@@ -0,0 +1,42 @@
+from typing import Any
+
+
+class CowWorkflow(dict):
+    """
+    A workflow that shares its nodes with the workflow it was made from.
+    A shared node is copied the first time it is edited and added nodes
+    belong to it from the start, so the base workflow is never changed.
+    It is a dict of the nodes, so it serializes to the prompt JSON as is.
+
+    Nodes must be changed through edit(), never through workflow[node_id].
+    """
+
+    def __init__(self, base: dict[str, Any]):
+        super().__init__(base)
+        self._owned: set[str] = set()
+
+    def __setitem__(self, node_id: str, node: dict[str, Any]):
+        super().__setitem__(node_id, node)
+        self._owned.add(node_id)
+
+    def __reduce__(self):
+        # copies and pickles are plain dicts, they share nothing
+        return (dict, (dict(self),))
+
+    def edit(self, node_id: str) -> dict[str, Any]:
+        """Returns the node for writing, copying it first if it is shared."""
+        node = self[node_id]
+        if node_id not in self._owned:
+            node = {**node, "inputs": dict(node.get("inputs", {}))}
+            super().__setitem__(node_id, node)
+            self._owned.add(node_id)
+
+        return node
+
+
+def as_cow(workflow: dict[str, Any]) -> CowWorkflow:
+    """Wraps a workflow so that editing it leaves the original untouched."""
+    if isinstance(workflow, CowWorkflow):
+        return workflow
+
+    return CowWorkflow(workflow)
@@ -0,0 +1,69 @@
+import io
+import os
+import tempfile
+
+from PIL import Image
+
+from src.core.executors import run_cpu, run_io
+
+EXTENSION_FORMATS = {
+    ".png": "PNG",
+    ".jpg": "JPEG",
+    ".jpeg": "JPEG",
+    ".webp": "WEBP",
+    ".gif": "GIF",
+}
+
+
+def detect_image_format(data: bytes) -> str | None:
+    """Returns the PIL format name of the image from its file signature."""
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "PNG"
+    if data.startswith(b"\xff\xd8\xff"):
+        return "JPEG"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "WEBP"
+    if data[:6] in (b"GIF87a", b"GIF89a"):
+        return "GIF"
+
+    return None
+
+
+def write_file_atomically(path: str, data: bytes):
+    # readers see either the old file or the complete new one
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)), prefix=".", suffix=".tmp"
+    )
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def reencode_image(data: bytes, image_format: str) -> bytes:
+    image = Image.open(io.BytesIO(data))
+    out = io.BytesIO()
+    image.save(out, format=image_format, optimize=True)
+    return out.getvalue()
+
+
+async def save_image_bytes(path: str, data: bytes, recompress: bool = False):
+    """
+    Writes the image as it came from the server. It is decoded only when
+    it has to be recompressed or its format doesn't match the extension
+    of the path, and that work happens off the event loop.
+    """
+    detected_format = detect_image_format(data)
+    if detected_format is None:
+        raise ValueError(f"Unknown image format for '{path}'")
+
+    ext = os.path.splitext(path)[1].lower()
+    image_format = EXTENSION_FORMATS.get(ext, detected_format)
+    if recompress or image_format != detected_format:
+        data = await run_cpu(reencode_image, data, image_format)
+
+    await run_io(write_file_atomically, path, data)
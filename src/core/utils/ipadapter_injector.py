@@ -1,28 +1,10 @@
-import re
 from typing import Any
 
-
-def get_max_node_id(workflow: dict[str, Any]) -> int:
-    """Extract the maximum numeric node ID from workflow keys."""
-    max_id = 0
-    for key in workflow.keys():
-        numbers = re.findall(r"\d+", str(key))
-        if numbers:
-            max_id = max(max_id, max(int(n) for n in numbers))
-    return max_id
-
-
-def generate_unique_id(workflow: dict[str, Any], base_id: int) -> str:
-    """Generate a unique node ID that doesn't exist in the workflow."""
-    node_id = str(base_id)
-    while node_id in workflow:
-        base_id += 1
-        node_id = str(base_id)
-    return node_id
+from src.core.utils.workflow_graph import WorkflowGraph, as_graph
 
 
 def add_multiple_ipadapters_to_workflow(
-    workflow: dict[str, Any],
+    workflow: dict[str, Any] | WorkflowGraph,
     reference_images: list[dict[str, Any]],
     clip_vision_model: str = "CLIP-ViT-H-14-laion2B-s32B-b79K.safetensors",
 ) -> dict[str, Any]:
@@ -30,33 +12,25 @@ def add_multiple_ipadapters_to_workflow(
     Add multiple IPAdapter nodes to a ComfyUI workflow in sequence.
     Works with ComfyUI_IPAdapter_plus extension.
     """
-    # Find the highest node ID
-    max_id = get_max_node_id(workflow)
+    graph = as_graph(workflow)
 
     # Find the KSampler node
-    ksampler_id = None
-    model_input = None
-
-    for node_id, node_data in workflow.items():
-        class_type = node_data.get("class_type", "")
-        if class_type in ["KSampler", "KSamplerAdvanced"]:
-            ksampler_id = node_id
-            model_input = node_data["inputs"].get("model")
-            break
-
-    if not ksampler_id:
+    ksampler_ids = graph.node_ids_with_class("KSampler", "KSamplerAdvanced")
+    if not ksampler_ids:
         raise ValueError("No KSampler node found in workflow")
 
+    ksampler_id = ksampler_ids[0]
+    model_input = graph.workflow[ksampler_id]["inputs"].get("model")
+
     # Add CLIPVisionLoader (shared by all IPAdapters)
-    current_id = max_id + 1
-    clip_vision_loader_id = generate_unique_id(workflow, current_id)
-    workflow[clip_vision_loader_id] = {
-        "inputs": {"clip_name": clip_vision_model},
-        "class_type": "CLIPVisionLoader",
-        "_meta": {"title": "Load CLIP Vision"},
-    }
+    clip_vision_loader_id = graph.add_node(
+        {
+            "inputs": {"clip_name": clip_vision_model},
+            "class_type": "CLIPVisionLoader",
+            "_meta": {"title": "Load CLIP Vision"},
+        }
+    )
 
-    current_id = int(clip_vision_loader_id) + 1
     current_model_input = model_input
 
     # Add each IPAdapter in sequence
@@ -69,48 +43,47 @@ def add_multiple_ipadapters_to_workflow(
         end_at = ref_img.get("end_at", 1.0)
 
         # LoadImage node
-        load_image_id = generate_unique_id(workflow, current_id)
-        workflow[load_image_id] = {
-            "inputs": {"image": path},
-            "class_type": "LoadImage",
-            "_meta": {"title": f"IPAdapter Reference {idx + 1}"},
-        }
-        current_id = int(load_image_id) + 1
+        load_image_id = graph.add_node(
+            {
+                "inputs": {"image": path},
+                "class_type": "LoadImage",
+                "_meta": {"title": f"IPAdapter Reference {idx + 1}"},
+            }
+        )
 
         # IPAdapterModelLoader node
-        ipadapter_loader_id = generate_unique_id(workflow, current_id)
-        workflow[ipadapter_loader_id] = {
-            "inputs": {"ipadapter_file": model_name},
-            "class_type": "IPAdapterModelLoader",
-            "_meta": {"title": f"IPAdapter Model {idx + 1}"},
-        }
-        current_id = int(ipadapter_loader_id) + 1
+        ipadapter_loader_id = graph.add_node(
+            {
+                "inputs": {"ipadapter_file": model_name},
+                "class_type": "IPAdapterModelLoader",
+                "_meta": {"title": f"IPAdapter Model {idx + 1}"},
+            }
+        )
 
         # IPAdapterAdvanced node - THIS IS THE CORRECT CLASS NAME
-        ipadapter_apply_id = generate_unique_id(workflow, current_id)
-        workflow[ipadapter_apply_id] = {
-            "inputs": {
-                "weight": weight,
-                "weight_type": weight_type,
-                "start_at": start_at,
-                "end_at": end_at,
-                "model": current_model_input,
-                "ipadapter": [ipadapter_loader_id, 0],
-                "image": [load_image_id, 0],
-                "clip_vision": [clip_vision_loader_id, 0],
-                "embeds_scaling": "V only",
-                "combine_embeds": "concat",
-            },
-            "class_type": "IPAdapterAdvanced",
-            "_meta": {"title": f"Apply IPAdapter {idx + 1}"},
-        }
-
-        current_id = int(ipadapter_apply_id) + 1
+        ipadapter_apply_id = graph.add_node(
+            {
+                "inputs": {
+                    "weight": weight,
+                    "weight_type": weight_type,
+                    "start_at": start_at,
+                    "end_at": end_at,
+                    "model": current_model_input,
+                    "ipadapter": [ipadapter_loader_id, 0],
+                    "image": [load_image_id, 0],
+                    "clip_vision": [clip_vision_loader_id, 0],
+                    "embeds_scaling": "V only",
+                    "combine_embeds": "concat",
+                },
+                "class_type": "IPAdapterAdvanced",
+                "_meta": {"title": f"Apply IPAdapter {idx + 1}"},
+            }
+        )
 
         # The output of this IPAdapter becomes the input for the next
         current_model_input = [ipadapter_apply_id, 0]
 
     # Update KSampler to use the final IPAdapter output
-    workflow[ksampler_id]["inputs"]["model"] = current_model_input
+    graph.set_input(ksampler_id, "model", current_model_input)
 
-    return workflow
+    return graph.workflow
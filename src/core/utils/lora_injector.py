@@ -1,26 +1,17 @@
 import json
-from typing import Any, Optional, Tuple
+from typing import Any, Optional
+
+from src.core.utils.workflow_graph import WorkflowGraph, as_graph
 
 
 class LoRAInjector:
-    def __init__(self, workflow: dict[str, Any]):
-        self.workflow = workflow
-        self.next_node_id = self._get_next_node_id()
-
-    def _get_next_node_id(self) -> int:
-        """Get the next available node ID."""
-        if not self.workflow:
-            return 1
-        # Node IDs can be numeric or alphanumeric strings
-        # Extract only numeric IDs to find the next available number
-        numeric_ids = []
-        for node_id in self.workflow.keys():
-            try:
-                numeric_ids.append(int(node_id))
-            except ValueError:
-                # Skip non-numeric IDs like "4a", "node_1", etc.
-                continue
-        return max(numeric_ids) + 1 if numeric_ids else 1
+    def __init__(self, workflow: dict[str, Any] | WorkflowGraph):
+        self.graph = as_graph(workflow)
+        self.workflow = self.graph.workflow
+
+    @property
+    def next_node_id(self) -> int:
+        return self.graph.max_node_id + 1
 
     def _detect_workflow_type(self) -> str:
         """
@@ -31,78 +22,25 @@ class LoRAInjector:
             'split' - Split workflow with separate UNETLoader + CLIPLoader (Z-Image, Flux, etc.)
             'unknown' - Could not determine workflow type
         """
-        has_checkpoint_loader = False
-        has_unet_loader = False
-        has_clip_loader = False
-
-        for node_data in self.workflow.values():
-            class_type = node_data.get("class_type", "")
-            if "CheckpointLoader" in class_type:
-                has_checkpoint_loader = True
-            if class_type == "UNETLoader":
-                has_unet_loader = True
-            if class_type == "CLIPLoader":
-                has_clip_loader = True
-
-        if has_checkpoint_loader:
+        if self._find_model_nodes():
             return "checkpoint"
-        elif has_unet_loader:
+        elif self._find_unet_loader() is not None:
             return "split"
         return "unknown"
 
     def _find_model_nodes(self) -> list[str]:
         """Find all checkpoint loader nodes in the workflow."""
-        model_nodes = []
-        for node_id, node_data in self.workflow.items():
-            class_type = node_data.get("class_type", "")
-            if "CheckpointLoader" in class_type:
-                model_nodes.append(node_id)
-        return model_nodes
+        return self.graph.node_ids_with_class_containing("CheckpointLoader")
 
     def _find_unet_loader(self) -> Optional[str]:
         """Find the UNETLoader node (used in Z-Image, Flux, etc.)."""
-        for node_id, node_data in self.workflow.items():
-            if node_data.get("class_type") == "UNETLoader":
-                return node_id
-        return None
+        node_ids = self.graph.node_ids_with_class("UNETLoader")
+        return node_ids[0] if node_ids else None
 
     def _find_clip_loader(self) -> Optional[str]:
         """Find the CLIPLoader node (used in Z-Image, Flux, etc.)."""
-        for node_id, node_data in self.workflow.items():
-            if node_data.get("class_type") == "CLIPLoader":
-                return node_id
-        return None
-
-    def _find_nodes_using_model(self, model_source_id: str) -> list[Tuple[str, str]]:
-        """
-        Find nodes that use the model output from a given source node.
-        Returns list of (node_id, input_key) tuples.
-        """
-        using_nodes = []
-        for node_id, node_data in self.workflow.items():
-            inputs = node_data.get("inputs", {})
-            for input_key, input_value in inputs.items():
-                # Check if this input references the model source
-                if isinstance(input_value, list) and len(input_value) >= 1:
-                    if input_value[0] == model_source_id:
-                        using_nodes.append((node_id, input_key))
-        return using_nodes
-
-    def _find_nodes_using_output(
-        self, source_id: str, output_index: int
-    ) -> list[Tuple[str, str]]:
-        """
-        Find nodes that use a specific output from a given source node.
-        Returns list of (node_id, input_key) tuples.
-        """
-        using_nodes = []
-        for node_id, node_data in self.workflow.items():
-            inputs = node_data.get("inputs", {})
-            for input_key, input_value in inputs.items():
-                if isinstance(input_value, list) and len(input_value) >= 2:
-                    if input_value[0] == source_id and input_value[1] == output_index:
-                        using_nodes.append((node_id, input_key))
-        return using_nodes
+        node_ids = self.graph.node_ids_with_class("CLIPLoader")
+        return node_ids[0] if node_ids else None
 
     def add_lora(
         self,
@@ -153,9 +91,6 @@ class LoRAInjector:
 
         Uses LoraLoaderModelOnly since CLIP is loaded separately.
         """
-        node_id = str(self.next_node_id)
-        self.next_node_id += 1
-
         # Find the UNET loader if no specific node specified
         if insert_after_node is None:
             insert_after_node = self._find_unet_loader()
@@ -181,18 +116,11 @@ class LoRAInjector:
             "_meta": {"title": f"Load LoRA - {lora_name}"},
         }
 
-        # Find nodes using the model output BEFORE adding LoRA node
-        nodes_to_update = self._find_nodes_using_output(insert_after_node, 0)
-
-        # Add the LoRA node
-        self.workflow[node_id] = lora_node
-
-        # Redirect model connections to use LoRA output
-        for target_node_id, input_key in nodes_to_update:
-            if target_node_id == node_id:
-                continue  # Don't redirect the LoRA node itself
-            target_node = self.workflow[target_node_id]
-            target_node["inputs"][input_key] = [node_id, 0]
+        # Redirect model connections to use LoRA output, then add the LoRA
+        # node so that its own input stays on the source
+        node_id = self.graph.new_node_id()
+        self.graph.redirect_output(insert_after_node, 0, node_id)
+        self.graph.add_node(lora_node, node_id)
 
         return node_id
 
@@ -209,9 +137,6 @@ class LoRAInjector:
 
         Uses LoraLoader which handles both MODEL and CLIP.
         """
-        node_id = str(self.next_node_id)
-        self.next_node_id += 1
-
         # If no specific node specified, find the checkpoint loader
         if insert_after_node is None:
             model_nodes = self._find_model_nodes()
@@ -236,24 +161,12 @@ class LoRAInjector:
             "_meta": {"title": f"Load LoRA - {lora_name}"},
         }
 
-        # Find all nodes using model/clip outputs BEFORE adding LoRA
-        nodes_to_update = self._find_nodes_using_model(insert_after_node)
-
-        # Add the LoRA node
-        self.workflow[node_id] = lora_node
-
-        # Redirect nodes to use LoRA outputs instead
-        for target_node_id, input_key in nodes_to_update:
-            if target_node_id == node_id:
-                continue
-            target_node = self.workflow[target_node_id]
-            current_input = target_node["inputs"][input_key]
-
-            if isinstance(current_input, list) and len(current_input) >= 2:
-                if current_input[0] == insert_after_node:
-                    # Only redirect model (0) and clip (1), not VAE (2)
-                    if current_input[1] in [0, 1]:
-                        target_node["inputs"][input_key] = [node_id, current_input[1]]
+        # Redirect model (0) and clip (1) to the LoRA outputs, not VAE (2),
+        # then add the LoRA node so that its own inputs stay on the source
+        node_id = self.graph.new_node_id()
+        self.graph.redirect_output(insert_after_node, 0, node_id)
+        self.graph.redirect_output(insert_after_node, 1, node_id)
+        self.graph.add_node(lora_node, node_id)
 
         return node_id
 
@@ -1,37 +1,34 @@
-import copy
 from typing import Any
 
+from src.core.utils.workflow_graph import WorkflowGraph, as_graph
 from src.db.records.job_rec import RegionPrompt
 
 
 def inject_masks(
-    original_workflow: dict[str, Any], prompts: list[RegionPrompt]
+    original_workflow: dict[str, Any] | WorkflowGraph, prompts: list[RegionPrompt]
 ) -> dict[str, Any]:
+    graph = as_graph(original_workflow)
+    add_region_prompts(graph, prompts)
+    return graph.workflow
+
+
+def add_region_prompts(graph: WorkflowGraph, prompts: list[RegionPrompt]) -> list[str]:
+    """
+    Adds a masked or area conditioning for each prompt and combines them with
+    the positive conditioning. Returns the ids of the text encode nodes of
+    the prompts, in order.
+    """
+    workflow = graph.workflow
     if not prompts:
-        return copy.deepcopy(original_workflow)
-
-    workflow = copy.deepcopy(original_workflow)
-
-    # Find the maximum node ID to start assigning new IDs
-    max_id = max(int(k) for k in workflow.keys() if k.isdigit())
-    next_id = max_id + 1
-
-    def get_next_id() -> str:
-        nonlocal next_id
-        current = next_id
-        next_id += 1
-        return str(current)
+        return []
 
     # Find the KSampler node
-    ksampler_id = None
-    for node_id, node in workflow.items():
-        if node.get("class_type") == "KSampler":
-            ksampler_id = node_id
-            break
-
-    if ksampler_id is None:
+    ksampler_ids = graph.node_ids_with_class("KSampler")
+    if not ksampler_ids:
         raise ValueError("No KSampler node found in the workflow")
 
+    ksampler_id = ksampler_ids[0]
+
     def find_base_conditioning(positive_link):
         current_link = positive_link
         consumer_id = ksampler_id
@@ -86,6 +83,7 @@ def inject_masks(
 
     # Start with the base conditioning as the current conditioning
     current_cond = [base_cond_id, base_cond_output]
+    region_encode_ids = []
 
     for prompt_obj in prompts:
         # Validate that we have either mask_file or coordinates
@@ -100,75 +98,83 @@ def inject_masks(
             )
 
         # Add CLIPTextEncode for the regional prompt
-        region_encode_id = get_next_id()
-        workflow[region_encode_id] = {
-            "class_type": base_node.get("class_type"),
-            "inputs": {"text": prompt_obj.prompt, "clip": [clip_id, clip_output]},
-        }
+        region_encode_id = graph.add_node(
+            {
+                "class_type": base_node.get("class_type"),
+                "inputs": {"text": prompt_obj.prompt, "clip": [clip_id, clip_output]},
+            }
+        )
+
+        region_encode_ids.append(region_encode_id)
 
         # Branch based on whether we're using mask or coordinates
         if prompt_obj.mask_file is not None:
             # ===== MASK PATH =====
             # Add LoadImage node for the mask file
-            load_mask_id = get_next_id()
-            workflow[load_mask_id] = {
-                "class_type": "LoadImage",
-                "inputs": {"image": prompt_obj.mask_file},
-            }
+            load_mask_id = graph.add_node(
+                {
+                    "class_type": "LoadImage",
+                    "inputs": {"image": prompt_obj.mask_file},
+                }
+            )
 
             # Add ImageToMask node to convert image to mask
-            mask_id = get_next_id()
-            workflow[mask_id] = {
-                "class_type": "ImageToMask",
-                "inputs": {
-                    "image": [load_mask_id, 0],
-                    "channel": "red",
-                },
-            }
+            mask_id = graph.add_node(
+                {
+                    "class_type": "ImageToMask",
+                    "inputs": {
+                        "image": [load_mask_id, 0],
+                        "channel": "red",
+                    },
+                }
+            )
 
             # Add ConditioningSetMask to apply the mask
-            conditioned_id = get_next_id()
-            workflow[conditioned_id] = {
-                "class_type": "ConditioningSetMask",
-                "inputs": {
-                    "conditioning": [region_encode_id, 0],
-                    "mask": [mask_id, 0],
-                    "strength": 1.0,
-                    "set_cond_area": "default",
-                },
-            }
+            conditioned_id = graph.add_node(
+                {
+                    "class_type": "ConditioningSetMask",
+                    "inputs": {
+                        "conditioning": [region_encode_id, 0],
+                        "mask": [mask_id, 0],
+                        "strength": 1.0,
+                        "set_cond_area": "default",
+                    },
+                }
+            )
 
         else:
             # ===== COORDINATES PATH =====
             # Add ConditioningSetArea using coordinates
             assert prompt_obj.coordinates is not None
-            conditioned_id = get_next_id()
-            workflow[conditioned_id] = {
-                "class_type": "ConditioningSetArea",
+            conditioned_id = graph.add_node(
+                {
+                    "class_type": "ConditioningSetArea",
+                    "inputs": {
+                        "conditioning": [region_encode_id, 0],
+                        "width": prompt_obj.coordinates.width,
+                        "height": prompt_obj.coordinates.height,
+                        "x": prompt_obj.coordinates.x,
+                        "y": prompt_obj.coordinates.y,
+                        "strength": 1.0,
+                    },
+                }
+            )
+
+        # Add ConditioningCombine to combine with the current conditioning
+        combine_id = graph.add_node(
+            {
+                "class_type": "ConditioningCombine",
                 "inputs": {
-                    "conditioning": [region_encode_id, 0],
-                    "width": prompt_obj.coordinates.width,
-                    "height": prompt_obj.coordinates.height,
-                    "x": prompt_obj.coordinates.x,
-                    "y": prompt_obj.coordinates.y,
-                    "strength": 1.0,
+                    "conditioning_1": current_cond,
+                    "conditioning_2": [conditioned_id, 0],
                 },
             }
-
-        # Add ConditioningCombine to combine with the current conditioning
-        combine_id = get_next_id()
-        workflow[combine_id] = {
-            "class_type": "ConditioningCombine",
-            "inputs": {
-                "conditioning_1": current_cond,
-                "conditioning_2": [conditioned_id, 0],
-            },
-        }
+        )
 
         # Update current conditioning to the new combine
         current_cond = [combine_id, 0]
 
     # Update the consumer's input to the final combined conditioning
-    workflow[consumer_id]["inputs"][consumer_key] = current_cond
+    graph.set_input(consumer_id, consumer_key, current_cond)
 
-    return workflow
+    return region_encode_ids
@@ -1,41 +1,32 @@
 from typing import Any
 
+from src.core.utils.workflow_graph import WorkflowGraph, as_graph
+
 
 def title_with_class_type_exists(
-    workflow: dict[str, Any], title: str, class_type: str
+    workflow: dict[str, Any] | WorkflowGraph, title: str, class_type: str
 ) -> bool:
-    target_title = title.strip()
-    for node_id, value in workflow.items():
-        # Check class_type first
-        node_class_type = value.get("class_type", "").strip()
-        if class_type == node_class_type:
-            # Then check title
-            node_title = value.get("_meta", {}).get("title", "").strip()
-            if target_title == node_title:
-                return True
-
-    return False
-
+    graph = as_graph(workflow)
+    return any(
+        graph.title_of(node_id) == title.strip()
+        for node_id in graph.node_ids_with_class(class_type)
+    )
 
-def get_title_from_class_type(workflow: dict[str, Any], class_type: str) -> list[str]:
-    res = []
-    for node_id, value in workflow.items():
-        node_class_type = value.get("class_type", "").strip()
-        if class_type == node_class_type:
-            node_title = value.get("_meta", {}).get("title", "").strip()
-            res.append(node_title)
 
-    return res
+def get_title_from_class_type(
+    workflow: dict[str, Any] | WorkflowGraph, class_type: str
+) -> list[str]:
+    graph = as_graph(workflow)
+    return [
+        graph.title_of(node_id) for node_id in graph.node_ids_with_class(class_type)
+    ]
 
 
 def get_title_from_class_type_that_contains(
-    workflow: dict[str, Any], contains_word: str
+    workflow: dict[str, Any] | WorkflowGraph, contains_word: str
 ) -> list[str]:
-    res = []
-    for node_id, value in workflow.items():
-        node_class_type = value.get("class_type", "").strip()
-        if contains_word in node_class_type:
-            node_title = value.get("_meta", {}).get("title", "").strip()
-            res.append(node_title)
-
-    return res
+    graph = as_graph(workflow)
+    return [
+        graph.title_of(node_id)
+        for node_id in graph.node_ids_with_class_containing(contains_word)
+    ]
@@ -0,0 +1,148 @@
+from itertools import groupby
+from typing import Any
+
+from src.core.utils.cow_workflow import CowWorkflow, as_cow
+
+# an output of a node, as (node_id, output_index)
+Link = tuple[str, int]
+
+
+def max_number_in(node_id: str) -> int:
+    """Returns the largest number written in a node id, 0 if it has none."""
+    if node_id.isdecimal():
+        return int(node_id)
+
+    numbers = [
+        int("".join(digits))
+        for is_number, digits in groupby(node_id, str.isdecimal)
+        if is_number
+    ]
+    return max(numbers, default=0)
+
+
+def as_link(value: Any) -> Link | None:
+    """Returns the output an input value is linked to, None for plain values."""
+    if (
+        isinstance(value, list)
+        and len(value) >= 2
+        and isinstance(value[0], str)
+        and isinstance(value[1], int)
+    ):
+        return (value[0], value[1])
+
+    return None
+
+
+class WorkflowGraph:
+    """
+    Indexes over the nodes of a workflow, built in one pass and kept up to
+    date while the workflow is changed through add_node, set_input and
+    redirect_output. The inputs of a node are its edges, the consumers index
+    holds them reversed. New node ids are numbers above every number found
+    in the existing ids, so they never collide.
+    """
+
+    def __init__(self, workflow: dict[str, Any]):
+        self.workflow: CowWorkflow = as_cow(workflow)
+        self._position: dict[str, int] = {}
+        self._node_ids_by_class: dict[str, list[str]] = {}
+        self._node_ids_by_title: dict[str, list[str]] = {}
+        self._consumers: dict[Link, list[tuple[str, str]]] = {}
+        self._max_id = 0
+        for node_id, node in self.workflow.items():
+            self._index_node(node_id, node)
+
+    def _index_node(self, node_id: str, node: dict[str, Any]):
+        self._position[node_id] = len(self._position)
+        class_type = node.get("class_type", "").strip()
+        self._node_ids_by_class.setdefault(class_type, []).append(node_id)
+        title = node.get("_meta", {}).get("title", "").strip()
+        self._node_ids_by_title.setdefault(title, []).append(node_id)
+        for input_key, input_value in node.get("inputs", {}).items():
+            self._add_consumer(input_value, node_id, input_key)
+        self._max_id = max(self._max_id, max_number_in(str(node_id)))
+
+    def _add_consumer(self, input_value: Any, node_id: str, input_key: str):
+        link = as_link(input_value)
+        if link is not None:
+            self._consumers.setdefault(link, []).append((node_id, input_key))
+
+    def _in_order(self, node_ids: list[str]) -> list[str]:
+        return sorted(node_ids, key=self._position.__getitem__)
+
+    @property
+    def max_node_id(self) -> int:
+        return self._max_id
+
+    def node_ids_with_class(self, *class_types: str) -> list[str]:
+        """Returns the ids of the nodes of any of the classes in workflow order."""
+        return self._in_order(
+            [
+                node_id
+                for class_type in class_types
+                for node_id in self._node_ids_by_class.get(class_type.strip(), [])
+            ]
+        )
+
+    def node_ids_with_class_containing(self, word: str) -> list[str]:
+        return self._in_order(
+            [
+                node_id
+                for class_type, node_ids in self._node_ids_by_class.items()
+                if word in class_type
+                for node_id in node_ids
+            ]
+        )
+
+    def node_ids_with_title(self, title: str) -> list[str]:
+        return list(self._node_ids_by_title.get(title.strip(), []))
+
+    def title_of(self, node_id: str) -> str:
+        return self.workflow[node_id].get("_meta", {}).get("title", "").strip()
+
+    def consumers(self, source_id: str, output_index: int) -> list[tuple[str, str]]:
+        """Returns the (node_id, input_key) pairs linked to an output."""
+        return list(self._consumers.get((source_id, output_index), []))
+
+    def new_node_id(self) -> str:
+        self._max_id += 1
+        return str(self._max_id)
+
+    def add_node(self, node: dict[str, Any], node_id: str | None = None) -> str:
+        """Adds a node under a new id, or under one taken from new_node_id."""
+        if node_id is None:
+            node_id = self.new_node_id()
+        self.workflow[node_id] = node
+        self._index_node(node_id, node)
+        return node_id
+
+    def set_input(self, node_id: str, input_key: str, value: Any):
+        node = self.workflow.edit(node_id)
+        old_link = as_link(node["inputs"].get(input_key))
+        if old_link is not None:
+            self._consumers[old_link].remove((node_id, input_key))
+
+        node["inputs"][input_key] = value
+        self._add_consumer(value, node_id, input_key)
+
+    def redirect_output(self, source_id: str, output_index: int, new_source_id: str):
+        """Links every consumer of an output to the same output of another node."""
+        consumers = self._consumers.pop((source_id, output_index), [])
+        for node_id, input_key in consumers:
+            self.workflow.edit(node_id)["inputs"][input_key] = [
+                new_source_id,
+                output_index,
+            ]
+
+        if consumers:
+            self._consumers.setdefault((new_source_id, output_index), []).extend(
+                consumers
+            )
+
+
+def as_graph(workflow: dict[str, Any] | WorkflowGraph) -> WorkflowGraph:
+    """Returns the graph as is, or indexes a workflow dict."""
+    if isinstance(workflow, WorkflowGraph):
+        return workflow
+
+    return WorkflowGraph(workflow)
@@ -3,6 +3,8 @@
 
 from tortoise import Tortoise
 
+from src.db.migrations import migrate_db
+
 
 async def init_db(filepath: str) -> None:
     await Tortoise.init(
@@ -14,6 +16,7 @@ async def init_db(filepath: str) -> None:
         },
     )
     await Tortoise.generate_schemas()
+    await migrate_db()
 
 
 async def close_db() -> None:
@@ -0,0 +1,104 @@
+import json
+
+from tortoise import Tortoise
+from tortoise.backends.base.client import BaseDBAsyncClient
+from tortoise.transactions import in_transaction
+
+from src.controllers.blob_store import store_blobs
+from src.db.records.job_rec import JOB_BLOB_FIELDS
+
+# columns added to the records after their tables were first created, as
+# (table, column, definition). generate_schemas only creates the missing
+# tables, so the databases that already exist get them with ALTER TABLE.
+ADDED_COLUMNS = [
+    ("generatorrecord", "version", "INT NOT NULL DEFAULT 1"),
+    ("fixerrecord", "version", "INT NOT NULL DEFAULT 1"),
+    ("jobrecord", "server_pool", "JSON"),
+    ("jobrecord", "lease_expires_at", "TIMESTAMP"),
+    ("jobrecord", "render_seconds", "REAL"),
+    ("jobrecord", "compiled_prompt", "BLOB"),
+    ("jobrecord", "compiled_version", "INT"),
+    ("jobrecord", "group_item_id_list_ref", "VARCHAR(64) NOT NULL DEFAULT ''"),
+    ("jobrecord", "code_str_ref", "VARCHAR(64) NOT NULL DEFAULT ''"),
+    ("jobrecord", "region_prompts_ref", "VARCHAR(64)"),
+    ("jobrecord", "ipadapter_list_ref", "VARCHAR(64)"),
+    ("jobrecord", "lora_list_ref", "VARCHAR(64)"),
+]
+# how many jobs have their JSON moved to the blobs at once
+MOVE_BATCH_SIZE = 1000
+
+
+async def table_columns(conn: BaseDBAsyncClient, table: str) -> set[str]:
+    _, rows = await conn.execute_query(f'PRAGMA table_info("{table}")')
+    return {row["name"] for row in rows}
+
+
+async def add_missing_columns(conn: BaseDBAsyncClient):
+    columns_by_table: dict[str, set[str]] = {}
+    for table, column, definition in ADDED_COLUMNS:
+        if table not in columns_by_table:
+            columns_by_table[table] = await table_columns(conn, table)
+
+        if column not in columns_by_table[table]:
+            print("Adding column", column, "to", table)
+            await conn.execute_query(
+                f'ALTER TABLE "{table}" ADD COLUMN "{column}" {definition}'
+            )
+            columns_by_table[table].add(column)
+
+
+async def move_job_blobs():
+    """
+    Moves the JSON that older versions kept in the columns of the jobs to
+    BlobRecord, sets the references to it and drops the old columns.
+    """
+    columns = await table_columns(Tortoise.get_connection("default"), "jobrecord")
+    if not all(name in columns for name in JOB_BLOB_FIELDS):
+        return
+
+    print("Moving the JSON of the jobs to the blobs")
+    select = (
+        "SELECT "
+        + ", ".join(f'"{name}"' for name in ("id",) + JOB_BLOB_FIELDS)
+        + ' FROM "jobrecord" WHERE "id" > ? ORDER BY "id" LIMIT ?'
+    )
+    update = (
+        'UPDATE "jobrecord" SET '
+        + ", ".join(f'"{name}_ref" = ?' for name in JOB_BLOB_FIELDS)
+        + ' WHERE "id" = ?'
+    )
+    async with in_transaction() as conn:
+        last_id = 0
+        while True:
+            _, rows = await conn.execute_query(select, [last_id, MOVE_BATCH_SIZE])
+            if len(rows) == 0:
+                break
+
+            # code_str was a text column, the others held JSON
+            values = [
+                row[name]
+                if name == "code_str" or row[name] is None
+                else json.loads(row[name])
+                for row in rows
+                for name in JOB_BLOB_FIELDS
+            ]
+            refs = await store_blobs(values, conn)
+            width = len(JOB_BLOB_FIELDS)
+            await conn.execute_many(
+                update,
+                [
+                    refs[i * width : (i + 1) * width] + [row["id"]]
+                    for i, row in enumerate(rows)
+                ],
+            )
+            last_id = rows[-1]["id"]
+
+        for name in JOB_BLOB_FIELDS:
+            await conn.execute_query(f'ALTER TABLE "jobrecord" DROP COLUMN "{name}"')
+
+
+async def migrate_db():
+    """Brings the tables of a database made by an older version up to date."""
+    conn = Tortoise.get_connection("default")
+    await add_missing_columns(conn)
+    await move_job_blobs()
@@ -1,3 +1,4 @@
+from .blob_rec import BlobRecord
 from .category_rec import CategoryRecord
 from .command_rec import CommandRecord
 from .fixer_rec import FixerRecord
@@ -18,4 +19,5 @@ __all__ = [
     "ServerRecord",
     "GeneratorRecord",
     "FixerRecord",
+    "BlobRecord",
 ]
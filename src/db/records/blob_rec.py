@@ -0,0 +1,8 @@
+from tortoise import fields
+from tortoise.models import Model
+
+
+class BlobRecord(Model):
+    # the sha256 of data, rows reference the blob by it
+    hash = fields.CharField(max_length=64, primary_key=True)
+    data = fields.TextField()  # JSON
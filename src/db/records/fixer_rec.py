@@ -15,3 +15,5 @@ class FixerRecord(TimestampMixin, Model):
     load_image_title = fields.TextField()
     save_image_title = fields.TextField()
     workflow_json = fields.JSONField()
+    # bumped on every edit, so compiled workflows know they are stale
+    version = fields.IntField(default=1)
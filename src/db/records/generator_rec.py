@@ -13,3 +13,5 @@ class GeneratorRecord(TimestampMixin, Model):
     load_image_controlnet_title = fields.TextField(null=True)
     save_image_title = fields.TextField()
     workflow_json = fields.JSONField()
+    # bumped on every edit, so compiled workflows know they are stale
+    version = fields.IntField(default=1)
@@ -10,6 +10,7 @@ from src.db.records.common import TimestampMixin
 
 class JobStatus(enum.StrEnum):
     WAITING = "waiting"
+    QUEUED = "queued"
     PROCESSING = "processing"
     FINISHED = "finished"
 
@@ -30,25 +31,49 @@ class RegionPrompt:
     prompt: str
 
 
+# the job values that are stored in BlobRecord, each in the field <name>_ref
+JOB_BLOB_FIELDS = (
+    "group_item_id_list",
+    "code_str",
+    "region_prompts",
+    "ipadapter_list",
+    "lora_list",
+)
+
+
 class JobRecord(TimestampMixin, Model):
     id = fields.IntField(primary_key=True)
     project_id = fields.IntField()
     command_id = fields.IntField()
-    group_item_id_list = fields.JSONField()
-    code_str = fields.TextField()
+    # the JSON that many jobs repeat is stored once as a BlobRecord and
+    # referenced by its hash, hydrate_jobs sets the values without _ref
+    group_item_id_list_ref = fields.CharField(max_length=64)
+    code_str_ref = fields.CharField(max_length=64)
     server_code_name = fields.CharField(max_length=100)
     server_host = fields.CharField(max_length=100)
+    server_pool = fields.JSONField(null=True, default=None)  # list[str]
     status = fields.CharEnumField(enum_type=JobStatus, default=JobStatus.WAITING)
     generator_code_name = fields.CharField(max_length=100, null=True)
     fixer_code_name = fields.CharField(max_length=100, null=True)
     fix_job_id = fields.IntField(null=True)
+    # set while a server owns the job, renewed by the manager's heartbeat
+    lease_expires_at = fields.DatetimeField(null=True, default=None)
     comfyui_prompt_id = fields.CharField(max_length=200, null=True, default=None)
     prompt_positive = fields.TextField()
     prompt_negative = fields.TextField()
-    region_prompts = fields.JSONField(
-        null=True, default=None
-    )  # dict[str, RegionPrompt]
+    region_prompts_ref = fields.CharField(max_length=64, null=True, default=None)
     reference_controlnet_img = fields.TextField(null=True)
-    ipadapter_list = fields.JSONField(null=True)
-    lora_list = fields.JSONField(null=True)
+    ipadapter_list_ref = fields.CharField(max_length=64, null=True, default=None)
+    lora_list_ref = fields.CharField(max_length=64, null=True, default=None)
     result_img = fields.TextField()
+    render_seconds = fields.FloatField(null=True, default=None)
+    # the zlib compressed prompt JSON built when the job was created, with the
+    # version of the generator or fixer it was built from
+    compiled_prompt = fields.BinaryField(null=True, default=None)
+    compiled_version = fields.IntField(null=True, default=None)
+
+    group_item_id_list: list[dict[str, Any]]
+    code_str: str
+    region_prompts: dict[str, Any] | None  # dict[str, RegionPrompt]
+    ipadapter_list: list[dict[str, Any]] | None
+    lora_list: list[dict[str, Any]] | None
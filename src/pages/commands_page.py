@@ -14,6 +14,7 @@ from src.controllers.command_ctrl.command_ctrl import (
     recreate_command,
     run_command,
 )
+from src.controllers.command_ctrl.command_estimator import estimate_command
 from src.controllers.group_ctrl import edit_group
 from src.controllers.manager_ctrl import Manager
 from src.controllers.project_ctrl import ProjectOutput, get_project
@@ -43,26 +44,45 @@ class CommandsPage:
 
             code_input = ui.textarea("Code").props("outlined")
             error_label = ui.label("").classes("text-red-600")
+            progress_label = ui.label("")
+            estimate_label = ui.label("").style("white-space: pre-line")
             with ui.row():
                 ui.button("Cancel", on_click=dialog.close)
+                ui.button(
+                    "Estimate",
+                    on_click=lambda: self.handle_estimate(
+                        code_input.value,
+                        error_label,
+                        estimate_label,
+                    ),
+                )
                 ui.button(
                     "Create",
                     on_click=lambda: self.handle_create(
                         dialog,
                         code_input.value,
                         error_label,
+                        progress_label,
                     ),
                 ).props("color=primary")
 
         dialog.open()
 
-    async def handle_create(self, dialog, code: str, error_label: Label):
+    async def handle_create(
+        self, dialog, code: str, error_label: Label, progress_label: Label
+    ):
         input = CommandInput(
             project_id=self.project.id,
             code=code,
         )
 
-        errors = await add_command(self.conf, input)
+        errors = await add_command(
+            self.conf,
+            input,
+            on_progress=lambda created, total: progress_label.set_text(
+                f"Created {created}/{total} jobs"
+            ),
+        )
         if errors is not None:
             ui.notify("Command didn't created", type="negative")
             error_label.set_text(str(errors))
@@ -71,6 +91,32 @@ class CommandsPage:
         ui.notify("Command created successfully", type="positive")
         dialog.close()
 
+    async def handle_estimate(
+        self, code: str, error_label: Label, estimate_label: Label
+    ):
+        try:
+            estimate = await estimate_command(code)
+        except ValueError as e:
+            error_label.set_text(str(e))
+            estimate_label.set_text("")
+            return
+
+        error_label.set_text("")
+        lines = [
+            f"Jobs: {estimate.total_jobs} "
+            f"({estimate.generator_jobs} generator, {estimate.fixer_jobs} fixer)",
+            f"Region combinations: {estimate.region_combinations}",
+        ]
+        for server in estimate.servers:
+            lines.append(
+                f"{server.server_code_name}: "
+                f"{format_seconds(server.estimated_seconds)}"
+            )
+        if len(estimate.servers) > 1:
+            lines.append(f"Pool: {format_seconds(estimate.estimated_seconds)}")
+
+        estimate_label.set_text("\n".join(lines))
+
     async def show_edit_dialog(self, item):
         with ui.dialog() as dialog, ui.card():
             ui.label("Edit Command").classes("text-h6")
@@ -79,9 +125,19 @@ class CommandsPage:
                 "outlined"
             )
             error_label = ui.label("").classes("text-red-600")
+            progress_label = ui.label("")
+            estimate_label = ui.label("").style("white-space: pre-line")
 
             with ui.row():
                 ui.button("Cancel", on_click=dialog.close)
+                ui.button(
+                    "Estimate",
+                    on_click=lambda: self.handle_estimate(
+                        code_input.value,
+                        error_label,
+                        estimate_label,
+                    ),
+                )
                 ui.button(
                     "Update",
                     on_click=lambda: self.handle_update(
@@ -89,6 +145,7 @@ class CommandsPage:
                         item["id"],
                         code_input.value,
                         error_label,
+                        progress_label,
                     ),
                 ).props("color=primary")
 
@@ -100,13 +157,21 @@ class CommandsPage:
         item_id,
         code: str,
         error_label,
+        progress_label,
     ):
         input = CommandInput(
             project_id=self.project.id,
             code=code,
         )
 
-        errors = await edit_command(self.conf, item_id, input)
+        errors = await edit_command(
+            self.conf,
+            item_id,
+            input,
+            on_progress=lambda created, total: progress_label.set_text(
+                f"Created {created}/{total} jobs"
+            ),
+        )
         if errors is not None:
             ui.notify("Command didn't update", type="negative")
             error_label.set_text(str(errors))
@@ -205,6 +270,15 @@ class CommandsPage:
         await table()
 
 
+def format_seconds(seconds: float | None) -> str:
+    if seconds is None:
+        return "no finished jobs to estimate from"
+
+    hours, rest = divmod(int(seconds), 3600)
+    minutes, secs = divmod(rest, 60)
+    return f"{hours}h {minutes}m {secs}s"
+
+
 def init(conf: Config, manager: Manager | None):
     @ui.page("/projects/{project_id}/commands")
     async def page(project_id: int):
@@ -9,6 +9,7 @@ from src.controllers.ctrl_types import FixerInput
 from src.controllers.fixer_ctrl import add_fixer, delete_fixer, edit_fixer, list_fixers
 from src.core.utils import get_title_from_class_type
 from src.core.utils.utils import get_title_from_class_type_that_contains
+from src.core.utils.workflow_graph import WorkflowGraph
 from src.pages.common.nav_menu import common_nav_menu
 
 
@@ -49,23 +50,20 @@ class FixersPage:
             async def handle_upload(event: UploadEventArguments):
                 nonlocal workflow_json
                 workflow_json = await event.file.json()
-                save_image_titles = get_title_from_class_type(
-                    workflow_json, "SaveImage"
-                )
+                graph = WorkflowGraph(workflow_json)
+                save_image_titles = get_title_from_class_type(graph, "SaveImage")
                 if len(save_image_titles) > 0:
                     save_image_title_input.value = save_image_titles[
                         len(save_image_titles) - 1
                     ]
 
-                load_image_titles = get_title_from_class_type(
-                    workflow_json, "LoadImage"
-                )
+                load_image_titles = get_title_from_class_type(graph, "LoadImage")
 
                 if len(load_image_titles) == 1:
                     load_image_title_input.value = load_image_titles[0]
 
                 prompt_titles = get_title_from_class_type_that_contains(
-                    workflow_json, "TextEncode"
+                    graph, "TextEncode"
                 )
                 for title in prompt_titles:
                     low_title = title.lower()
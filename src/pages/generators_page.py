@@ -14,6 +14,7 @@ from src.controllers.generator_ctrl import (
 )
 from src.core.utils import get_title_from_class_type
 from src.core.utils.utils import get_title_from_class_type_that_contains
+from src.core.utils.workflow_graph import WorkflowGraph
 from src.pages.common.nav_menu import common_nav_menu
 
 
@@ -53,17 +54,14 @@ class GeneratorsPage:
             async def handle_upload(event: UploadEventArguments):
                 nonlocal workflow_json
                 workflow_json = await event.file.json()
-                save_image_titles = get_title_from_class_type(
-                    workflow_json, "SaveImage"
-                )
+                graph = WorkflowGraph(workflow_json)
+                save_image_titles = get_title_from_class_type(graph, "SaveImage")
                 if len(save_image_titles) > 0:
                     save_image_title_input.value = save_image_titles[
                         len(save_image_titles) - 1
                     ]
 
-                load_image_titles = get_title_from_class_type(
-                    workflow_json, "LoadImage"
-                )
+                load_image_titles = get_title_from_class_type(graph, "LoadImage")
 
                 for title in load_image_titles:
                     low_title = title.lower()
@@ -71,7 +69,7 @@ class GeneratorsPage:
                         load_image_controlnet_title_input.value = title
 
                 prompt_titles = get_title_from_class_type_that_contains(
-                    workflow_json, "TextEncode"
+                    graph, "TextEncode"
                 )
                 for title in prompt_titles:
                     low_title = title.lower()
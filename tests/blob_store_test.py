@@ -0,0 +1,126 @@
+import asyncio
+from dataclasses import asdict
+
+from tortoise import Tortoise
+
+from src.controllers import blob_store
+from src.controllers.blob_store import (
+    delete_unused_blobs,
+    hydrate_jobs,
+    store_job_blobs,
+)
+from src.db.records import BlobRecord, JobRecord
+from src.db.records.job_rec import CoordinatedRegion, RegionPrompt
+
+LORA_LIST = [{"name": "a.safetensors", "strength_model": 1.0, "strength_clip": 1.0}]
+REGION_PROMPTS = {
+    "left": RegionPrompt(
+        keyword="left",
+        mask_file=None,
+        coordinates=CoordinatedRegion(width=64, height=64, x=0, y=0),
+        prompt="a cat",
+    )
+}
+
+
+def job_input(item_id: int, code_str: str = "s1 -$ gen: chars") -> dict:
+    return dict(
+        project_id=1,
+        command_id=1,
+        group_item_id_list=[{"group_id": 1, "item_id": item_id}],
+        code_str=code_str,
+        server_code_name="s1",
+        server_host="s1",
+        generator_code_name="gen",
+        prompt_positive="",
+        prompt_negative="",
+        region_prompts=REGION_PROMPTS,
+        ipadapter_list=None,
+        lora_list=LORA_LIST,
+        result_img=f"/tmp/{item_id}.png",
+    )
+
+
+async def create_jobs(job_inputs: list[dict]) -> list[JobRecord]:
+    await store_job_blobs(job_inputs)
+    return [await JobRecord.create(**job_input) for job_input in job_inputs]
+
+
+def run_with_db(scenario):
+    async def run():
+        await Tortoise.init(
+            db_url="sqlite://:memory:", modules={"models": ["src.db.records"]}
+        )
+        await Tortoise.generate_schemas()
+        blob_store._blobs.clear()
+        try:
+            await scenario()
+        finally:
+            await Tortoise.close_connections()
+
+    asyncio.run(run())
+
+
+def test_jobs_are_hydrated_from_their_blobs():
+    async def scenario():
+        jobs = await create_jobs([job_input(1), job_input(2)])
+        blob_store._blobs.clear()
+
+        loaded = await hydrate_jobs(await JobRecord.all().order_by("id"))
+        assert [job.id for job in loaded] == [job.id for job in jobs]
+        assert loaded[1].group_item_id_list == [{"group_id": 1, "item_id": 2}]
+        assert loaded[1].code_str == "s1 -$ gen: chars"
+        assert loaded[1].region_prompts == {"left": asdict(REGION_PROMPTS["left"])}
+        assert loaded[1].ipadapter_list is None
+        assert loaded[1].lora_list == LORA_LIST
+
+    run_with_db(scenario)
+
+
+def test_repeated_values_are_stored_once():
+    async def scenario():
+        jobs = await create_jobs([job_input(1), job_input(2), job_input(2)])
+        assert jobs[0].code_str_ref == jobs[1].code_str_ref
+        assert jobs[0].lora_list_ref == jobs[2].lora_list_ref
+        assert jobs[1].group_item_id_list_ref == jobs[2].group_item_id_list_ref
+        assert jobs[0].group_item_id_list_ref != jobs[1].group_item_id_list_ref
+        # two item lists, the code, the region prompts and the LoRAs
+        assert await BlobRecord.all().count() == 5
+
+        # values that are stored already are not stored again
+        await create_jobs([job_input(1)])
+        assert await BlobRecord.all().count() == 5
+
+    run_with_db(scenario)
+
+
+def test_unused_blobs_are_deleted():
+    async def scenario():
+        kept, deleted = await create_jobs(
+            [job_input(1), job_input(2, code_str="s1 -$ gen: poses")]
+        )
+        await deleted.delete()
+        await delete_unused_blobs()
+
+        refs = [kept.group_item_id_list_ref, kept.code_str_ref]
+        refs += [kept.region_prompts_ref, kept.lora_list_ref]
+        stored = await BlobRecord.all().values_list("hash", flat=True)
+        assert sorted(stored) == sorted(refs)
+
+        (job,) = await hydrate_jobs([await JobRecord.get(id=kept.id)])
+        assert job.group_item_id_list == [{"group_id": 1, "item_id": 1}]
+
+    run_with_db(scenario)
+
+
+def test_missing_blobs_are_hydrated_as_none():
+    async def scenario():
+        (job,) = await create_jobs([job_input(1)])
+        await BlobRecord.filter(hash=job.lora_list_ref).delete()
+        blob_store._blobs.clear()
+
+        (job,) = await hydrate_jobs([await JobRecord.get(id=job.id)])
+        assert job.lora_list is None
+        assert job.code_str == "s1 -$ gen: chars"
+
+    run_with_db(scenario)
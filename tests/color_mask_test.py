@@ -1,4 +1,8 @@
 import os
+import time
+
+import cv2
+import numpy as np
 
 from src.core.utils.auto_masking import auto_create_masks
 
@@ -22,3 +26,31 @@ def test_create_conditioning_masks():
         assert k == "person_" + str(count)
         assert os.path.exists(v)
         count += 1
+
+
+def test_color_masks_benchmark():
+    img = cv2.imread("tests/testdata/color-mask.png")
+    big = cv2.resize(img, (3840, 2160), interpolation=cv2.INTER_NEAREST)
+    cv2.imwrite("/tmp/color-mask-4k.png", big)
+
+    start = time.perf_counter()
+    mask_paths = auto_create_masks("/tmp/color-mask-4k.png", "/tmp/masks-4k")
+    print(f"color masks of a 4k image in {time.perf_counter() - start:.3f}s")
+
+    assert set(mask_paths.keys()) == {"red", "blue", "background"}
+    red_mask = cv2.imread(mask_paths["red"], cv2.IMREAD_GRAYSCALE)
+    assert (red_mask == 255).sum() == np.all(big == (255, 0, 0), axis=-1).sum()
+
+
+def test_antialiased_color_masks():
+    img = np.full((540, 960, 3), 255, np.uint8)
+    cv2.circle(img, (250, 250), 150, (255, 0, 0), -1, lineType=cv2.LINE_AA)
+    cv2.circle(img, (650, 300), 180, (0, 0, 255), -1, lineType=cv2.LINE_AA)
+    cv2.imwrite("/tmp/antialiased-mask.jpg", img, [cv2.IMWRITE_JPEG_QUALITY, 80])
+
+    mask_paths = auto_create_masks("/tmp/antialiased-mask.jpg", "/tmp/masks-aa")
+    assert set(mask_paths.keys()) == {"red", "blue", "background"}
+
+    # every pixel belongs to exactly one mask
+    masks = [cv2.imread(p, cv2.IMREAD_GRAYSCALE) == 255 for p in mask_paths.values()]
+    assert (np.sum(masks, axis=0) == 1).all()
@@ -0,0 +1,413 @@
+import asyncio
+import json
+
+import pytest
+from tortoise import Tortoise
+
+from src.controllers.blob_store import hydrate_jobs
+from src.controllers.command_ctrl import command_ctrl
+from src.controllers.command_ctrl.command_ctrl import (
+    CommandInput,
+    add_command,
+    fixer_result_img,
+)
+from src.controllers.command_ctrl.command_estimator import estimate_command
+from src.controllers.command_ctrl.command_parser import PromptLanguageParser
+from src.controllers.command_ctrl.command_validator import validate_code_names
+from src.controllers.manager_ctrl import build_fixer_prompt, build_generator_prompt
+from src.controllers.prompt_builder import decompress_prompt
+from src.controllers.workflow_templates import (
+    invalidate_fixer_template,
+    invalidate_generator_template,
+)
+from src.core.config import Config
+from src.core.executors import shutdown_executors
+from src.db.records import (
+    FixerRecord,
+    GeneratorRecord,
+    GroupRecord,
+    ItemRecord,
+    JobRecord,
+    ServerRecord,
+)
+from src.db.records.job_rec import JobStatus
+
+WORKFLOW = {
+    "3": {
+        "class_type": "KSampler",
+        "inputs": {
+            "model": ["4", 0],
+            "positive": ["6", 0],
+            "negative": ["7", 0],
+            "latent_image": ["5", 0],
+        },
+        "_meta": {"title": "KSampler"},
+    },
+    "4": {
+        "class_type": "CheckpointLoaderSimple",
+        "inputs": {"ckpt_name": "model.safetensors"},
+        "_meta": {"title": "Load Checkpoint"},
+    },
+    "5": {
+        "class_type": "EmptyLatentImage",
+        "inputs": {"width": 512, "height": 512},
+        "_meta": {"title": "Empty Latent Image"},
+    },
+    "6": {
+        "class_type": "CLIPTextEncode",
+        "inputs": {"text": "", "clip": ["4", 1]},
+        "_meta": {"title": "positive"},
+    },
+    "7": {
+        "class_type": "CLIPTextEncode",
+        "inputs": {"text": "", "clip": ["4", 1]},
+        "_meta": {"title": "negative"},
+    },
+    "8": {
+        "class_type": "VAEDecode",
+        "inputs": {"samples": ["3", 0], "vae": ["4", 2]},
+        "_meta": {"title": "VAE Decode"},
+    },
+    "9": {
+        "class_type": "SaveImage",
+        "inputs": {"images": ["8", 0], "filename_prefix": "scene"},
+        "_meta": {"title": "save"},
+    },
+    "10": {
+        "class_type": "LoadImage",
+        "inputs": {"image": ""},
+        "_meta": {"title": "load"},
+    },
+}
+
+# LoRAs, IPAdapters and ControlNet references with a fixer chain
+CHAIN_COMMAND = "s1 -$ gen: chars * poses * emo > fix > fix"
+# coordinated regions with a fixer
+REGION_COMMAND = "s1 -$ gen: reg{left: chars * emo, right: poses} * emo(emo1) > fix"
+
+
+async def seed_scene():
+    """Adds the servers, the generator, the fixer and the groups of a scene."""
+    for code_name in ["s1", "s2", "s3"]:
+        await ServerRecord.create(
+            name=code_name, host=code_name, code_name=code_name, is_local=True
+        )
+    await GeneratorRecord.create(
+        name="gen",
+        code_name="gen",
+        positive_prompt_title="positive",
+        negative_prompt_title="negative",
+        load_image_controlnet_title="load",
+        save_image_title="save",
+        workflow_json=WORKFLOW,
+    )
+    await FixerRecord.create(
+        name="fix",
+        code_name="fix",
+        load_image_title="load",
+        save_image_title="save",
+        workflow_json=WORKFLOW,
+    )
+
+    for code_name, count in [("chars", 4), ("poses", 3), ("emo", 2)]:
+        group = await GroupRecord.create(
+            name=code_name,
+            description="",
+            code_name=code_name,
+            use_controlnet=code_name == "emo",
+            use_ip_adapter=code_name == "poses",
+            use_mask_region=False,
+            use_coordinates_region=False,
+            use_lora=code_name == "chars",
+        )
+        for i in range(count):
+            await ItemRecord.create(
+                group_id=group.id,
+                name=f"{code_name}{i}",
+                code_name=f"{code_name}{i}",
+                positive_prompt=f"{code_name} {i}",
+                negative_prompt=f"not {code_name} {i}" if i % 2 else "",
+                lora={
+                    "name": f"{code_name}{i}.safetensors",
+                    "strength_model": 1.0,
+                    "strength_clip": 1.0,
+                }
+                if code_name == "chars"
+                else None,
+                ipadapter={
+                    "image_file": "/tmp/pose.png",
+                    "weight": 1.0,
+                    "weight_type": "linear",
+                    "start_at": 0.0,
+                    "end_at": 1.0,
+                    "clip_vision_model": "clip_vision.safetensors",
+                    "model_name": "ipadapter.safetensors",
+                }
+                if code_name == "poses" and i == 0
+                else None,
+                controlnet_reference_image=f"/tmp/{code_name}{i}.png"
+                if code_name == "emo"
+                else None,
+            )
+
+    group = await GroupRecord.create(
+        name="reg",
+        description="",
+        code_name="reg",
+        use_controlnet=False,
+        use_ip_adapter=False,
+        use_mask_region=False,
+        use_coordinates_region=True,
+        use_lora=False,
+    )
+    await ItemRecord.create(
+        group_id=group.id,
+        name="halves",
+        code_name="halves",
+        positive_prompt="",
+        negative_prompt="",
+        coordinated_regions=[
+            {"keyword": "left", "width": 256, "height": 512, "x": 0, "y": 0},
+            {"keyword": "right", "width": 256, "height": 512, "x": 256, "y": 0},
+        ],
+    )
+
+
+def config(tmp_path, precompile_prompts: bool = False) -> Config:
+    return Config(
+        db_path="",
+        result_path=str(tmp_path),
+        controlnet_references_path="",
+        ipadapter_references_path="",
+        colored_region_path="",
+        thumbnails_path="",
+        precompile_prompts=precompile_prompts,
+    )
+
+
+def run_with_scene(scenario):
+    async def run():
+        await Tortoise.init(
+            db_url="sqlite://:memory:", modules={"models": ["src.db.records"]}
+        )
+        await Tortoise.generate_schemas()
+        await seed_scene()
+        # the templates of another test can have the same ids and versions
+        invalidate_generator_template(1)
+        invalidate_fixer_template(1)
+        try:
+            await scenario()
+        finally:
+            shutdown_executors()
+            await Tortoise.close_connections()
+
+    asyncio.run(run())
+
+
+async def build_prompt(job: JobRecord) -> dict:
+    if job.generator_code_name is not None:
+        prompt = await build_generator_prompt(job)
+    else:
+        prompt = await build_fixer_prompt(job)
+    assert prompt is not None
+    return json.loads(json.dumps(prompt))
+
+
+def test_precompiled_prompts_match_the_dispatched_ones(tmp_path):
+    async def scenario():
+        conf = config(tmp_path, precompile_prompts=True)
+        for code in [CHAIN_COMMAND, REGION_COMMAND]:
+            await add_command(conf, CommandInput(project_id=1, code=code))
+
+        jobs = await JobRecord.all().order_by("id")
+        assert len(jobs) == 4 * 3 * 2 * 3 + 4 * 2 * 3 * 2
+        for job in jobs:
+            assert job.compiled_prompt is not None
+            compiled = decompress_prompt(job.compiled_prompt)
+            job.compiled_prompt = None
+            assert compiled == await build_prompt(job)
+
+        # the prompts were built with every kind of injected node
+        jobs = await hydrate_jobs(jobs)
+        assert any(job.lora_list for job in jobs)
+        assert any(job.ipadapter_list for job in jobs)
+        assert any(job.region_prompts for job in jobs)
+        assert any(job.fix_job_id is not None for job in jobs)
+
+    run_with_scene(scenario)
+
+
+def test_stale_compiled_prompts_are_built_again(tmp_path):
+    async def scenario():
+        conf = config(tmp_path, precompile_prompts=True)
+        code = "s1 -$ gen: chars > fix"
+        await add_command(conf, CommandInput(project_id=1, code=code))
+
+        for record in [
+            await GeneratorRecord.get(code_name="gen"),
+            await FixerRecord.get(code_name="fix"),
+        ]:
+            record.workflow_json["9"]["inputs"]["filename_prefix"] = "edited"
+            record.version += 1
+            await record.save()
+
+        jobs = await JobRecord.all().order_by("id")
+        assert len(jobs) == 8
+        for job in jobs:
+            assert job.compiled_version == 1
+            prompt = await build_prompt(job)
+            assert prompt["9"]["inputs"]["filename_prefix"] == "edited"
+
+    run_with_scene(scenario)
+
+
+def test_fixer_jobs_point_to_their_parent_jobs(tmp_path, monkeypatch):
+    async def scenario():
+        conf = config(tmp_path)
+        code = "s1 -$ gen: chars * poses"
+        await add_command(conf, CommandInput(project_id=1, code=code))
+        # the highest ids are free again and the chunks end inside a command
+        old_jobs = await JobRecord.all().order_by("-id").limit(5)
+        await JobRecord.filter(id__in=[job.id for job in old_jobs]).delete()
+        kept = await JobRecord.all().count()
+        monkeypatch.setattr(command_ctrl, "JOBS_CHUNK_SIZE", 5)
+
+        await add_command(conf, CommandInput(project_id=1, code=CHAIN_COMMAND))
+
+        fixer = await FixerRecord.get(code_name="fix")
+        jobs = {job.id: job for job in await JobRecord.filter(command_id=2)}
+        assert len(jobs) == 4 * 3 * 2 * 3
+        assert await JobRecord.all().count() == kept + len(jobs)
+        generated = [job for job in jobs.values() if job.fix_job_id is None]
+        assert all(job.generator_code_name == "gen" for job in generated)
+        for job in generated:
+            # each generated image is fixed twice, each fix by a single job
+            first = [j for j in jobs.values() if j.fix_job_id == job.id]
+            assert len(first) == 1
+            second = [j for j in jobs.values() if j.fix_job_id == first[0].id]
+            assert len(second) == 1
+            assert first[0].result_img == fixer_result_img(conf, fixer, job.result_img)
+            assert second[0].result_img == fixer_result_img(
+                conf, fixer, first[0].result_img
+            )
+            assert first[0].group_item_id_list_ref == job.group_item_id_list_ref
+
+    run_with_scene(scenario)
+
+
+def test_estimate_counts_the_jobs_that_are_created(tmp_path):
+    async def scenario():
+        conf = config(tmp_path)
+        codes = [
+            CHAIN_COMMAND,
+            REGION_COMMAND,
+            "s1 and s2 -$ gen: chars(~chars0) * reg{left: poses(poses1), "
+            + "right: emo} > fix",
+            "s2 -$ gen: chars(chars1, chars2) * emo",
+        ]
+        for command_id, code in enumerate(codes, start=1):
+            estimate = await estimate_command(code)
+            await add_command(conf, CommandInput(project_id=1, code=code))
+
+            jobs = await JobRecord.filter(command_id=command_id)
+            generated = [job for job in jobs if job.fix_job_id is None]
+            assert estimate.generator_jobs == len(generated)
+            assert estimate.fixer_jobs == len(jobs) - len(generated)
+            assert estimate.total_jobs == len(jobs)
+
+        assert (await estimate_command(REGION_COMMAND)).region_combinations == 8 * 3
+
+    run_with_scene(scenario)
+
+
+def test_estimate_uses_the_average_render_times(tmp_path):
+    async def scenario():
+        finished = [
+            ("s1", "gen", None, 10.0),
+            ("s1", "gen", None, 20.0),
+            ("s1", None, "fix", 4.0),
+            ("s2", "gen", None, 30.0),
+        ]
+        for server_cn, gen_cn, fixer_cn, seconds in finished:
+            await JobRecord.create(
+                project_id=1,
+                command_id=1,
+                group_item_id_list_ref="",
+                code_str_ref="",
+                server_code_name=server_cn,
+                server_host=server_cn,
+                status=JobStatus.FINISHED,
+                generator_code_name=gen_cn,
+                fixer_code_name=fixer_cn,
+                prompt_positive="",
+                prompt_negative="",
+                result_img="",
+                render_seconds=seconds,
+            )
+        # only the finished jobs count
+        await JobRecord.filter(id=1).update(status=JobStatus.QUEUED)
+        await JobRecord.filter(id=2).update(render_seconds=20.0)
+
+        estimate = await estimate_command("s1 and s2 -$ gen: chars > fix")
+        s1, s2 = estimate.servers
+        assert s1.seconds_per_generator_job == 20.0
+        assert s1.seconds_per_fixer_job == {"fix": 4.0}
+        assert s1.estimated_seconds == 4 * 20.0 + 4 * 4.0
+        # the fixer never ran on s2, so it takes the average of s2
+        assert s2.seconds_per_fixer_job == {"fix": 30.0}
+        assert s2.estimated_seconds == 4 * 30.0 + 4 * 30.0
+        assert estimate.estimated_seconds == pytest.approx(1 / (1 / 96 + 1 / 240))
+
+        (s3,) = (await estimate_command("s3 -$ gen: chars")).servers
+        assert s3.estimated_seconds is None
+
+    run_with_scene(scenario)
+
+
+def validation_errors(code: str) -> list[str]:
+    errors = []
+
+    async def scenario():
+        result = await validate_code_names(PromptLanguageParser().parse(code))
+        assert result.is_valid == (len(result.errors) == 0)
+        errors.extend(result.errors)
+
+    run_with_scene(scenario)
+    return errors
+
+
+def test_validator_reports_missing_code_names():
+    assert validation_errors(CHAIN_COMMAND) == []
+    assert validation_errors(REGION_COMMAND) == []
+    assert validation_errors("s9 -$ gen: chars > fix > nofix") == [
+        "Server 's9' not found",
+        "Fixer 'nofix' not found",
+    ]
+    assert validation_errors("s1 -$ nogen: chars") == ["Workflow 'nogen' not found"]
+    assert validation_errors("s1 -$ gen: chars * nogroup") == [
+        "Group 'nogroup' not found"
+    ]
+
+
+def test_validator_reports_missing_items():
+    assert validation_errors("s1 -$ gen: chars(chars0, chars9) * poses(~poses7)") == [
+        "Item 'chars9' not found in group 'chars'",
+        "Item 'poses7' not found in group 'poses'",
+    ]
+    assert validation_errors("s1 -$ gen: chars(~chars0) * emo(emo1)") == []
+
+
+def test_validator_reports_bad_region_selections():
+    # the selections of each keyword get the messages of the other selections
+    assert validation_errors(
+        "s1 -$ gen: reg{left: chars(chars9) * emo, right: nogroup}"
+    ) == [
+        "Item 'chars9' not found in group 'chars'",
+        "Group 'nogroup' not found",
+    ]
+    assert validation_errors("s1 -$ gen: reg{left: chars}") == [
+        "Missing region keywords from command: {'right'}"
+    ]
+    assert validation_errors("s1 -$ gen: reg{left: chars, right: emo, up: poses}") == [
+        "Missing color coded keywords from group 'reg': {'up'}'"
+    ]
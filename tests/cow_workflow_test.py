@@ -0,0 +1,29 @@
+import json
+
+from src.core.utils.cow_workflow import CowWorkflow
+from src.core.utils.mask_injector import inject_masks
+
+
+def test_cow_workflow_leaves_base_untouched():
+    base = {
+        "1": {"class_type": "KSampler", "inputs": {"seed": 1, "model": ["2", 0]}},
+        "2": {"class_type": "CheckpointLoaderSimple", "inputs": {}},
+    }
+    before = json.dumps(base, sort_keys=True)
+
+    workflow = CowWorkflow(base)
+    workflow.edit("1")["inputs"]["seed"] = 2
+    workflow["3"] = {"class_type": "SaveImage", "inputs": {}}
+
+    assert json.dumps(base, sort_keys=True) == before
+    assert workflow["1"]["inputs"]["seed"] == 2
+    assert workflow["2"] is base["2"]
+    assert json.loads(json.dumps(workflow))["3"]["class_type"] == "SaveImage"
+
+
+def test_inject_masks_without_prompts_shares_nodes():
+    base = {"1": {"class_type": "KSampler", "inputs": {}}}
+    workflow = inject_masks(base, [])
+
+    assert workflow == base
+    assert workflow["1"] is base["1"]
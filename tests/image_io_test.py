@@ -0,0 +1,35 @@
+import asyncio
+import io
+import os
+
+from PIL import Image
+
+from src.core.utils.image_io import detect_image_format, save_image_bytes
+
+
+def image_bytes(image_format: str) -> bytes:
+    out = io.BytesIO()
+    Image.new("RGB", (8, 8), (255, 0, 0)).save(out, format=image_format)
+    return out.getvalue()
+
+
+def test_detect_image_format():
+    assert detect_image_format(image_bytes("PNG")) == "PNG"
+    assert detect_image_format(image_bytes("JPEG")) == "JPEG"
+    assert detect_image_format(image_bytes("WEBP")) == "WEBP"
+    assert detect_image_format(b"not an image") is None
+
+
+def test_save_image_bytes():
+    os.makedirs("/tmp/image_io", exist_ok=True)
+    png = image_bytes("PNG")
+    asyncio.run(save_image_bytes("/tmp/image_io/result.png", png))
+    with open("/tmp/image_io/result.png", "rb") as f:
+        assert f.read() == png
+
+    # converted when the format doesn't match the extension
+    asyncio.run(save_image_bytes("/tmp/image_io/result.png", image_bytes("JPEG")))
+    with open("/tmp/image_io/result.png", "rb") as f:
+        assert detect_image_format(f.read()) == "PNG"
+
+    assert [f for f in os.listdir("/tmp/image_io") if f.endswith(".tmp")] == []
@@ -0,0 +1,391 @@
+import asyncio
+import io
+import itertools
+from datetime import timedelta
+from pathlib import Path
+from types import SimpleNamespace
+
+from PIL import Image
+from tortoise import Tortoise, timezone
+from yet_another_comfy_client import EventType, StatusData
+
+from src.controllers import manager_ctrl
+from src.controllers.ctrl_types import ServerData
+from src.controllers.manager_ctrl import (
+    Manager,
+    claim_job,
+    reconcile_jobs,
+    requeue_orphaned_jobs,
+)
+from src.controllers.prompt_builder import compress_prompt
+from src.core.config import Config
+from src.db.records import FixerRecord, GeneratorRecord, JobRecord
+from src.db.records.job_rec import JobStatus
+
+PROMPT_IDS = itertools.count(1)
+
+
+def png() -> bytes:
+    out = io.BytesIO()
+    Image.new("RGB", (4, 4), (255, 0, 0)).save(out, format="PNG")
+    return out.getvalue()
+
+
+def status_event(queue_remaining: int) -> SimpleNamespace:
+    # made without its constructor, the listener only reads the queue size
+    data = StatusData.__new__(StatusData)
+    data.status = SimpleNamespace(
+        exec_info=SimpleNamespace(queue_remaining=queue_remaining)
+    )
+    return SimpleNamespace(type=EventType.STATUS, data=data)
+
+
+class FakeComfyClient:
+    """Renders the queued prompts one at a time like a ComfyUI server."""
+
+    def __init__(self, code_name: str, render_seconds: float):
+        self.code_name = code_name
+        self.render_seconds = render_seconds
+        self.history: dict[str, SimpleNamespace] = {}
+        # the jobs whose prompts fail, with the event sent instead of the
+        # success, None when the server sends nothing
+        self.failures: dict[int, EventType | None] = {}
+        # (event, job id) in the order they happened
+        self.log: list[tuple[str, int]] = []
+        self._queue: asyncio.Queue[tuple[str, int]] = asyncio.Queue()
+        self._subscribers: list[asyncio.Queue] = []
+        self._renderer = asyncio.create_task(self.render())
+
+    async def render(self):
+        while True:
+            prompt_id, job_id = await self._queue.get()
+            await asyncio.sleep(self.render_seconds)
+            events = []
+            if job_id in self.failures:
+                self.log.append(("failed", job_id))
+                if self.failures[job_id] is not None:
+                    events.append(self.failures[job_id])
+            else:
+                self.history[prompt_id] = SimpleNamespace(
+                    output_images={"9": [png()]}
+                )
+                self.log.append(("rendered", job_id))
+                events.append(EventType.EXECUTION_SUCCESS)
+
+            for subscriber in self._subscribers:
+                for event_type in events:
+                    subscriber.put_nowait(
+                        SimpleNamespace(
+                            type=event_type, data=SimpleNamespace(prompt_id=prompt_id)
+                        )
+                    )
+                subscriber.put_nowait(status_event(self._queue.qsize()))
+
+    async def queue_prompt(self, prompt):
+        prompt_id = f"{self.code_name}-{next(PROMPT_IDS)}"
+        self.log.append(("queued", prompt["job"]))
+        self._queue.put_nowait((prompt_id, prompt["job"]))
+        return {"prompt_id": prompt_id}
+
+    async def get_events(self):
+        events: asyncio.Queue = asyncio.Queue()
+        self._subscribers.append(events)
+        try:
+            while True:
+                yield await events.get()
+        finally:
+            self._subscribers.remove(events)
+
+    async def get_images_by_prompt_id(self, prompt_id: str):
+        return self.history.get(prompt_id)
+
+    async def close(self):
+        self._renderer.cancel()
+
+    def rendered(self) -> list[int]:
+        return [job_id for event, job_id in self.log if event == "rendered"]
+
+
+async def create_job(
+    result_path: Path,
+    server_code_name: str,
+    status: JobStatus = JobStatus.QUEUED,
+    **kwargs,
+) -> JobRecord:
+    job = await JobRecord.create(
+        project_id=1,
+        command_id=1,
+        group_item_id_list_ref="",
+        code_str_ref="",
+        server_code_name=server_code_name,
+        server_host=server_code_name,
+        prompt_positive="",
+        prompt_negative="",
+        result_img="",
+        status=status,
+        compiled_version=1,
+        **kwargs,
+    )
+    # the fake server tells the jobs apart by the prompt
+    job.compiled_prompt = compress_prompt({"job": job.id})
+    job.result_img = f"{result_path}/{job.id}.png"
+    await job.save()
+    return job
+
+
+async def wait_until_finished(job_ids: list[int], timeout: float = 10):
+    async with asyncio.timeout(timeout):
+        while (
+            await JobRecord.filter(id__in=job_ids, status=JobStatus.FINISHED).count()
+            < len(job_ids)
+        ):
+            await asyncio.sleep(0.01)
+
+
+def add_fake_server(manager: Manager, client: FakeComfyClient) -> FakeComfyClient:
+    code_name = client.code_name
+    manager.add_server(
+        ServerData(id=1, host=code_name, code_name=code_name, client=client)
+    )
+    return client
+
+
+def run_manager(tmp_path, servers: dict[str, float], scenario):
+    """
+    Runs the scenario with a manager that dispatches to fake servers, given
+    with how many seconds each of them renders a prompt.
+    """
+
+    async def run():
+        await Tortoise.init(
+            db_url="sqlite://:memory:", modules={"models": ["src.db.records"]}
+        )
+        await Tortoise.generate_schemas()
+        await GeneratorRecord.create(
+            name="gen", code_name="gen", save_image_title="save", workflow_json={}
+        )
+        await FixerRecord.create(
+            name="fix",
+            code_name="fix",
+            load_image_title="load",
+            save_image_title="save",
+            workflow_json={},
+        )
+        conf = Config(
+            db_path="",
+            result_path=str(tmp_path),
+            controlnet_references_path="",
+            ipadapter_references_path="",
+            colored_region_path="",
+            thumbnails_path="",
+        )
+        manager = Manager(conf)
+        dispatcher = asyncio.create_task(manager.dispatch_jobs())
+        clients = {
+            code_name: add_fake_server(manager, FakeComfyClient(code_name, seconds))
+            for code_name, seconds in servers.items()
+        }
+
+        try:
+            await scenario(manager, clients)
+        finally:
+            for code_name in list(manager._servers.keys()):
+                await manager.remove_server(code_name)
+            dispatcher.cancel()
+            await Tortoise.close_connections()
+
+    asyncio.run(run())
+
+
+def test_servers_drain_at_the_same_time(tmp_path, monkeypatch):
+    monkeypatch.setattr(manager_ctrl, "MAX_DISPATCHED_JOBS", 4)
+    monkeypatch.setattr(manager_ctrl, "DISPATCH_BATCH_SIZE", 2)
+
+    async def scenario(manager, clients):
+        # the slow server has a long queue in front of the jobs of the fast one
+        slow_ids = [
+            (await create_job(tmp_path, "slow", generator_code_name="gen")).id
+            for _ in range(20)
+        ]
+        fast_ids = [
+            (await create_job(tmp_path, "fast", generator_code_name="gen")).id
+            for _ in range(5)
+        ]
+        manager.rescan_queue()
+
+        await wait_until_finished(fast_ids)
+        assert sorted(clients["fast"].rendered()) == fast_ids
+        assert len(clients["slow"].rendered()) < len(slow_ids) // 2
+
+        await wait_until_finished(slow_ids)
+        assert sorted(clients["slow"].rendered()) == slow_ids
+
+    run_manager(tmp_path, {"slow": 0.05, "fast": 0.001}, scenario)
+
+
+def test_fixer_waits_for_its_job(tmp_path):
+    async def scenario(manager, clients):
+        job = await create_job(tmp_path, "s1", generator_code_name="gen")
+        fixer = await create_job(
+            tmp_path, "s1", fixer_code_name="fix", fix_job_id=job.id
+        )
+        manager.rescan_queue()
+
+        await wait_until_finished([job.id, fixer.id])
+        assert clients["s1"].log == [
+            ("queued", job.id),
+            ("rendered", job.id),
+            ("queued", fixer.id),
+            ("rendered", fixer.id),
+        ]
+
+    run_manager(tmp_path, {"s1": 0.02}, scenario)
+
+
+def test_pool_jobs_run_on_every_server_of_the_pool(tmp_path):
+    async def scenario(manager, clients):
+        job_ids = [
+            (
+                await create_job(
+                    tmp_path, "s1", generator_code_name="gen", server_pool=["s1", "s2"]
+                )
+            ).id
+            for _ in range(10)
+        ]
+        manager.rescan_queue()
+
+        await wait_until_finished(job_ids)
+        assert len(clients["s1"].rendered()) > 0
+        assert len(clients["s2"].rendered()) > 0
+        assert sorted(clients["s1"].rendered() + clients["s2"].rendered()) == job_ids
+
+    run_manager(tmp_path, {"s1": 0.01, "s2": 0.01}, scenario)
+
+
+def test_failed_prompts_free_the_server(tmp_path):
+    async def scenario(manager, clients):
+        failed_ids = [
+            (await create_job(tmp_path, "s1", generator_code_name="gen")).id
+            for _ in range(3)
+        ]
+        job_ids = [
+            (await create_job(tmp_path, "s1", generator_code_name="gen")).id
+            for _ in range(3)
+        ]
+        # the last failure is a prompt lost in a restart of ComfyUI
+        clients["s1"].failures = {
+            failed_ids[0]: EventType.EXECUTION_ERROR,
+            failed_ids[1]: EventType.EXECUTION_INTERRUPTED,
+            failed_ids[2]: None,
+        }
+        manager.rescan_queue()
+
+        await wait_until_finished(job_ids)
+        async with asyncio.timeout(10):
+            while (
+                await JobRecord.filter(
+                    id__in=failed_ids, status=JobStatus.WAITING
+                ).count()
+                < len(failed_ids)
+            ):
+                await asyncio.sleep(0.01)
+
+        for job in await JobRecord.filter(id__in=failed_ids):
+            assert job.lease_expires_at is None
+        assert manager._servers["s1"].in_flight_tasks == {}
+
+    run_manager(tmp_path, {"s1": 0.01}, scenario)
+
+
+def test_orphaned_jobs_are_queued_again(tmp_path):
+    async def scenario(manager, clients):
+        expired = await create_job(tmp_path, "s1", generator_code_name="gen")
+        leased = await create_job(tmp_path, "s1", generator_code_name="gen")
+        await JobRecord.filter(id=expired.id).update(
+            status=JobStatus.PROCESSING,
+            lease_expires_at=timezone.now() - timedelta(seconds=1),
+        )
+        await JobRecord.filter(id=leased.id).update(
+            status=JobStatus.PROCESSING, lease_expires_at=manager_ctrl.lease_deadline()
+        )
+
+        assert await requeue_orphaned_jobs() == 1
+        assert (await JobRecord.get(id=expired.id)).status == JobStatus.QUEUED
+        assert (await JobRecord.get(id=leased.id)).status == JobStatus.PROCESSING
+
+        # only one server can claim a queued job
+        sd = ServerData(id=1, host="s1", code_name="s1", client=None)
+        assert await claim_job(sd, expired.id) is not None
+        assert await claim_job(sd, expired.id) is None
+
+    # no server is online, so the dispatcher leaves the jobs alone
+    run_manager(tmp_path, {}, scenario)
+
+
+def rendered_output() -> SimpleNamespace:
+    return SimpleNamespace(output_images={"9": [png()]})
+
+
+def test_reconcile_saves_the_prompts_rendered_before_a_crash(tmp_path):
+    async def scenario(manager, clients):
+        client = FakeComfyClient("s1", 0.01)
+        client.history["old-1"] = rendered_output()
+        client.history["old-3"] = rendered_output()
+        expired_at = timezone.now() - timedelta(seconds=1)
+        rendered, not_rendered, leased = [
+            await create_job(
+                tmp_path,
+                "s1",
+                generator_code_name="gen",
+                status=JobStatus.PROCESSING,
+                comfyui_prompt_id=prompt_id,
+                lease_expires_at=lease_expires_at,
+            )
+            for prompt_id, lease_expires_at in [
+                ("old-1", expired_at),
+                ("old-2", expired_at),
+                # another worker owns it
+                ("old-3", manager_ctrl.lease_deadline()),
+            ]
+        ]
+
+        sd = ServerData(id=1, host="s1", code_name="s1", client=client)
+        try:
+            assert await reconcile_jobs(sd) == 1
+        finally:
+            await client.close()
+
+        job = await JobRecord.get(id=rendered.id)
+        assert job.status == JobStatus.FINISHED
+        assert Path(job.result_img).exists()
+        # the old status and lease are back when the history has no images
+        job = await JobRecord.get(id=not_rendered.id)
+        assert job.status == JobStatus.PROCESSING
+        assert job.lease_expires_at == not_rendered.lease_expires_at
+        job = await JobRecord.get(id=leased.id)
+        assert job.status == JobStatus.PROCESSING
+        assert not Path(job.result_img).exists()
+        assert client.log == []
+
+    run_manager(tmp_path, {}, scenario)
+
+
+def test_queued_jobs_are_rendered_unless_in_the_history(tmp_path):
+    async def scenario(manager, clients):
+        client = FakeComfyClient("s1", 0.01)
+        client.history["old-1"] = rendered_output()
+        rendered, not_rendered = [
+            await create_job(
+                tmp_path, "s1", generator_code_name="gen", comfyui_prompt_id=prompt_id
+            )
+            for prompt_id in ["old-1", "old-2"]
+        ]
+
+        add_fake_server(manager, client)
+        await wait_until_finished([rendered.id, not_rendered.id])
+        assert client.log == [
+            ("queued", not_rendered.id),
+            ("rendered", not_rendered.id),
+        ]
+
+    run_manager(tmp_path, {}, scenario)
@@ -87,3 +87,16 @@ def test_color_coded_keyword_parser():
         "item1"
         in cmd.group_selections[0].region_group_selections["red"][1].include_only
     )
+
+
+def test_server_pool_parser():
+    parser = PromptLanguageParser()
+    cmd = parser.parse("server_1 and server_2 -$ workflow_anime: characters")
+
+    assert cmd.server_code_name == "server_1"
+    assert cmd.server_pool == ["server_1", "server_2"]
+    assert cmd.generator_code_name == "workflow_anime"
+    assert cmd.group_selections[0].group_code_name == "characters"
+
+    cmd = parser.parse("server_1 -$ workflow_anime: characters")
+    assert cmd.server_pool is None
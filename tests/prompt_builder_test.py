@@ -0,0 +1,126 @@
+from dataclasses import asdict
+
+from src.controllers import workflow_templates
+from src.controllers.prompt_builder import generator_prompt, injection_fingerprint
+from src.controllers.workflow_templates import invalidate_generator_template
+from src.db.records import GeneratorRecord, JobRecord
+from src.db.records.job_rec import CoordinatedRegion, RegionPrompt
+
+WORKFLOW = {
+    "3": {
+        "class_type": "KSampler",
+        "inputs": {"model": ["4", 0], "positive": ["6", 0], "negative": ["7", 0]},
+    },
+    "4": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": "x"}},
+    "6": {
+        "class_type": "CLIPTextEncode",
+        "inputs": {"text": "", "clip": ["4", 1]},
+        "_meta": {"title": "positive"},
+    },
+    "7": {
+        "class_type": "CLIPTextEncode",
+        "inputs": {"text": "", "clip": ["4", 1]},
+        "_meta": {"title": "negative"},
+    },
+    "8": {"class_type": "VAEDecode", "inputs": {"samples": ["3", 0], "vae": ["4", 2]}},
+}
+
+
+def generator(gen_id: int = 1, version: int = 1) -> GeneratorRecord:
+    invalidate_generator_template(gen_id)
+    return GeneratorRecord(
+        id=gen_id,
+        name="gen",
+        code_name="gen",
+        positive_prompt_title="positive",
+        negative_prompt_title="negative",
+        load_image_controlnet_title=None,
+        save_image_title="save",
+        workflow_json=WORKFLOW,
+        version=version,
+    )
+
+
+def job(left: str, right: str, lora: str = "a.safetensors") -> JobRecord:
+    job = JobRecord(
+        prompt_positive=f"{left} and {right}",
+        prompt_negative="blurry",
+        reference_controlnet_img=None,
+    )
+    job.region_prompts = {
+        keyword: asdict(
+            RegionPrompt(
+                keyword=keyword,
+                mask_file=None,
+                coordinates=CoordinatedRegion(width=64, height=64, x=x, y=0),
+                prompt=prompt,
+            )
+        )
+        for keyword, x, prompt in [("left", 0, left), ("right", 64, right)]
+    }
+    job.ipadapter_list = None
+    job.lora_list = [{"name": lora, "strength_model": 1.0, "strength_clip": 1.0}]
+    return job
+
+
+def region_texts(prompt: dict) -> list[str]:
+    return sorted(
+        node["inputs"]["text"]
+        for node in prompt.values()
+        if node["class_type"] == "CLIPTextEncode"
+    )
+
+
+def test_jobs_differing_in_texts_share_one_injection():
+    gen = generator()
+    cat = generator_prompt(gen, job("a cat", "a dog"))
+    bird = generator_prompt(gen, job("a bird", "a fish"))
+
+    assert len(workflow_templates._injected) == 1
+    assert region_texts(cat) == ["a cat", "a cat and a dog", "a dog", "blurry"]
+    assert region_texts(bird) == ["a bird", "a bird and a fish", "a fish", "blurry"]
+    # the shared workflow is not changed by the texts of the jobs
+    assert cat != bird
+    assert generator_prompt(gen, job("a cat", "a dog")) == cat
+
+    generator_prompt(gen, job("a cat", "a dog", lora="b.safetensors"))
+    assert len(workflow_templates._injected) == 2
+
+
+def test_version_bump_misses_the_injection_cache():
+    gen = generator()
+    generator_prompt(gen, job("a cat", "a dog"))
+    (key,) = workflow_templates._injected
+
+    # an edited generator that was not invalidated still misses the cache
+    gen.version = 2
+    gen.workflow_json = {
+        **WORKFLOW,
+        "4": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": "y"}},
+    }
+    prompt = generator_prompt(gen, job("a cat", "a dog"))
+
+    assert list(workflow_templates._injected) == [key, (key[0], 2, key[2])]
+    assert prompt["4"]["inputs"]["ckpt_name"] == "y"
+
+
+def test_injection_cache_stays_within_its_node_limit(monkeypatch):
+    gen = generator()
+    size = workflow_templates.generator_template(gen).node_count
+    injected_size = len(generator_prompt(gen, job("a cat", "a dog")))
+    monkeypatch.setattr(workflow_templates, "MAX_INJECTED_NODES", 3 * injected_size)
+
+    for i in range(10):
+        generator_prompt(gen, job("a cat", "a dog", lora=f"{i}.safetensors"))
+        count = sum(w.node_count for w in workflow_templates._injected.values())
+        assert count == workflow_templates._injected_node_count
+        assert count <= workflow_templates.MAX_INJECTED_NODES
+
+    assert injected_size > size
+    assert len(workflow_templates._injected) == 3
+    # the least recently used injections were dropped
+    kept = [job("a cat", "a dog", lora=f"{i}.safetensors") for i in range(7, 10)]
+    assert [key[2] for key in workflow_templates._injected] == [
+        injection_fingerprint(job) for job in kept
+    ]
+
@@ -0,0 +1,45 @@
+import json
+
+from src.core.utils import LoRAInjector
+from src.core.utils.ipadapter_injector import add_multiple_ipadapters_to_workflow
+from src.core.utils.mask_injector import inject_masks
+from src.core.utils.workflow_graph import WorkflowGraph
+from src.db.records.job_rec import CoordinatedRegion, RegionPrompt
+
+WORKFLOW = {
+    "3": {
+        "class_type": "KSampler",
+        "inputs": {"model": ["4", 0], "positive": ["6", 0], "negative": ["7", 0]},
+    },
+    "4": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": "x"}},
+    "6": {"class_type": "CLIPTextEncode", "inputs": {"text": "", "clip": ["4", 1]}},
+    "7": {"class_type": "CLIPTextEncode", "inputs": {"text": "", "clip": ["4", 1]}},
+    "8": {"class_type": "VAEDecode", "inputs": {"samples": ["3", 0], "vae": ["4", 2]}},
+}
+
+
+def test_injectors_share_one_graph():
+    before = json.dumps(WORKFLOW, sort_keys=True)
+    graph = WorkflowGraph(WORKFLOW)
+    add_multiple_ipadapters_to_workflow(graph, [{"path": "ref.png"}])
+    LoRAInjector(graph).add_multiple_loras([{"name": "a"}, {"name": "b"}])
+    region = RegionPrompt(
+        keyword="left",
+        prompt="a cat",
+        mask_file=None,
+        coordinates=CoordinatedRegion(x=0, y=0, width=64, height=64),
+    )
+    inject_masks(graph, [region])
+
+    assert json.dumps(WORKFLOW, sort_keys=True) == before
+    assert len(graph.workflow) == 5 + 4 + 2 + 3
+    # the indexes kept up to date match the ones of a fresh scan
+    fresh = WorkflowGraph(dict(graph.workflow))
+    for node_id in graph.workflow:
+        for output_index in range(3):
+            assert sorted(graph.consumers(node_id, output_index)) == sorted(
+                fresh.consumers(node_id, output_index)
+            )
+    assert graph.workflow["3"]["inputs"]["model"] == ["12", 0]
+    assert graph.workflow["12"]["inputs"]["model"] == ["14", 0]
+    assert graph.consumers("4", 0) == [("13", "model")]